@@ -1,24 +1,31 @@
 import os
 import logging
-import zipfile
 import shutil
-from flask import Flask, render_template, request, redirect, flash, url_for, session, jsonify, send_from_directory, Response
+from flask import (Flask, render_template, request, redirect, flash, url_for, session, jsonify, send_from_directory,
+                   send_file, Response, abort)
 from werkzeug.middleware.proxy_fix import ProxyFix
 from flask_sqlalchemy import SQLAlchemy
 from sqlalchemy.orm import DeclarativeBase
 from flask_login import LoginManager, login_user, logout_user, login_required, current_user
 from flask_migrate import Migrate
-import qrcode
-from io import BytesIO
-import base64
 from werkzeug.utils import secure_filename
-from urllib.parse import urlparse
+from urllib.parse import urlparse, quote
+from werkzeug.http import http_date
 import secrets
 import uuid
+import json
+import base64
+import hashlib
+import mimetypes
+import tempfile
 from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes
 from cryptography.hazmat.backends import default_backend
 import time
-from utils import get_file_icon, format_file_size
+from datetime import datetime
+from functools import partial
+from utils import (get_file_icon, format_file_size, preallocate_file, write_stream_at, copy_stream, stream_multipart,
+                   parse_byte_ranges, decrypt_stream, decrypted_size, decompress_stream, stream_zip, is_precompressed,
+                   qr_code_png, FileRange)
 from flask_wtf import FlaskForm
 from wtforms import StringField, PasswordField, BooleanField, SubmitField
 from wtforms.validators import DataRequired, Email, EqualTo, Length, ValidationError
@@ -50,8 +57,8 @@ class SignupForm(FlaskForm):
         if user is not None:
             raise ValidationError('Please use a different email address.')
 
-# Configure logging
-logging.basicConfig(level=logging.DEBUG)
+# Configure logging; numbers for monitoring are at /metrics rather than in the logs
+logging.basicConfig(level=os.environ.get('LOG_LEVEL', 'DEBUG').upper())
 
 class Base(DeclarativeBase):
     pass
@@ -94,38 +101,152 @@ if not os.path.exists(UPLOAD_FOLDER):
 app.config['UPLOAD_FOLDER'] = UPLOAD_FOLDER
 # Set max content length for regular uploads, chunked uploads will bypass this
 app.config['MAX_CONTENT_LENGTH'] = 500 * 1024 * 1024  # 500MB for regular uploads
+# /upload and /mobile_upload stream the body straight to disk, so they can take more
+app.config['STREAMING_UPLOAD_MAX_LENGTH'] = int(os.environ.get('STREAMING_UPLOAD_MAX_LENGTH', 30 * 1024 * 1024 * 1024))
+
+# Admission control: uploads that could not be stored are refused before any data is sent.
+# USER_QUOTA is a per-user limit in bytes (unset for no limit); MIN_FREE_SPACE is kept
+# free on the upload and chunk filesystems.
+app.config['USER_QUOTA'] = int(os.environ['USER_QUOTA']) if os.environ.get('USER_QUOTA') else None
+app.config['MIN_FREE_SPACE'] = int(os.environ.get('MIN_FREE_SPACE', 1024 * 1024 * 1024))
+
+# Folder listings render the first page of files and fetch the rest on scroll
+app.config['FILE_PAGE_SIZE'] = 100
+app.config['FILE_PAGE_MAX_SIZE'] = 500
+
+# QR code images never change for a given link, let browsers keep them a long time
+app.config['QR_CODE_MAX_AGE'] = int(os.environ.get('QR_CODE_MAX_AGE', 30 * 24 * 3600))
 
 # Create a temporary directory for chunked uploads
 CHUNK_FOLDER = os.path.join(os.getcwd(), "chunks")
 if not os.path.exists(CHUNK_FOLDER):
     os.makedirs(CHUNK_FOLDER)
 
+# 'preallocate' writes each chunk straight to its offset in a preallocated file
+# under UPLOAD_FOLDER; 'chunks' stores chunk files and concatenates them at the end
+app.config['CHUNKED_UPLOAD_MODE'] = os.environ.get('CHUNKED_UPLOAD_MODE', 'preallocate')
+# Upload state grows with the number of chunks (a bit and a digest each), so it is bounded;
+# clients pick a chunk size big enough to stay under it
+app.config['MAX_UPLOAD_CHUNKS'] = int(os.environ.get('MAX_UPLOAD_CHUNKS', 10000))
+
+# Background jobs (see jobs.py): threads per web worker, 0 to run jobs inline in the request.
+# A running job whose worker hasn't sent a heartbeat for JOB_STALE_AFTER seconds is retried.
+app.config['JOB_WORKERS'] = int(os.environ.get('JOB_WORKERS', 2))
+app.config['JOB_POLL_INTERVAL'] = 5
+app.config['JOB_STALE_AFTER'] = 60
+app.config['JOB_MAX_ATTEMPTS'] = 3
+
+# Folder archives built by background jobs
+ARCHIVE_FOLDER = os.path.join(os.getcwd(), "archives")
+if not os.path.exists(ARCHIVE_FOLDER):
+    os.makedirs(ARCHIVE_FOLDER)
+
+# Image thumbnails (see thumbnails.py), rendered by THUMBNAIL_WORKERS processes per web
+# worker (0 renders them in the request instead, and only when first viewed). The cache is
+# kept under THUMBNAIL_CACHE_SIZE bytes by evicting the least recently used thumbnails.
+THUMBNAIL_FOLDER = os.path.join(os.getcwd(), "thumbnails")
+if not os.path.exists(THUMBNAIL_FOLDER):
+    os.makedirs(THUMBNAIL_FOLDER)
+app.config['THUMBNAIL_WORKERS'] = int(os.environ.get('THUMBNAIL_WORKERS', 2))
+app.config['THUMBNAIL_SIZE'] = 256
+app.config['THUMBNAIL_CACHE_SIZE'] = int(os.environ.get('THUMBNAIL_CACHE_SIZE', 512 * 1024 * 1024))
+app.config['THUMBNAIL_MAX_SOURCE_SIZE'] = 64 * 1024 * 1024
+app.config['THUMBNAIL_MAX_PIXELS'] = 100 * 1000 * 1000
+app.config['THUMBNAIL_TIMEOUT'] = 15
+# Thumbnails never change for a given file
+app.config['THUMBNAIL_MAX_AGE'] = 365 * 24 * 3600
+
+# Compression at rest: new data of a compressible type whose contents shrink well is
+# stored compressed and decompressed on the fly when read
+app.config['COMPRESS_AT_REST'] = os.environ.get('COMPRESS_AT_REST', '1') == '1'
+app.config['COMPRESSION_LEVEL'] = 6
+app.config['COMPRESSION_MIN_SIZE'] = 4096
+
+# Where file data is stored (see storage.py): 'local' keeps it under UPLOAD_FOLDER, 's3'
+# in an S3-compatible object store such as AWS S3 or MinIO (needs boto3, credentials come
+# from the usual AWS environment). With 's3', chunked uploads go straight to the store as
+# multipart uploads and downloads are redirected to presigned URLs.
+app.config['STORAGE_BACKEND'] = os.environ.get('STORAGE_BACKEND', 'local')
+app.config['S3_BUCKET'] = os.environ.get('S3_BUCKET')
+app.config['S3_PREFIX'] = os.environ.get('S3_PREFIX', '')
+app.config['S3_ENDPOINT_URL'] = os.environ.get('S3_ENDPOINT_URL')
+app.config['S3_REGION'] = os.environ.get('S3_REGION')
+app.config['S3_TRANSFER_CONCURRENCY'] = int(os.environ.get('S3_TRANSFER_CONCURRENCY', 8))
+app.config['S3_URL_EXPIRY'] = 3600
+
+# Storage sweeper (see sweeper.py): unfinished uploads idle for UPLOAD_TTL seconds expire,
+# finished archives are kept ARCHIVE_TTL seconds and finished jobs JOB_TTL seconds. Data
+# with no record left is removed once it is ORPHAN_AGE seconds old. When a storage
+# filesystem has less than GC_PRESSURE_FREE_SPACE bytes free, the sweeper runs every
+# GC_PRESSURE_INTERVAL seconds and upload and archive lifetimes drop to GC_PRESSURE_TTL.
+# GC_INTERVAL=0 leaves sweeping to `flask sweep-storage`.
+app.config['GC_INTERVAL'] = int(os.environ.get('GC_INTERVAL', 3600))
+app.config['GC_PRESSURE_INTERVAL'] = 300
+app.config['GC_PRESSURE_FREE_SPACE'] = int(os.environ.get('GC_PRESSURE_FREE_SPACE', 4 * app.config['MIN_FREE_SPACE']))
+app.config['GC_PRESSURE_TTL'] = 6 * 3600
+app.config['UPLOAD_TTL'] = int(os.environ.get('UPLOAD_TTL', 3 * 24 * 3600))
+app.config['ARCHIVE_TTL'] = 24 * 3600
+app.config['JOB_TTL'] = 7 * 24 * 3600
+app.config['ORPHAN_AGE'] = 24 * 3600
+
+# How stored files are sent once a download route has checked access. 'sendfile' serves
+# them from this process through the WSGI server's file wrapper, which gunicorn sends with
+# sendfile(2); 'x-accel-redirect' (nginx) and 'x-sendfile' (Apache mod_xsendfile, lighttpd)
+# hand the whole transfer, ranges included, to the front server. Encrypted files are
+# always decrypted and streamed here.
+app.config['DOWNLOAD_OFFLOAD'] = os.environ.get('DOWNLOAD_OFFLOAD', 'sendfile')
+# Internal nginx locations serving each storage directory for X-Accel-Redirect, e.g.
+#   location /_protected/uploads/ { internal; alias /srv/filelock/uploads/; }
+app.config['X_ACCEL_LOCATIONS'] = {
+    UPLOAD_FOLDER: '/_protected/uploads/',
+    ARCHIVE_FOLDER: '/_protected/archives/',
+}
+
+# Prometheus metrics at /metrics (see metrics.py). Each worker writes its values to
+# METRICS_FOLDER at most every METRICS_FLUSH_INTERVAL seconds so any worker can answer a
+# scrape. With METRICS_TOKEN set, scrapes must send it as a bearer token.
+METRICS_FOLDER = os.path.join(os.getcwd(), "metrics")
+if not os.path.exists(METRICS_FOLDER):
+    os.makedirs(METRICS_FOLDER)
+app.config['METRICS_FOLDER'] = METRICS_FOLDER
+app.config['METRICS_FLUSH_INTERVAL'] = 15
+app.config['METRICS_SNAPSHOT_TTL'] = 24 * 3600
+app.config['METRICS_TOKEN'] = os.environ.get('METRICS_TOKEN')
+
+# SQL profiling (see profiling.py): with SQL_PROFILING=1 every request's statements are
+# counted and timed, and requests taking SQL_PROFILING_SLOW_REQUEST seconds, running
+# SQL_PROFILING_MAX_QUERIES statements or one statement SQL_PROFILING_REPEAT_THRESHOLD
+# times (a query in a loop) are logged with the breakdown.
+app.config['SQL_PROFILING'] = os.environ.get('SQL_PROFILING', '0') == '1'
+app.config['SQL_PROFILING_SLOW_REQUEST'] = float(os.environ.get('SQL_PROFILING_SLOW_REQUEST', 0.5))
+app.config['SQL_PROFILING_MAX_QUERIES'] = 50
+app.config['SQL_PROFILING_REPEAT_THRESHOLD'] = 5
+
 # Import models after db initialization
 with app.app_context():
-    from models import User, Folder, File
+    from models import User, Folder, File, ChunkedUpload, Blob, Job
+
+from blobs import (store_blob, acquire_blob, release_blob, delete_file_data, sha256_digest, hash_location,
+                   is_chunk_tree_digest, rekey_blob, user_has_blob)
+from storage import get_storage, storage_for, spool_stream
+from jobs import job_handler, enqueue_job, report_progress, start_job_runner
+from thumbnails import has_thumbnail, get_thumbnail, queue_thumbnail
+from metrics import (chunk_receive_duration, chunk_bytes, assembly_duration, assembly_bytes, archive_build_duration,
+                     download_bytes)
+
+app.jinja_env.filters['has_thumbnail'] = has_thumbnail
+
+@app.before_request
+def ensure_job_runner():
+    # Started lazily so CLI commands and migrations don't spin up the pool;
+    # the first request also picks up jobs left queued before a restart
+    start_job_runner()
 
 @app.route('/')
 @login_required
 def index():
     user_id = current_user.id
     
-    # Generate QR code for mobile upload
-    qr = qrcode.QRCode(
-        version=1,
-        error_correction=qrcode.constants.ERROR_CORRECT_L,
-        box_size=10,
-        border=4,
-    )
-    
-    upload_url = url_for('mobile_upload', user_id=user_id, _external=True)
-    qr.add_data(upload_url)
-    qr.make(fit=True)
-    
-    img = qr.make_image(fill_color="black", back_color="white")
-    buffered = BytesIO()
-    img.save(buffered)
-    qr_code = base64.b64encode(buffered.getvalue()).decode()
-    
     # Get user's root folder
     root_folder = Folder.query.filter_by(user_id=user_id, parent_id=None).first()
     
@@ -135,18 +256,38 @@ def index():
         db.session.add(root_folder)
         db.session.commit()
     
-    # Get subfolders and files
+    # Get subfolders and the first page of files; the rest is fetched on scroll
     subfolders = Folder.query.filter_by(parent_id=root_folder.id).all()
-    files = File.query.filter_by(folder_id=root_folder.id).all()
+    sort, descending = listing_order(request.args)
+    files, next_cursor = list_folder_files(root_folder.id, sort, descending)
     
     return render_template('index.html', 
-                          qr_code=qr_code, 
                           user=current_user, 
                           root_folder=root_folder, 
                           subfolders=subfolders, 
                           files=files,
+                          sort=sort,
+                          order='desc' if descending else 'asc',
+                          next_cursor=next_cursor,
                           folder_locked=session.get('folder_locked', False))
 
+@app.route('/qr/mobile_upload/<int:user_id>.png')
+@login_required
+def mobile_upload_qr(user_id):
+    """QR code of the user's mobile upload link, served separately so pages stay light"""
+    if user_id != current_user.id:
+        abort(404)
+
+    # The link only changes with the host name, which is part of the cache key
+    upload_url = url_for('mobile_upload', user_id=user_id, _external=True)
+    png, etag = qr_code_png(upload_url)
+
+    response = Response(png, mimetype='image/png')
+    response.set_etag(etag)
+    response.cache_control.private = True
+    response.cache_control.max_age = app.config['QR_CODE_MAX_AGE']
+    return response.make_conditional(request)
+
 @app.route('/generate_key', methods=['POST'])
 @login_required
 def generate_key():
@@ -159,6 +300,14 @@ def generate_key():
         
     return jsonify({'key': key_hex})
 
+def set_vault_visibility(user_id, visible):
+    """Show or hide all of a user's folders with one UPDATE, whatever the tree size"""
+    Folder.query.filter(
+        Folder.user_id == user_id,
+        db.or_(Folder.is_visible != visible, Folder.is_visible.is_(None))
+    ).update({'is_visible': visible}, synchronize_session=False)
+    db.session.commit()
+
 @app.route('/lock_folder', methods=['POST'])
 @login_required
 def lock_folder():
@@ -173,23 +322,8 @@ def lock_folder():
         session['has_key'] = True
         
         # Hide all files and folders when locked
-        root_folder = Folder.query.filter_by(user_id=current_user.id, parent_id=None).first()
-        if root_folder:
-            # Hide the main folder
-            root_folder.is_visible = False
-            
-            # Update visibility of all subfolders recursively
-            def set_folder_visibility(folder_id, visible):
-                # Update subfolders
-                subfolders = Folder.query.filter_by(parent_id=folder_id).all()
-                for subfolder in subfolders:
-                    subfolder.is_visible = visible
-                    set_folder_visibility(subfolder.id, visible)
-            
-            # Hide all subfolders
-            set_folder_visibility(root_folder.id, False)
-            db.session.commit()
-            
+        set_vault_visibility(current_user.id, False)
+        
         flash('Your folder has been securely locked and hidden.')
     else:
         flash('Invalid key. Could not lock folder.')
@@ -210,23 +344,8 @@ def unlock_folder():
         session['has_key'] = True
         
         # Show all files and folders when unlocked
-        root_folder = Folder.query.filter_by(user_id=current_user.id, parent_id=None).first()
-        if root_folder:
-            # Show the main folder
-            root_folder.is_visible = True
-            
-            # Update visibility of all subfolders recursively
-            def set_folder_visibility(folder_id, visible):
-                # Update subfolders
-                subfolders = Folder.query.filter_by(parent_id=folder_id).all()
-                for subfolder in subfolders:
-                    subfolder.is_visible = visible
-                    set_folder_visibility(subfolder.id, visible)
-            
-            # Show all subfolders
-            set_folder_visibility(root_folder.id, True)
-            db.session.commit()
-            
+        set_vault_visibility(current_user.id, True)
+        
         flash('Your folder has been unlocked and is now visible.')
     else:
         flash('Invalid key. Could not unlock folder.')
@@ -267,72 +386,208 @@ def view_folder(folder_id):
         return redirect(url_for('index'))
     
     subfolders = Folder.query.filter_by(parent_id=folder.id).all()
-    files = File.query.filter_by(folder_id=folder.id).all()
+    sort, descending = listing_order(request.args)
+    files, next_cursor = list_folder_files(folder.id, sort, descending)
     
     # Get parent folders for breadcrumb navigation
-    breadcrumbs = []
-    current = folder
-    while current:
-        breadcrumbs.insert(0, current)
-        if current.parent_id:
-            current = Folder.query.get(current.parent_id)
-        else:
-            current = None
+    breadcrumbs = folder.ancestors()
     
     return render_template('index.html', 
                           folder=folder, 
                           subfolders=subfolders, 
                           files=files, 
+                          sort=sort,
+                          order='desc' if descending else 'asc',
+                          next_cursor=next_cursor,
                           breadcrumbs=breadcrumbs,
                           folder_locked=session.get('folder_locked', False))
 
+def listing_order(args):
+    """Sort key and direction requested in the query string, defaulting to name ascending"""
+    sort = args.get('sort', 'name')
+    if sort not in File.SORT_KEYS:
+        sort = 'name'
+    return sort, args.get('order') == 'desc'
+
+def encode_cursor(file, sort):
+    """Opaque cursor pointing just past the given file in the listing order"""
+    value = file.sort_value(sort)
+    if isinstance(value, datetime):
+        value = value.isoformat()
+    return base64.urlsafe_b64encode(json.dumps([value, file.id]).encode()).decode().rstrip('=')
+
+def decode_cursor(cursor, sort):
+    """Inverse of encode_cursor; returns (sort value, file id), or None if the cursor is invalid"""
+    try:
+        value, file_id = json.loads(base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)))
+        if sort == 'created_at':
+            value = datetime.fromisoformat(value)
+        elif not isinstance(value, int if sort == 'size' else str):
+            return None
+        if not isinstance(file_id, int):
+            return None
+    except (ValueError, TypeError):
+        return None
+    return value, file_id
+
+def list_folder_files(folder_id, sort, descending, after=None, limit=None):
+    """A page of a folder's files and the cursor for the next page (None on the last one)"""
+    limit = limit or app.config['FILE_PAGE_SIZE']
+    files = File.page(folder_id, sort, descending, after=after, limit=limit + 1)
+    if len(files) <= limit:
+        return files, None
+    return files[:limit], encode_cursor(files[limit - 1], sort)
+
+@app.route('/api/folder/<int:folder_id>/files', methods=['GET'])
+@login_required
+def folder_files(folder_id):
+    """
+    Keyset-paginated listing of a folder's files
+    Query parameters: sort (name, size, type, created_at), order (asc, desc),
+    limit, and cursor (next_cursor from the previous page)
+    """
+    folder = db.session.get(Folder, folder_id)
+    if not folder or folder.user_id != current_user.id:
+        return jsonify({
+            'success': False,
+            'message': 'Folder not found'
+        }), 404
+    
+    sort = request.args.get('sort', 'name')
+    order = request.args.get('order', 'asc')
+    if sort not in File.SORT_KEYS or order not in ('asc', 'desc'):
+        return jsonify({
+            'success': False,
+            'message': 'Invalid sort order'
+        }), 400
+    
+    after = None
+    cursor = request.args.get('cursor')
+    if cursor:
+        after = decode_cursor(cursor, sort)
+        if after is None:
+            return jsonify({
+                'success': False,
+                'message': 'Invalid cursor'
+            }), 400
+    
+    limit = request.args.get('limit', app.config['FILE_PAGE_SIZE'], type=int)
+    limit = max(1, min(limit, app.config['FILE_PAGE_MAX_SIZE']))
+    
+    files, next_cursor = list_folder_files(folder.id, sort, order == 'desc', after=after, limit=limit)
+    return jsonify({
+        'success': True,
+        'files': [{
+            'id': file.id,
+            'name': file.name,
+            'size': file.size,
+            'size_display': format_file_size(file.size),
+            'file_type': file.file_type,
+            'icon': get_file_icon(file.file_type),
+            'thumbnail_url': url_for('file_thumbnail', file_id=file.id) if has_thumbnail(file) else None,
+            'created_at': file.created_at.strftime('%Y-%m-%d %H:%M:%S')
+        } for file in files],
+        'next_cursor': next_cursor
+    })
+
+def stream_uploaded_files():
+    """Stream a multipart request body straight into UPLOAD_FOLDER.
+    
+    Bypasses Werkzeug's form parsing (which spools to temp files first), so each
+    file is written exactly once and its size and SHA-256 come from the copy.
+    Returns (fields, files) as produced by utils.stream_multipart.
+    """
+    request.max_content_length = app.config['STREAMING_UPLOAD_MAX_LENGTH']
+    boundary = request.mimetype_params.get('boundary')
+    if request.mimetype != 'multipart/form-data' or not boundary:
+        return {}, []
+    
+    def destination_for(field_name, filename):
+        if field_name != 'file' or not secure_filename(filename):
+            return None
+        return os.path.join(app.config['UPLOAD_FOLDER'], str(uuid.uuid4()) + "_" + secure_filename(filename))
+    
+    return stream_multipart(request.stream, boundary.encode('latin-1'), destination_for)
+
+def discard_uploaded_files(files):
+    """Remove files written by stream_uploaded_files that won't be kept"""
+    for uploaded in files:
+        if os.path.exists(uploaded['path']):
+            os.remove(uploaded['path'])
+
 @app.route('/upload', methods=['GET', 'POST'])
 @login_required
 def upload():
     if request.method == 'POST':
-        folder_id = request.form.get('folder_id')
+        # Refuse bodies that could not be stored before reading them; one sent without
+        # a length (chunked transfer encoding) can't be checked, so it is refused too
+        if request.content_length is None:
+            abort(411)
+        error = quota_error(current_user.id, request.content_length) or disk_space_error(request.content_length)
+        if error:
+            flash(error)
+            return redirect(url_for('index'))
+        
+        # Files are streamed to disk while the body is parsed; a body cut short is malformed
+        try:
+            fields, files = stream_uploaded_files()
+        except ValueError:
+            abort(400)
+        folder_id = (fields.get('folder_id') or [request.args.get('folder_id')])[0]
         
         if not folder_id:
+            discard_uploaded_files(files)
             flash('Folder ID is required.')
             return redirect(url_for('index'))
         
-        folder = Folder.query.get_or_404(folder_id)
+        folder = db.session.get(Folder, int(folder_id)) if folder_id.isdigit() else None
+        if not folder:
+            discard_uploaded_files(files)
+            abort(404)
         
         # Security check
         if folder.user_id != current_user.id:
+            discard_uploaded_files(files)
             flash('Access denied.')
             return redirect(url_for('index'))
         
         # Check if the post request has the file part
-        if 'file' not in request.files:
+        if not files:
             flash('No file part')
             return redirect(request.url)
         
-        files = request.files.getlist('file')
+        # Other uploads may have used up the quota while this one was sent
+        User.query.filter_by(id=current_user.id).with_for_update().one()
+        error = quota_error(current_user.id, sum(uploaded['size'] for uploaded in files))
+        if error:
+            discard_uploaded_files(files)
+            flash(error)
+            return redirect(url_for('index'))
         
-        for file in files:
-            if file.filename == '':
-                flash('No selected file')
-                continue
-            
-            filename = secure_filename(file.filename)
-            file_path = os.path.join(app.config['UPLOAD_FOLDER'], str(uuid.uuid4()) + "_" + filename)
-            file.save(file_path)
+        for uploaded in files:
+            filename = secure_filename(uploaded['filename'])
+            file_type = filename.split('.')[-1] if '.' in filename else ''
+            blob = store_blob(uploaded['path'], sha256_digest(uploaded['sha256']), uploaded['size'], file_type)
             
             # Create file record in database
             new_file = File(
                 name=filename,
-                path=file_path,
-                size=os.path.getsize(file_path),
-                file_type=filename.split('.')[-1] if '.' in filename else '',
-                folder_id=folder_id,
-                user_id=current_user.id
+                path=blob.path,
+                size=uploaded['size'],
+                file_type=file_type,
+                folder_id=folder.id,
+                user_id=current_user.id,
+                checksum=blob.digest,
+                compressed=blob.compressed,
+                stored_size=blob.stored_size
             )
             db.session.add(new_file)
-            db.session.commit()
+            Folder.add_to_totals(folder.id, uploaded['size'], 1)
+            queue_thumbnail(new_file)
+        db.session.commit()
         
         flash('File(s) uploaded successfully')
-        return redirect(url_for('view_folder', folder_id=folder_id))
+        return redirect(url_for('view_folder', folder_id=folder.id))
     
     folder_id = request.args.get('folder_id')
     if not folder_id:
@@ -366,6 +621,63 @@ def large_upload():
     return render_template('large_upload.html', folder=folder)
 
 # Chunked upload API endpoints
+def quota_error(user_id, size):
+    """Message explaining why the user can't store size more bytes, or None if it fits.
+    
+    Counts stored files (from the root folders' maintained totals) and the full size of
+    every unfinished chunked upload, which stays reserved until it completes or is cancelled.
+    """
+    quota = app.config['USER_QUOTA']
+    if quota is None:
+        return None
+    
+    stored = db.session.query(db.func.coalesce(db.func.sum(Folder.tree_size), 0)).filter(
+        Folder.user_id == user_id, Folder.parent_id.is_(None)).scalar()
+    reserved = db.session.query(db.func.coalesce(db.func.sum(ChunkedUpload.total_size), 0)).filter(
+        ChunkedUpload.user_id == user_id, ChunkedUpload.status.in_(('uploading', 'assembling'))).scalar()
+    available = quota - stored - reserved
+    if size > available:
+        return f'Not enough storage quota: {format_file_size(max(0, available))} available'
+    return None
+
+def pending_upload_space():
+    """Disk space unfinished chunked uploads will still write, per filesystem device.
+    
+    Preallocated uploads already hold their space. Uploads kept as chunk files still
+    need their missing chunks in CHUNK_FOLDER and a full copy in UPLOAD_FOLDER on assembly.
+    """
+    missing, assembled = db.session.query(
+        db.func.coalesce(db.func.sum(ChunkedUpload.total_size * (ChunkedUpload.total_chunks - ChunkedUpload.received_count)
+                                     / ChunkedUpload.total_chunks), 0),
+        db.func.coalesce(db.func.sum(ChunkedUpload.total_size), 0)
+    ).filter(ChunkedUpload.status.in_(('uploading', 'assembling')), ChunkedUpload.target_path.is_(None)).one()
+    
+    pending = {}
+    for folder, size in ((CHUNK_FOLDER, missing), (app.config['UPLOAD_FOLDER'], assembled)):
+        device = os.stat(folder).st_dev
+        pending[device] = pending.get(device, 0) + int(size)
+    return pending
+
+def disk_space_error(size, chunked=False):
+    """Message explaining why size more bytes won't fit on disk, or None if they do.
+    
+    A chunked upload that is not written in place needs the space twice: once for the
+    chunk files and once for the assembled file.
+    """
+    needed = {}
+    paths = {}
+    for folder in ((CHUNK_FOLDER, app.config['UPLOAD_FOLDER']) if chunked else (app.config['UPLOAD_FOLDER'],)):
+        device = os.stat(folder).st_dev
+        needed[device] = needed.get(device, 0) + size
+        paths[device] = folder
+    
+    pending = pending_upload_space()
+    for device, size_needed in needed.items():
+        free = shutil.disk_usage(paths[device]).free - pending.get(device, 0) - app.config['MIN_FREE_SPACE']
+        if size_needed > free:
+            return f'Not enough free space on the server: {format_file_size(max(0, free))} available'
+    return None
+
 @app.route('/api/upload/init', methods=['POST'])
 @login_required
 def init_chunked_upload():
@@ -374,8 +686,9 @@ def init_chunked_upload():
     filename = request.form.get('filename')
     total_size = request.form.get('total_size')
     total_chunks = request.form.get('total_chunks')
+    chunk_size = request.form.get('chunk_size')
     
-    if not folder_id or not filename or not total_size or not total_chunks:
+    if not folder_id or not filename or not total_size or not total_chunks or not chunk_size:
         return jsonify({
             'success': False,
             'message': 'Missing required parameters'
@@ -389,23 +702,87 @@ def init_chunked_upload():
             'message': 'Access denied'
         }), 403
     
+    try:
+        total_size = int(total_size)
+        total_chunks = int(total_chunks)
+        chunk_size = int(chunk_size)
+    except ValueError:
+        return jsonify({
+            'success': False,
+            'message': 'Invalid size parameters'
+        }), 400
+    
+    # Every chunk but the last is chunk_size long
+    if total_size < 0 or chunk_size < 1 or total_chunks != max(1, -(-total_size // chunk_size)):
+        return jsonify({
+            'success': False,
+            'message': 'Invalid size parameters'
+        }), 400
+    if total_chunks > app.config['MAX_UPLOAD_CHUNKS']:
+        return jsonify({
+            'success': False,
+            'message': f"Too many chunks, at most {app.config['MAX_UPLOAD_CHUNKS']} are allowed"
+        }), 400
+    
+    # Concurrent inits by the same user wait here, so they can't both take the last of the quota
+    User.query.filter_by(id=current_user.id).with_for_update().one()
+    error = quota_error(current_user.id, total_size)
+    if error:
+        return jsonify({
+            'success': False,
+            'message': error
+        }), 413
+    
+    # An object store takes the chunks as the parts of a multipart upload if they are
+    # big enough to be parts
+    storage = get_storage()
+    multipart = (storage.supports_multipart and total_chunks <= storage.MAX_PARTS
+                 and (total_chunks == 1 or chunk_size >= storage.MIN_PART_SIZE))
+    preallocate = not multipart and app.config['CHUNKED_UPLOAD_MODE'] == 'preallocate'
+    
+    error = None if multipart else disk_space_error(total_size, chunked=not preallocate)
+    if error:
+        return jsonify({
+            'success': False,
+            'message': error
+        }), 507
+    
     # Create a unique upload ID
     upload_id = str(uuid.uuid4())
-    
-    # Create directory for chunks
-    upload_dir = os.path.join(CHUNK_FOLDER, upload_id)
-    os.makedirs(upload_dir)
-    
-    # Store upload info in session
-    session['chunked_uploads'] = session.get('chunked_uploads', {})
-    session['chunked_uploads'][upload_id] = {
-        'filename': secure_filename(filename),
-        'folder_id': folder_id,
-        'total_size': int(total_size),
-        'total_chunks': int(total_chunks),
-        'received_chunks': 0,
-        'upload_dir': upload_dir
-    }
+    filename = secure_filename(filename)
+    multipart_id = None
+    
+    if multipart:
+        # Nothing is kept on this server; any worker can take any chunk
+        target_path = storage.staging_location(upload_id)
+        multipart_id = storage.create_multipart(target_path)
+    elif preallocate:
+        # Reserve the destination up front; chunks are written to their offsets
+        target_path = os.path.join(app.config['UPLOAD_FOLDER'], f"{upload_id}_{filename}.part")
+        preallocate_file(target_path, total_size)
+    else:
+        # Create directory for chunks
+        target_path = None
+        upload_dir = os.path.join(CHUNK_FOLDER, upload_id)
+        os.makedirs(upload_dir)
+    
+    # Store upload state in the database so any worker can accept chunks
+    chunked_upload = ChunkedUpload(
+        id=upload_id,
+        user_id=current_user.id,
+        folder_id=folder.id,
+        filename=filename,
+        total_size=total_size,
+        total_chunks=total_chunks,
+        chunk_size=chunk_size,
+        target_path=target_path,
+        multipart_id=multipart_id,
+        received=ChunkedUpload.empty_bitmap(total_chunks),
+        chunk_digests=ChunkedUpload.empty_digests(total_chunks),
+        received_count=0
+    )
+    db.session.add(chunked_upload)
+    db.session.commit()
     
     return jsonify({
         'success': True,
@@ -413,106 +790,538 @@ def init_chunked_upload():
         'message': 'Upload initialized'
     })
 
+def link_existing_blob(checksum, filename, folder_id, user_id):
+    """Create a File for data that is already stored; returns None if the blob is gone"""
+    blob = acquire_blob(checksum)
+    if not blob:
+        return None
+    
+    filename = secure_filename(filename)
+    new_file = File(
+        name=filename,
+        path=blob.path,
+        size=blob.size,
+        file_type=filename.split('.')[-1] if '.' in filename else '',
+        folder_id=folder_id,
+        user_id=user_id,
+        checksum=blob.digest,
+        compressed=blob.compressed,
+        stored_size=blob.stored_size
+    )
+    db.session.add(new_file)
+    Folder.add_to_totals(folder_id, blob.size, 1)
+    db.session.commit()
+    return new_file
+
+@app.route('/api/upload/status/<upload_id>', methods=['GET'])
+@login_required
+def chunked_upload_status(upload_id):
+    """Report which chunks of an upload are still missing so a client can resume it"""
+    chunked_upload = db.session.get(ChunkedUpload, upload_id)
+    if not chunked_upload or chunked_upload.user_id != current_user.id:
+        return jsonify({
+            'success': False,
+            'message': 'Invalid upload ID'
+        }), 404
+    
+    if chunked_upload.status == 'uploading' and start_assembly(chunked_upload):
+        db.session.refresh(chunked_upload)
+    
+    status = chunked_upload.to_dict()
+    status['missing_ranges'] = chunked_upload.missing_ranges()
+    if chunked_upload.job_id:
+        status['job'] = db.session.get(Job, chunked_upload.job_id).to_dict()
+    return jsonify({
+        'success': True,
+        'upload': status
+    })
+
+@app.route('/api/uploads', methods=['GET'])
+@login_required
+def list_chunked_uploads():
+    """List the current user's unfinished uploads, optionally for one folder"""
+    query = ChunkedUpload.query.filter_by(user_id=current_user.id, status='uploading')
+    
+    folder_id = request.args.get('folder_id', type=int)
+    if folder_id:
+        query = query.filter_by(folder_id=folder_id)
+    
+    uploads = query.order_by(ChunkedUpload.updated_at.desc()).all()
+    return jsonify({
+        'success': True,
+        'uploads': [chunked_upload.to_dict() for chunked_upload in uploads]
+    })
+
+@app.route('/api/upload/<upload_id>', methods=['DELETE'])
+@login_required
+def cancel_chunked_upload(upload_id):
+    """Abandon an unfinished upload, deleting its partial data and releasing its reservation"""
+    chunked_upload = db.session.get(ChunkedUpload, upload_id)
+    if not chunked_upload or chunked_upload.user_id != current_user.id:
+        return jsonify({
+            'success': False,
+            'message': 'Invalid upload ID'
+        }), 404
+    # Keep its paths around once the row is gone
+    db.session.expunge(chunked_upload)
+    
+    # Only an upload nobody is finishing can be cancelled
+    cancelled = ChunkedUpload.query.filter_by(id=upload_id, status='uploading').delete(synchronize_session=False)
+    db.session.commit()
+    if not cancelled:
+        return jsonify({
+            'success': False,
+            'message': 'Upload is already being completed'
+        }), 409
+    
+    discard_chunked_upload_data(chunked_upload)
+    return jsonify({
+        'success': True,
+        'message': 'Upload cancelled'
+    })
+
+def mark_chunk_received(upload_id, chunk_number, digest):
+    """Atomically set a chunk's bit in the received bitmap and record its SHA-256.
+    
+    Uses an optimistic compare-and-swap on the version column so that chunks
+    arriving concurrently on different workers never lose an update.
+    Returns the refreshed upload and whether this call set the bit, or (None, False)
+    if the upload was cancelled meanwhile.
+    """
+    while True:
+        chunked_upload = ChunkedUpload.query.filter_by(id=upload_id).populate_existing().one_or_none()
+        if not chunked_upload:
+            return None, False
+        if chunked_upload.has_chunk(chunk_number):
+            # Retried chunk, already counted
+            return chunked_upload, False
+        
+        updated = ChunkedUpload.query.filter_by(id=upload_id, version=chunked_upload.version).update({
+            'received': chunked_upload.bitmap_with(chunk_number),
+            'chunk_digests': chunked_upload.digests_with(chunk_number, digest),
+            'received_count': ChunkedUpload.received_count + 1,
+            'version': ChunkedUpload.version + 1,
+            'updated_at': datetime.utcnow()
+        }, synchronize_session=False)
+        db.session.commit()
+        
+        if updated:
+            return ChunkedUpload.query.filter_by(id=upload_id).populate_existing().one(), True
+
+def unmark_chunks(upload_id, chunk_numbers):
+    """Clear chunks from the received bitmap so the client sends them again"""
+    while True:
+        chunked_upload = ChunkedUpload.query.filter_by(id=upload_id).populate_existing().one()
+        bitmap = bytearray(chunked_upload.received)
+        for chunk_number in chunk_numbers:
+            bitmap[chunk_number // 8] &= ~(1 << (chunk_number % 8)) & 0xFF
+        
+        updated = ChunkedUpload.query.filter_by(id=upload_id, version=chunked_upload.version).update({
+            'received': bytes(bitmap),
+            'received_count': ChunkedUpload.received_count - len(chunk_numbers),
+            'status': 'uploading',
+            'version': ChunkedUpload.version + 1,
+            'updated_at': datetime.utcnow()
+        }, synchronize_session=False)
+        db.session.commit()
+        
+        if updated:
+            return
+
+def discard_chunked_upload_data(chunked_upload):
+    """Remove the partial data of an upload that will never be finished; returns the bytes freed"""
+    freed = 0
+    if chunked_upload.multipart_id:
+        # Stored parts, or the joined object if the upload got that far
+        storage = storage_for(chunked_upload.target_path)
+        storage.abort_multipart(chunked_upload.target_path, chunked_upload.multipart_id)
+        storage.delete(chunked_upload.target_path)
+    elif chunked_upload.target_path and os.path.exists(chunked_upload.target_path):
+        freed += os.path.getsize(chunked_upload.target_path)
+        os.remove(chunked_upload.target_path)
+    upload_dir = os.path.join(CHUNK_FOLDER, chunked_upload.id)
+    if os.path.exists(upload_dir):
+        freed += sum(entry.stat().st_size for entry in os.scandir(upload_dir) if entry.is_file())
+        shutil.rmtree(upload_dir, ignore_errors=True)
+    if chunked_upload.blob_digest:
+        # Assembly stored the data but never created the File
+        release_blob(chunked_upload.blob_digest)
+    return freed
+
+def claim_assembly(upload_id):
+    """Move an upload from 'uploading' to 'assembling'; only one caller wins"""
+    claimed = ChunkedUpload.query.filter_by(id=upload_id, status='uploading').update({
+        'status': 'assembling'
+    }, synchronize_session=False)
+    db.session.commit()
+    return claimed == 1
+
+def start_assembly(chunked_upload):
+    """
+    Queue the assembly of an upload whose chunks have all arrived
+    Also called when a chunk is resent or the status polled, so an upload whose
+    worker stopped between storing the last chunk and queueing the job still finishes.
+    :return: the assembly Job, or None if chunks are missing or another request got to it
+    """
+    if not chunked_upload.is_complete or not claim_assembly(chunked_upload.id):
+        return None
+    job = enqueue_job('assemble_upload', chunked_upload.user_id, {'upload_id': chunked_upload.id})
+    ChunkedUpload.query.filter_by(id=chunked_upload.id).update({'job_id': job.id}, synchronize_session=False)
+    db.session.commit()
+    return job
+
 @app.route('/api/upload/chunk/<upload_id>', methods=['POST'])
 @login_required
 def upload_chunk(upload_id):
     """Handle upload of a single chunk"""
-    if 'chunked_uploads' not in session or upload_id not in session['chunked_uploads']:
+    started = time.perf_counter()
+    chunked_upload = db.session.get(ChunkedUpload, upload_id)
+    if not chunked_upload or chunked_upload.user_id != current_user.id:
         return jsonify({
             'success': False,
             'message': 'Invalid upload ID'
         }), 400
     
-    upload_info = session['chunked_uploads'][upload_id]
+    if chunked_upload.status != 'uploading':
+        return jsonify({
+            'success': True,
+            'message': 'Upload already complete' if chunked_upload.status == 'complete' else 'Upload is being assembled',
+            'status': chunked_upload.status,
+            'file_id': chunked_upload.file_id
+        })
+    
+    # Chunks arrive either as a raw request body (chunk number in the query
+    # string) or as a multipart form with a 'chunk' file part
+    raw_body = request.mimetype == 'application/octet-stream'
     
     # Get chunk number
-    chunk_number = request.form.get('chunk_number')
+    chunk_number = request.args.get('chunk_number') if raw_body else request.form.get('chunk_number')
     if not chunk_number:
         return jsonify({
             'success': False,
             'message': 'Missing chunk number'
         }), 400
     
-    chunk_number = int(chunk_number)
+    try:
+        chunk_number = int(chunk_number)
+    except ValueError:
+        chunk_number = -1
     
-    # Check if the post request has the file part
-    if 'chunk' not in request.files:
+    if chunk_number < 0 or chunk_number >= chunked_upload.total_chunks:
         return jsonify({
             'success': False,
-            'message': 'No file part'
+            'message': 'Invalid chunk number'
         }), 400
     
-    # Save chunk to disk
-    chunk = request.files['chunk']
-    chunk_path = os.path.join(upload_info['upload_dir'], f'chunk_{chunk_number}')
-    chunk.save(chunk_path)
+    if chunked_upload.has_chunk(chunk_number):
+        # Already stored and verified, don't touch the data again
+        job = start_assembly(chunked_upload)
+        if job:
+            return assembly_response(job)
+        return jsonify({
+            'success': True,
+            'message': f'Chunk {chunk_number} already received',
+            'received_chunks': chunked_upload.received_count,
+            'total_chunks': chunked_upload.total_chunks
+        })
+    
+    # Optional 'sha256:<hex>' of the chunk, checked against what actually arrived
+    expected_checksum = request.headers.get('X-Chunk-Checksum') or request.args.get('checksum')
+    if not expected_checksum and not raw_body:
+        expected_checksum = request.form.get('checksum')
+    
+    if raw_body:
+        chunk_stream = request.stream
+    elif 'chunk' in request.files:
+        chunk_stream = request.files['chunk'].stream
+    else:
+        # Check if the post request has the file part
+        return jsonify({
+            'success': False,
+            'message': 'No file part'
+        }), 400
     
-    # Update received chunks count
-    upload_info['received_chunks'] += 1
+    chunk_hash = hashlib.sha256()
+    part = None
+    if chunked_upload.multipart_id:
+        # Buffer the chunk so it can be verified before it is sent on as a part
+        expected = chunked_upload.chunk_length(chunk_number)
+        part = tempfile.SpooledTemporaryFile(max_size=8 * 1024 * 1024, dir=CHUNK_FOLDER)
+        written = spool_stream(chunk_stream, part, hasher=chunk_hash)
+        if written != expected:
+            part.close()
+            return jsonify({
+                'success': False,
+                'retry': True,
+                'message': f'Chunk {chunk_number} has {written} bytes, expected {expected}'
+            }), 400
+        chunk_path = None
+    elif chunked_upload.target_path:
+        # Write the chunk straight to its offset in the preallocated file
+        expected = chunked_upload.chunk_length(chunk_number)
+        try:
+            written = write_stream_at(chunked_upload.target_path, chunk_number * chunked_upload.chunk_size,
+                                      chunk_stream, hasher=chunk_hash)
+        except FileNotFoundError:
+            return upload_cancelled_response()
+        if written != expected:
+            return jsonify({
+                'success': False,
+                'retry': True,
+                'message': f'Chunk {chunk_number} has {written} bytes, expected {expected}'
+            }), 400
+        chunk_path = None
+    else:
+        # Save chunk to disk under a temporary name; it is renamed into place once verified
+        upload_dir = os.path.join(CHUNK_FOLDER, upload_id)
+        chunk_path = os.path.join(upload_dir, f'chunk_{chunk_number}')
+        temp_path = f"{chunk_path}.{uuid.uuid4().hex}.tmp"
+        try:
+            written = copy_stream(chunk_stream, temp_path, hasher=chunk_hash)
+        except FileNotFoundError:
+            return upload_cancelled_response()
+    
+    if expected_checksum and expected_checksum.lower() != f"sha256:{chunk_hash.hexdigest()}":
+        # Corrupted in transit; leave the chunk unmarked so only it is sent again
+        if chunk_path:
+            os.remove(temp_path)
+        if part:
+            part.close()
+        return jsonify({
+            'success': False,
+            'retry': True,
+            'message': f'Checksum mismatch for chunk {chunk_number}'
+        }), 400
     
-    # Check if all chunks received
-    if upload_info['received_chunks'] >= upload_info['total_chunks']:
-        # All chunks received, assemble file
-        return assemble_chunks(upload_id)
+    if chunk_path:
+        # A concurrent retry of the same chunk never sees a half-written file
+        try:
+            os.replace(temp_path, chunk_path)
+        except FileNotFoundError:
+            return upload_cancelled_response()
+    elif part:
+        try:
+            storage_for(chunked_upload.target_path).upload_part(chunked_upload.target_path, chunked_upload.multipart_id,
+                                                                 chunk_number + 1, part, written)
+        except FileNotFoundError:
+            return upload_cancelled_response()
+        finally:
+            part.close()
+    
+    # Update the received bitmap
+    chunked_upload, _ = mark_chunk_received(upload_id, chunk_number, chunk_hash.digest())
+    if not chunked_upload:
+        if chunk_path and os.path.exists(chunk_path):
+            os.remove(chunk_path)
+        return upload_cancelled_response()
+    chunk_receive_duration.observe(time.perf_counter() - started)
+    chunk_bytes.inc(written)
+    
+    # Check if all chunks received; only one request gets to assemble, in the background
+    job = start_assembly(chunked_upload)
+    if job:
+        return assembly_response(job)
     
     return jsonify({
         'success': True,
         'message': f'Chunk {chunk_number} received',
-        'received_chunks': upload_info['received_chunks'],
-        'total_chunks': upload_info['total_chunks']
+        'received_chunks': chunked_upload.received_count,
+        'total_chunks': chunked_upload.total_chunks
     })
 
-def assemble_chunks(upload_id):
-    """Assemble all chunks into the final file"""
-    if 'chunked_uploads' not in session or upload_id not in session['chunked_uploads']:
+def upload_cancelled_response():
+    """Reply to a chunk that arrived after its upload was cancelled"""
+    return jsonify({
+        'success': False,
+        'message': 'Upload was cancelled'
+    }), 404
+
+def assembly_response(job):
+    """Reply to the chunk that completed an upload, given its assembly job"""
+    result = json.loads(job.result) if job.result else {}
+    if job.status == 'complete' and 'missing_chunks' in result:
         return jsonify({
             'success': False,
-            'message': 'Invalid upload ID'
-        }), 400
+            'retry': True,
+            'message': f"{len(result['missing_chunks'])} chunks are missing and must be sent again",
+            'missing_chunks': result['missing_chunks']
+        }), 409
+    if job.status == 'complete':
+        return jsonify({
+            'success': True,
+            'message': 'File upload complete',
+            **result
+        })
+    if job.status == 'failed':
+        return jsonify({
+            'success': False,
+            'message': job.message or 'Could not assemble the file'
+        }), 500
     
-    upload_info = session['chunked_uploads'][upload_id]
+    # Still running; clients follow it through /api/upload/status or /api/jobs
+    return jsonify({
+        'success': True,
+        'message': 'All chunks received, assembling the file',
+        'status': 'assembling',
+        'job_id': job.id
+    }), 202
+
+@job_handler('assemble_upload')
+def assemble_upload_job(job_id, params):
+    """Background job finishing a chunked upload whose chunks have all arrived"""
+    upload_id = params['upload_id']
+    try:
+        return assemble_chunks(upload_id, job_id)
+    except Exception:
+        # Give up on the upload so its space is released
+        db.session.rollback()
+        chunked_upload = db.session.get(ChunkedUpload, upload_id)
+        if chunked_upload and chunked_upload.status == 'assembling':
+            chunked_upload.status = 'failed'
+            db.session.commit()
+            discard_chunked_upload_data(chunked_upload)
+        raise
+
+def assemble_chunks(upload_id, job_id):
+    """
+    Assemble all chunks into the final file
+    :return: the new file's details, or {'missing_chunks': [...]} if chunks must be sent again
+    """
+    started = time.perf_counter()
+    chunked_upload = db.session.get(ChunkedUpload, upload_id)
+    if not chunked_upload:
+        raise ValueError('Upload no longer exists')
+    
+    if chunked_upload.status == 'complete':
+        # An interrupted run got this far already
+        file = db.session.get(File, chunked_upload.file_id)
+        return assembled_file_details(file)
     
-    # Create final file
-    filename = upload_info['filename']
-    file_path = os.path.join(app.config['UPLOAD_FOLDER'], f"{upload_id}_{filename}")
+    upload_dir = os.path.join(CHUNK_FOLDER, upload_id)
     
-    # Assemble file from chunks
-    with open(file_path, 'wb') as output_file:
-        for i in range(upload_info['total_chunks']):
-            chunk_path = os.path.join(upload_info['upload_dir'], f'chunk_{i}')
-            if os.path.exists(chunk_path):
-                with open(chunk_path, 'rb') as chunk_file:
-                    output_file.write(chunk_file.read())
+    filename = chunked_upload.filename
+    file_type = filename.split('.')[-1] if '.' in filename else ''
+    
+    if chunked_upload.blob_digest:
+        # An interrupted run stored the data and holds a reference on its blob already
+        blob = db.session.get(Blob, chunked_upload.blob_digest)
+        file_size = chunked_upload.total_size
+    else:
+        if chunked_upload.multipart_id:
+            # The store joins the parts; an interrupted run may have done so already
+            file_path = chunked_upload.target_path
+            storage = storage_for(file_path)
+            if not storage.exists(file_path):
+                parts = storage.uploaded_parts(file_path, chunked_upload.multipart_id)
+                missing = [i for i in range(chunked_upload.total_chunks) if i + 1 not in parts]
+                if missing:
+                    unmark_chunks(upload_id, missing)
+                    return {'missing_chunks': missing}
+                report_progress(job_id, 0, 0, 'Joining parts')
+                storage.complete_multipart(file_path, chunked_upload.multipart_id, parts)
+            digest = None
+        elif chunked_upload.target_path:
+            # Every chunk is already in place, the preallocated file is the result
+            file_path = chunked_upload.target_path
+            digest = None
+        else:
+            # Every chunk must be present; never commit a file with holes in it
+            missing = [i for i in range(chunked_upload.total_chunks)
+                       if not os.path.exists(os.path.join(upload_dir, f'chunk_{i}'))]
+            if missing:
+                unmark_chunks(upload_id, missing)
+                return {'missing_chunks': missing}
+            
+            # Assemble file from chunks, hashing the whole file on the way
+            file_path = os.path.join(app.config['UPLOAD_FOLDER'], f"{upload_id}_{filename}")
+            sha256 = hashlib.sha256()
+            report_progress(job_id, 0, chunked_upload.total_chunks, 'Assembling chunks')
+            reported = time.monotonic()
+            with open(file_path, 'wb') as output_file:
+                for i in range(chunked_upload.total_chunks):
+                    chunk_path = os.path.join(upload_dir, f'chunk_{i}')
+                    with open(chunk_path, 'rb') as chunk_file:
+                        for buf in iter(lambda: chunk_file.read(1024 * 1024), b''):
+                            sha256.update(buf)
+                            output_file.write(buf)
+                    if time.monotonic() - reported >= 1:
+                        report_progress(job_id, i + 1)
+                        reported = time.monotonic()
+            report_progress(job_id, chunked_upload.total_chunks)
+            digest = sha256_digest(sha256.hexdigest())
+        file_size = chunked_upload.total_size
+        
+        if digest is None:
+            # Data written in place is stored under the digest of its chunks, verified
+            # as they arrived, so finishing doesn't read it again; a job re-keys it by
+            # its SHA-256 afterwards. Uploads started before chunk digests were
+            # recorded are hashed now.
+            if chunked_upload.has_all_digests():
+                digest = chunked_upload.chunk_tree_digest()
+            else:
+                report_progress(job_id, 0, 0, 'Computing checksum')
+                digest = hash_location(file_path, file_size)
+        
+        # Move the data into the blob store, or drop it if the contents already exist.
+        # The upload records the reference it takes, in the commit that takes it, so
+        # a retry doesn't take a second one.
+        chunked_upload.blob_digest = digest
+        blob = store_blob(file_path, digest, file_size, file_type)
     
     # Create file record in database
-    folder_id = upload_info['folder_id']
-    file_size = os.path.getsize(file_path)
-    file_type = filename.split('.')[-1] if '.' in filename else ''
+    folder_id = chunked_upload.folder_id
     
     new_file = File(
         name=filename,
-        path=file_path,
+        path=blob.path,
         size=file_size,
         file_type=file_type,
         folder_id=folder_id,
-        user_id=current_user.id
+        user_id=chunked_upload.user_id,
+        checksum=blob.digest,
+        compressed=blob.compressed,
+        stored_size=blob.stored_size,
+        chunk_digest=chunked_upload.chunk_tree_digest() if chunked_upload.has_all_digests() else None
     )
     db.session.add(new_file)
+    db.session.flush()
+    Folder.add_to_totals(folder_id, file_size, 1)
+    queue_thumbnail(new_file)
+    
+    chunked_upload.status = 'complete'
+    chunked_upload.file_id = new_file.id
+    chunked_upload.target_path = None
+    chunked_upload.blob_digest = None  # The File holds the reference now
     db.session.commit()
     
     # Clean up chunks
-    shutil.rmtree(upload_info['upload_dir'], ignore_errors=True)
+    if os.path.exists(upload_dir):
+        shutil.rmtree(upload_dir, ignore_errors=True)
     
-    # Remove upload info from session
-    del session['chunked_uploads'][upload_id]
+    if is_chunk_tree_digest(blob.digest):
+        enqueue_job('rekey_blob', chunked_upload.user_id, {'digest': blob.digest})
     
-    return jsonify({
-        'success': True,
-        'message': 'File upload complete',
-        'file_id': new_file.id,
-        'file_name': new_file.name,
-        'file_size': format_file_size(new_file.size)
-    })
+    assembly_duration.observe(time.perf_counter() - started)
+    assembly_bytes.inc(file_size)
+    return assembled_file_details(new_file)
+
+@job_handler('rekey_blob')
+def rekey_blob_job(job_id, params):
+    """Background job keying an assembled upload's blob by the SHA-256 of its contents, so it deduplicates"""
+    rekeyed = rekey_blob(params['digest'])
+    if not rekeyed:
+        return {'files': 0}
+    # The old blob is left to the sweeper, which gives readers of its path time to finish
+    digest, switched = rekeyed
+    return {'digest': digest, 'files': switched}
+
+def assembled_file_details(file):
+    return {
+        'file_id': file.id,
+        'file_name': file.name,
+        'file_size': format_file_size(file.size),
+        'checksum': file.checksum
+    }
 
 @app.route('/mobile_upload/<int:user_id>', methods=['GET', 'POST'])
 def mobile_upload(user_id):
@@ -525,32 +1334,71 @@ def mobile_upload(user_id):
         if not root_folder:
             return "Error: Root folder not found", 400
         
+        # Refuse bodies that could not be stored before reading them; one sent without
+        # a length (chunked transfer encoding) can't be checked, so it is refused too
+        if request.content_length is None:
+            return jsonify({
+                'success': False,
+                'message': 'Content-Length required'
+            }), 411
+        error = quota_error(user_id, request.content_length)
+        if error:
+            return jsonify({
+                'success': False,
+                'message': error
+            }), 413
+        error = disk_space_error(request.content_length)
+        if error:
+            return jsonify({
+                'success': False,
+                'message': error
+            }), 507
+        
+        # Files are streamed to disk while the body is parsed; a body cut short is malformed
+        try:
+            fields, files = stream_uploaded_files()
+        except ValueError:
+            return jsonify({
+                'success': False,
+                'message': 'Malformed upload body'
+            }), 400
+        auto_backup = (fields.get('auto_backup') or [''])[0] == 'true'
+        
         # Check if the post request has the file part
-        if 'file' not in request.files:
+        if not files:
             return "No file part", 400
         
-        files = request.files.getlist('file')
-        auto_backup = request.form.get('auto_backup') == 'true'
+        # Other uploads may have used up the quota while this one was sent
+        User.query.filter_by(id=user_id).with_for_update().one()
+        error = quota_error(user_id, sum(uploaded['size'] for uploaded in files))
+        if error:
+            discard_uploaded_files(files)
+            return jsonify({
+                'success': False,
+                'message': error
+            }), 413
         
         uploaded_files = []
-        for file in files:
-            if file.filename == '':
-                continue
-            
-            filename = secure_filename(file.filename)
-            file_path = os.path.join(app.config['UPLOAD_FOLDER'], str(uuid.uuid4()) + "_" + filename)
-            file.save(file_path)
+        for uploaded in files:
+            filename = secure_filename(uploaded['filename'])
+            file_type = filename.split('.')[-1] if '.' in filename else ''
+            blob = store_blob(uploaded['path'], sha256_digest(uploaded['sha256']), uploaded['size'], file_type)
             
             # Create file record in database
             new_file = File(
                 name=filename,
-                path=file_path,
-                size=os.path.getsize(file_path),
-                file_type=filename.split('.')[-1] if '.' in filename else '',
+                path=blob.path,
+                size=uploaded['size'],
+                file_type=file_type,
                 folder_id=root_folder.id,
-                user_id=user_id
+                user_id=user_id,
+                checksum=blob.digest,
+                compressed=blob.compressed,
+                stored_size=blob.stored_size
             )
             db.session.add(new_file)
+            Folder.add_to_totals(root_folder.id, uploaded['size'], 1)
+            queue_thumbnail(new_file)
             uploaded_files.append(filename)
         
         db.session.commit()
@@ -571,6 +1419,40 @@ def mobile_upload(user_id):
     # GET request - show upload form
     return render_template('mobile_upload.html', user_id=user_id)
 
+@app.route('/mobile_upload/<int:user_id>/known', methods=['POST'])
+def mobile_upload_known(user_id):
+    """Link announced files whose contents the user already stored, so they need not be sent"""
+    # Which checksums match tells what the user stores, so only the signed-in user may ask;
+    # the page falls back to sending every file
+    if not current_user.is_authenticated or current_user.id != user_id:
+        abort(404)
+    
+    root_folder = Folder.query.filter_by(user_id=user_id, parent_id=None).first()
+    if not root_folder:
+        return "Error: Root folder not found", 400
+    
+    data = request.get_json(silent=True) or {}
+    linked = []
+    for entry in data.get('files', []):
+        checksum = entry.get('checksum')
+        filename = entry.get('name') or ''
+        if not checksum or not secure_filename(filename) or not user_has_blob(user_id, checksum):
+            continue
+        # A linked file counts towards the quota like a sent one; files that don't fit
+        # are left for the upload, which reports the error. Concurrent requests by the
+        # same user wait on the lock, so they can't both take the last of the quota.
+        User.query.filter_by(id=user_id).with_for_update().one()
+        blob = db.session.get(Blob, checksum)
+        if not blob or quota_error(user_id, blob.size):
+            continue
+        if link_existing_blob(checksum, filename, root_folder.id, user_id):
+            linked.append(entry.get('index'))
+    
+    return jsonify({
+        'success': True,
+        'linked': linked
+    })
+
 @app.route('/download/<int:file_id>')
 @login_required
 def download_file(file_id):
@@ -589,10 +1471,190 @@ def download_file(file_id):
         flash('This file is in a locked folder. Please unlock the folder first to download its contents.')
         return redirect(url_for('view_folder', folder_id=file.folder_id))
     
-    # Return the file for download
-    directory = os.path.dirname(file.path)
-    filename = os.path.basename(file.path)
-    return send_from_directory(directory, filename, as_attachment=True, download_name=file.name)
+    if file.encrypted and not file.owner.key_hash:
+        flash('This file is encrypted and its key is no longer available.')
+        return redirect(url_for('view_folder', folder_id=file.folder_id))
+    
+    length, read_range = file_reader(file)
+    
+    etag = file_etag(file, length)
+    last_modified = file.updated_at or file.created_at
+    
+    # A Range only applies if the client's copy is still current (If-Range)
+    ranges = None
+    if request.headers.get('Range') and if_range_matches(etag, last_modified):
+        ranges = parse_byte_ranges(request.headers['Range'], length)
+    
+    sent = length if ranges is None else sum(stop - start for start, stop in ranges)
+    
+    # Only data stored as is can be sent by something other than this process
+    if not file.encrypted and not file.compressed:
+        offloaded = offload_download(file.path, file.name)
+        if offloaded:
+            download_bytes.inc(sent, 'offload')
+            return offloaded
+        
+        if ranges is None:
+            # Return the file for download
+            directory = os.path.dirname(file.path)
+            filename = os.path.basename(file.path)
+            response = send_from_directory(directory, filename, as_attachment=True, download_name=file.name,
+                                           etag=etag, last_modified=last_modified)
+            response.headers['Accept-Ranges'] = 'bytes'
+            download_bytes.inc(sent, 'sendfile')
+            return response
+        
+        if len(ranges) == 1 and 'wsgi.file_wrapper' in request.environ:
+            # A single range can still go out with sendfile: the server starts at the
+            # file's offset and stops at Content-Length, or where the reader ends
+            download_bytes.inc(sent, 'sendfile')
+            return send_byte_ranges(partial(wrap_file_range, file.path), length, ranges, etag, last_modified, file.name)
+    
+    download_bytes.inc(sent, 'stream')
+    return send_byte_ranges(read_range, length, ranges, etag, last_modified, file.name)
+
+def offload_download(path, download_name):
+    """
+    Hand the transfer of a stored file to the object store holding it, or to the
+    front web server per DOWNLOAD_OFFLOAD
+    :return: a redirect or an empty response telling the server which file to send,
+             or None if this process has to send it
+    """
+    storage = storage_for(path)
+    if not storage.is_local:
+        # Clients fetch it from the object store directly, ranges included
+        return redirect(storage.download_url(path, download_name))
+    
+    mode = app.config['DOWNLOAD_OFFLOAD']
+    if mode == 'sendfile':
+        return None
+    
+    path = os.path.realpath(path)
+    if mode == 'x-sendfile':
+        header, location = 'X-Sendfile', path
+    elif mode == 'x-accel-redirect':
+        header, location = 'X-Accel-Redirect', None
+        for directory, prefix in app.config['X_ACCEL_LOCATIONS'].items():
+            directory = os.path.realpath(directory)
+            if os.path.commonpath([directory, path]) == directory:
+                location = quote(prefix.rstrip('/') + '/' + os.path.relpath(path, directory).replace(os.sep, '/'))
+                break
+        if location is None:
+            logging.warning(f"No X-Accel-Redirect location for {path}, sending it directly")
+            return None
+    else:
+        raise ValueError(f"Unknown DOWNLOAD_OFFLOAD mode: {mode}")
+    
+    # The server fills in the length, validators and any Range handling itself
+    mimetype = mimetypes.guess_type(download_name)[0] or 'application/octet-stream'
+    return Response(status=200, mimetype=mimetype, headers={
+        header: location,
+        'Content-Disposition': f"attachment; filename*=UTF-8''{quote(download_name)}"
+    })
+
+def wrap_file_range(path, start, stop):
+    """Body for bytes [start, stop) of a file, through the server's wsgi.file_wrapper"""
+    f = open(path, 'rb')
+    f.seek(start)
+    # Servers that don't stop at Content-Length read the file through the bound
+    return request.environ['wsgi.file_wrapper'](FileRange(f, stop - start), 1024 * 1024)
+
+def file_reader(file, buffer_size=1024 * 1024):
+    """
+    Give access to a stored file's contents
+    :return: (length, read_range) where read_range(start, stop) yields the bytes in
+             [start, stop); encrypted files only have the overlapping segments decrypted
+    """
+    path = file.path
+    
+    if file.encrypted:
+        key = bytes.fromhex(file.owner.key_hash)
+        with open(path, 'rb') as f:
+            length = decrypted_size(f)
+        
+        def read_range(start, stop):
+            with open(path, 'rb') as f:
+                yield from decrypt_stream(f, key, start, stop)
+    elif file.compressed:
+        storage = storage_for(path)
+        length = file.size
+        
+        def read_range(start, stop):
+            return decompress_stream(partial(storage.read_at, path), file.stored_size, start, stop)
+    else:
+        storage = storage_for(path)
+        # The record's size saves a round trip to an object store
+        length = os.path.getsize(path) if storage.is_local else file.size
+        
+        def read_range(start, stop):
+            return storage.read_range(path, start, stop, buffer_size)
+    
+    return length, read_range
+
+def file_etag(file, length):
+    """Strong validator for a stored file, stable across workers"""
+    if file.checksum:
+        return file.checksum.split(':', 1)[1]
+    return f"{file.id}-{length}-{int(os.path.getmtime(file.path))}"
+
+def if_range_matches(etag, last_modified):
+    """Whether a Range request may be honoured given its If-Range precondition"""
+    if_range = request.if_range
+    if if_range.etag:
+        return if_range.etag == etag
+    if if_range.date:
+        return last_modified is not None and if_range.date.replace(tzinfo=None) == last_modified.replace(microsecond=0)
+    return True
+
+def send_byte_ranges(read_range, length, ranges, etag, last_modified, download_name):
+    """
+    Build a download response from a range reader
+    :param read_range: called with (start, stop), returns an iterable of bytes
+    :param length: full length of the file
+    :param ranges: None for the whole file, [] if unsatisfiable, else (start, stop) pairs
+    """
+    mimetype = mimetypes.guess_type(download_name)[0] or 'application/octet-stream'
+    headers = {
+        'Accept-Ranges': 'bytes',
+        'ETag': f'"{etag}"',
+        'Content-Disposition': f"attachment; filename*=UTF-8''{quote(download_name)}"
+    }
+    if last_modified:
+        headers['Last-Modified'] = http_date(last_modified)
+    
+    if ranges is None:
+        headers['Content-Length'] = str(length)
+        return Response(read_range(0, length), 200, headers=headers, mimetype=mimetype, direct_passthrough=True)
+    
+    if not ranges:
+        headers['Content-Range'] = f'bytes */{length}'
+        return Response(status=416, headers=headers)
+    
+    if len(ranges) == 1:
+        start, stop = ranges[0]
+        headers['Content-Range'] = f'bytes {start}-{stop - 1}/{length}'
+        headers['Content-Length'] = str(stop - start)
+        return Response(read_range(start, stop), 206, headers=headers, mimetype=mimetype, direct_passthrough=True)
+    
+    # Several ranges: a multipart/byteranges body, each part read lazily
+    boundary = uuid.uuid4().hex
+    part_headers = [
+        (f'--{boundary}\r\nContent-Type: {mimetype}\r\n'
+         f'Content-Range: bytes {start}-{stop - 1}/{length}\r\n\r\n').encode()
+        for start, stop in ranges
+    ]
+    closing = f'\r\n--{boundary}--\r\n'.encode()
+    
+    def generate():
+        for index, (start, stop) in enumerate(ranges):
+            yield (b'\r\n' if index else b'') + part_headers[index]
+            yield from read_range(start, stop)
+        yield closing
+    
+    headers['Content-Length'] = str(sum(len(h) for h in part_headers) + 2 * (len(ranges) - 1)
+                                    + sum(stop - start for start, stop in ranges) + len(closing))
+    return Response(generate(), 206, headers=headers, direct_passthrough=True,
+                    content_type=f'multipart/byteranges; boundary={boundary}')
 
 @app.route('/delete_file/<int:file_id>', methods=['POST'])
 def delete_file(file_id):
@@ -608,15 +1670,17 @@ def delete_file(file_id):
         return redirect(url_for('index'))
     
     folder_id = file.folder_id
+    checksum, path = file.checksum, file.path
     
-    # Delete the actual file from disk
-    if os.path.exists(file.path):
-        os.remove(file.path)
-    
-    # Delete the database record
+    # Delete the database record; a finished upload's record no longer points at it
+    ChunkedUpload.query.filter_by(file_id=file.id).update({'file_id': None}, synchronize_session=False)
     db.session.delete(file)
+    Folder.add_to_totals(folder_id, -file.size, -1)
     db.session.commit()
     
+    # Delete the actual data, unless other files still share it
+    delete_file_data(checksum, path)
+    
     flash('File deleted successfully.')
     return redirect(url_for('view_folder', folder_id=folder_id))
 
@@ -640,30 +1704,58 @@ def delete_folder(folder_id):
     
     parent_id = folder.parent_id
     
-    # Recursively delete all files and subfolders
-    def delete_folder_recursive(folder_id):
-        # Delete all files in this folder
-        files = File.query.filter_by(folder_id=folder_id).all()
-        for file in files:
-            if os.path.exists(file.path):
-                os.remove(file.path)
-            db.session.delete(file)
-        
-        # Delete all subfolders
-        subfolders = Folder.query.filter_by(parent_id=folder_id).all()
-        for subfolder in subfolders:
-            delete_folder_recursive(subfolder.id)
-        
-        # Delete this folder
-        folder = Folder.query.get(folder_id)
-        db.session.delete(folder)
-    
-    delete_folder_recursive(folder_id)
+    # Delete all files and subfolders; the whole subtree is selected by one recursive query
+    subtree_ids = Folder.subtree_ids(folder_id)
+    files = db.session.query(File.checksum, File.path, File.size).filter(File.folder_id.in_(subtree_ids)).all()
+    deleted_data = [(file.checksum, file.path) for file in files]
+    
+    # Abandon uploads still in progress into the deleted folders
+    abandoned_uploads = ChunkedUpload.query.filter(ChunkedUpload.folder_id.in_(subtree_ids)).all()
+    abandoned_paths = [path for chunked_upload in abandoned_uploads if not chunked_upload.multipart_id
+                       for path in (chunked_upload.target_path, os.path.join(CHUNK_FOLDER, chunked_upload.id)) if path]
+    abandoned_multipart = [(chunked_upload.target_path, chunked_upload.multipart_id)
+                           for chunked_upload in abandoned_uploads if chunked_upload.multipart_id]
+    ChunkedUpload.query.filter(ChunkedUpload.folder_id.in_(subtree_ids)).delete(synchronize_session=False)
+    
+    File.query.filter(File.folder_id.in_(subtree_ids)).delete(synchronize_session=False)
+    Folder.query.filter(Folder.id.in_(subtree_ids)).delete(synchronize_session=False)
+    Folder.add_to_totals(parent_id, -sum(file.size for file in files), -len(files), direct=False)
     db.session.commit()
     
+    # The records are gone; releasing the stored data touches every file, so it
+    # happens in the background
+    if deleted_data or abandoned_paths or abandoned_multipart:
+        enqueue_job('delete_file_data', user_id, {'files': deleted_data, 'paths': abandoned_paths,
+                                                  'multipart': abandoned_multipart})
+    
     flash('Folder and all its contents deleted successfully.')
     return redirect(url_for('view_folder', folder_id=parent_id))
 
+@job_handler('delete_file_data')
+def delete_file_data_job(job_id, params):
+    """Background job releasing the stored data of deleted files and partial uploads"""
+    files = params['files']
+    done = db.session.get(Job, job_id).progress_done
+    report_progress(job_id, done, len(files))
+    for i in range(done, len(files)):
+        checksum, path = files[i]
+        # The progress is committed together with the blob release, so a
+        # retried job never releases the same file twice
+        Job.query.filter_by(id=job_id).update({'progress_done': i + 1}, synchronize_session=False)
+        delete_file_data(checksum, path)
+        db.session.commit()
+    
+    for path in params['paths']:
+        if os.path.isdir(path):
+            shutil.rmtree(path, ignore_errors=True)
+        elif os.path.exists(path):
+            os.remove(path)
+    for location, multipart_id in params.get('multipart', []):
+        storage = storage_for(location)
+        storage.abort_multipart(location, multipart_id)
+        storage.delete(location)
+    return {'files': len(files)}
+
 @app.route('/file_details/<int:file_id>')
 def file_details(file_id):
     user_id = session.get('user_id')
@@ -680,11 +1772,47 @@ def file_details(file_id):
         'id': file.id,
         'name': file.name,
         'size': file.size,
+        'stored_size': file.stored_size,
         'file_type': file.file_type,
         'created_at': file.created_at.strftime('%Y-%m-%d %H:%M:%S'),
+        'checksum': file.checksum,
         'download_url': url_for('download_file', file_id=file.id)
     })
 
+@app.route('/thumbnail/<int:file_id>')
+@login_required
+def file_thumbnail(file_id):
+    """Small preview of an image file, from the thumbnail cache or rendered on a miss"""
+    file = db.session.get(File, file_id)
+    if not file or file.user_id != current_user.id or not has_thumbnail(file):
+        abort(404)
+    
+    # Previews would show what a locked folder holds
+    if not file.folder.is_visible and not session.get('has_key', False):
+        abort(404)
+    if file.encrypted and not file.owner.key_hash:
+        abort(404)
+    
+    try:
+        path = get_thumbnail(file, timeout=app.config['THUMBNAIL_TIMEOUT'])
+    except TimeoutError:
+        response = jsonify({
+            'success': False,
+            'message': 'Thumbnail is being rendered'
+        })
+        response.status_code = 503
+        response.headers['Retry-After'] = '5'
+        return response
+    if not path:
+        abort(404)
+    
+    response = send_file(path, mimetype='image/webp', etag=os.path.basename(path).split('.')[0],
+                         max_age=app.config['THUMBNAIL_MAX_AGE'])
+    response.cache_control.public = False
+    response.cache_control.private = True
+    response.cache_control.immutable = True
+    return response
+
 @app.route('/download_folder/<int:folder_id>')
 def download_folder(folder_id):
     """Download all files in a folder as a zip archive"""
@@ -704,48 +1832,158 @@ def download_folder(folder_id):
         flash('This folder is locked. Please unlock it first to download its contents.')
         return redirect(url_for('view_folder', folder_id=folder_id))
     
-    # Create a temporary directory to store the folder structure
-    temp_dir = os.path.join(app.config['UPLOAD_FOLDER'], f"temp_{str(uuid.uuid4())}")
-    os.makedirs(temp_dir)
+    # The archive is produced while it is being sent, so memory use doesn't
+    # depend on the folder size
+    entries = folder_archive_entries(folder)
+    
+    def timed(data):
+        # Only archives sent in full are timed
+        started = time.perf_counter()
+        yield from data
+        archive_build_duration.observe(time.perf_counter() - started, 'stream')
+    
+    # Return the zip file as an attachment, streamed entry by entry
+    return Response(
+        timed(stream_zip(entries)),
+        mimetype='application/zip',
+        headers={
+            'Content-Disposition': f"attachment; filename*=UTF-8''{quote(folder.name)}.zip"
+        },
+        direct_passthrough=True
+    )
+
+def folder_archive_entries(folder):
+    """Entries for utils.stream_zip covering a folder's whole subtree, in archive order"""
+    entries = []
+    
+    # One query for the folder tree, one for all of its files
+    subtree = folder.subtree()
+    zip_paths = {}
+    children = {}
+    for subfolder in subtree:
+        children.setdefault(subfolder.parent_id, []).append(subfolder)
+    
+    # Resolve each folder's path inside the archive, preserving folder structure
+    pending = [(folder, folder.name)]
+    while pending:
+        current_folder, zip_path = pending.pop()
+        zip_paths[current_folder.id] = zip_path
+        for subfolder in children.get(current_folder.id, []):
+            pending.append((subfolder, os.path.join(zip_path, subfolder.name)))
+    
+    files = File.query.filter(File.folder_id.in_(Folder.subtree_ids(folder.id))).order_by(File.folder_id, File.id).all()
+    for file in files:
+        if storage_for(file.path).exists(file.path) and not (file.encrypted and not file.owner.key_hash):
+            # Add file to zip with its original name
+            length, read_range = file_reader(file)
+            entries.append((
+                os.path.join(zip_paths[file.folder_id], file.name),
+                length,
+                file.created_at,
+                not is_precompressed(file.file_type),
+                lambda read_range=read_range, length=length: read_range(0, length)
+            ))
+    return entries
+
+@app.route('/api/folder/<int:folder_id>/archive', methods=['POST'])
+@login_required
+def build_folder_archive(folder_id):
+    """Start building a folder's zip archive in the background; download it once the job completes"""
+    folder = db.session.get(Folder, folder_id)
+    if not folder or folder.user_id != current_user.id:
+        return jsonify({
+            'success': False,
+            'message': 'Folder not found'
+        }), 404
     
-    # Create a zip file in memory
-    memory_file = BytesIO()
+    if not folder.is_visible and not session.get('has_key', False):
+        return jsonify({
+            'success': False,
+            'message': 'This folder is locked. Please unlock it first to download its contents.'
+        }), 403
     
-    try:
-        with zipfile.ZipFile(memory_file, 'w', zipfile.ZIP_DEFLATED) as zipf:
-            def add_folder_to_zip(current_folder, zip_path):
-                # Add files in this folder
-                files = File.query.filter_by(folder_id=current_folder.id).all()
-                for file in files:
-                    if os.path.exists(file.path):
-                        # Add file to zip with its original name, preserving folder structure
-                        zipf.write(file.path, os.path.join(zip_path, file.name))
-                
-                # Process subfolders recursively
-                subfolders = Folder.query.filter_by(parent_id=current_folder.id).all()
-                for subfolder in subfolders:
-                    subfolder_path = os.path.join(zip_path, subfolder.name)
-                    add_folder_to_zip(subfolder, subfolder_path)
-            
-            # Start with the requested folder
-            add_folder_to_zip(folder, folder.name)
-        
-        # Reset file position to the beginning
-        memory_file.seek(0)
-        
-        # Return the zip file as an attachment
-        return Response(
-            memory_file.getvalue(),
-            mimetype='application/zip',
-            headers={
-                'Content-Disposition': f'attachment; filename={folder.name}.zip'
-            }
-        )
-    
-    finally:
-        # Clean up the temporary directory
-        if os.path.exists(temp_dir):
-            shutil.rmtree(temp_dir)
+    job = enqueue_job('build_archive', current_user.id, {'folder_id': folder.id})
+    return jsonify({
+        'success': True,
+        'job': job_status(job)
+    }), 202
+
+def archive_path(job_id):
+    return os.path.join(ARCHIVE_FOLDER, f"{job_id}.zip")
+
+@job_handler('build_archive')
+def build_archive_job(job_id, params):
+    """Background job writing a folder's zip archive to ARCHIVE_FOLDER"""
+    started = time.perf_counter()
+    folder = db.session.get(Folder, params['folder_id'])
+    if not folder:
+        raise ValueError('Folder no longer exists')
+    
+    entries = folder_archive_entries(folder)
+    report_progress(job_id, 0, sum(entry[1] for entry in entries), 'Building archive')
+    
+    done = 0
+    reported = time.monotonic()
+    
+    def counted(read_chunks):
+        def read():
+            nonlocal done, reported
+            for chunk in read_chunks():
+                done += len(chunk)
+                if time.monotonic() - reported >= 1:
+                    report_progress(job_id, done)
+                    reported = time.monotonic()
+                yield chunk
+        return read
+    
+    # Written under a temporary name, so a retry after an interruption starts clean
+    path = archive_path(job_id)
+    with open(f"{path}.tmp", 'wb') as f:
+        for data in stream_zip((arcname, size, mtime, compress, counted(read_chunks))
+                               for arcname, size, mtime, compress, read_chunks in entries):
+            f.write(data)
+    os.replace(f"{path}.tmp", path)
+    report_progress(job_id, done)
+    archive_build_duration.observe(time.perf_counter() - started, 'job')
+    return {'filename': f"{folder.name}.zip", 'size': os.path.getsize(path)}
+
+def job_status(job):
+    status = job.to_dict()
+    if job.kind == 'build_archive' and job.status == 'complete':
+        status['download_url'] = url_for('download_archive', job_id=job.id)
+    return status
+
+@app.route('/api/jobs/<job_id>', methods=['GET'])
+@login_required
+def get_job(job_id):
+    """Report a background job's status and progress"""
+    job = db.session.get(Job, job_id)
+    if not job or job.user_id != current_user.id:
+        return jsonify({
+            'success': False,
+            'message': 'Job not found'
+        }), 404
+    
+    return jsonify({
+        'success': True,
+        'job': job_status(job)
+    })
+
+@app.route('/api/jobs/<job_id>/download', methods=['GET'])
+@login_required
+def download_archive(job_id):
+    """Download the archive built by a completed build_archive job"""
+    job = db.session.get(Job, job_id)
+    if (not job or job.user_id != current_user.id or job.kind != 'build_archive'
+            or job.status != 'complete' or not os.path.exists(archive_path(job.id))):
+        abort(404)
+    
+    download_name = json.loads(job.result)['filename']
+    offloaded = offload_download(archive_path(job.id), download_name)
+    if offloaded:
+        return offloaded
+    return send_from_directory(ARCHIVE_FOLDER, os.path.basename(archive_path(job.id)), as_attachment=True,
+                               download_name=download_name)
 
 @app.route('/rename_folder/<int:folder_id>', methods=['POST'])
 def rename_folder(folder_id):
@@ -855,5 +2093,10 @@ def logout():
     flash('You have been logged out successfully.', 'info')
     return redirect(url_for('login'))
 
+# Register the maintenance commands (flask <command>), the storage sweeper and SQL profiling
+import cli
+import sweeper
+import profiling
+
 if __name__ == "__main__":
     app.run(host="0.0.0.0", port=5000, debug=True)
@@ -0,0 +1,110 @@
+"""Measure lock/unlock latency on a large vault.
+
+Seeds a throwaway database with one user owning a deep folder tree, then times
+set_vault_visibility (the bulk UPDATE used by /lock_folder and /unlock_folder)
+and, optionally, the old one-query-per-folder walk for comparison.
+
+    python benchmarks/lock_benchmark.py --folders 100000
+    BENCH_DATABASE_URL=postgresql://... python benchmarks/lock_benchmark.py
+
+Without BENCH_DATABASE_URL a temporary SQLite file is used.
+"""
+import os
+import sys
+import time
+import argparse
+import statistics
+import tempfile
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--folders', type=int, default=100000, help='number of folders in the vault')
+    parser.add_argument('--fanout', type=int, default=10, help='subfolders per folder')
+    parser.add_argument('--runs', type=int, default=5, help='timed lock/unlock pairs')
+    parser.add_argument('--legacy', action='store_true',
+                        help='also time the old recursive walk (one query per folder, slow)')
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+
+    # Keep the app's upload/chunk directories and database out of the repository
+    work_dir = tempfile.mkdtemp(prefix='lock_benchmark_')
+    os.chdir(work_dir)
+    os.environ['DATABASE_URL'] = os.environ.get('BENCH_DATABASE_URL', 'sqlite:///' + os.path.join(work_dir, 'bench.db'))
+    sys.path.insert(0, ROOT_DIR)
+
+    import logging
+    logging.disable(logging.INFO)
+
+    from app import app, db, set_vault_visibility
+    from models import User, Folder
+
+    with app.app_context():
+        db.create_all()
+
+        user = User(username='benchmark', email='benchmark@example.com')
+        user.set_password(os.urandom(8).hex())
+        db.session.add(user)
+        db.session.commit()
+
+        # Seed the tree with executemany inserts; ids are assigned in order, so
+        # folder i's parent is folder (i - 1) // fanout
+        started = time.perf_counter()
+        root = Folder(name='Root', user_id=user.id)
+        db.session.add(root)
+        db.session.flush()
+        ids = [root.id]
+        batch = 10000
+        while len(ids) < args.folders:
+            rows = []
+            # A batch can only reference parents that already have ids
+            stop = min(args.folders, len(ids) + batch, len(ids) * args.fanout + 1)
+            for i in range(len(ids), stop):
+                rows.append({'name': f'Folder {i}', 'user_id': user.id, 'is_visible': True,
+                             'parent_id': ids[(i - 1) // args.fanout]})
+            result = db.session.execute(db.insert(Folder).returning(Folder.id), rows)
+            ids.extend(result.scalars().all())
+        db.session.commit()
+        print(f'Seeded {len(ids)} folders in {time.perf_counter() - started:.1f}s ({db.engine.url.get_backend_name()})')
+
+        def timed(func, *func_args):
+            started = time.perf_counter()
+            func(*func_args)
+            return (time.perf_counter() - started) * 1000
+
+        lock_times = []
+        unlock_times = []
+        for _ in range(args.runs):
+            lock_times.append(timed(set_vault_visibility, user.id, False))
+            unlock_times.append(timed(set_vault_visibility, user.id, True))
+        assert Folder.query.filter_by(is_visible=False).count() == 0
+
+        print(f'bulk lock:   median {statistics.median(lock_times):8.1f} ms  (min {min(lock_times):.1f}, max {max(lock_times):.1f})')
+        print(f'bulk unlock: median {statistics.median(unlock_times):8.1f} ms  (min {min(unlock_times):.1f}, max {max(unlock_times):.1f})')
+
+        if args.legacy:
+            def legacy_walk(folder_id, visible):
+                # The pre-bulk implementation: load and flip every folder one level at a time
+                root_folder = db.session.get(Folder, folder_id)
+                root_folder.is_visible = visible
+
+                def set_folder_visibility(parent_id):
+                    for subfolder in Folder.query.filter_by(parent_id=parent_id).all():
+                        subfolder.is_visible = visible
+                        set_folder_visibility(subfolder.id)
+
+                set_folder_visibility(folder_id)
+                db.session.commit()
+
+            sys.setrecursionlimit(max(sys.getrecursionlimit(), args.folders + 1000))
+            print(f'legacy lock: {timed(legacy_walk, root.id, False):8.1f} ms')
+            set_vault_visibility(user.id, True)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,238 @@
+"""Check that the hot queries are served by indexes.
+
+Seeds a throwaway database with many users, folders and files, exercises the
+busiest pages and API endpoints through the test client while recording every
+SQL statement they run, then EXPLAINs each statement. Exits non-zero if any
+plan reads a whole table instead of using an index, or if a request runs the
+same statement over and over (an N+1 query pattern).
+
+    python benchmarks/query_plans.py
+    BENCH_DATABASE_URL=postgresql://... python benchmarks/query_plans.py --users 500
+
+Without BENCH_DATABASE_URL a temporary SQLite file is used. The same check runs
+in the test suite (tests/test_query_plans.py) on a smaller data set.
+"""
+import os
+import re
+import sys
+import time
+import argparse
+import tempfile
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Full table reads in EXPLAIN output, per backend; group 1 is the table name or alias.
+# SQLite's automatic indexes are built by reading the whole table on every query.
+SEQUENTIAL_SCAN = {
+    'sqlite': re.compile(r'\b(?:SCAN|SEARCH) (\w+)(?! USING (?:COVERING )?INDEX| USING INTEGER PRIMARY KEY)'),
+    'postgresql': re.compile(r'\bSeq Scan on (\w+)'),
+}
+EXPLAIN_PREFIX = {
+    'sqlite': 'EXPLAIN QUERY PLAN ',
+    'postgresql': 'EXPLAIN ',
+}
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--users', type=int, default=200, help='number of users')
+    parser.add_argument('--folders', type=int, default=50, help='folders per user')
+    parser.add_argument('--files', type=int, default=20, help='files per folder')
+    parser.add_argument('--verbose', action='store_true', help='print every plan')
+    return parser.parse_args()
+
+
+def seed(users, folders, files):
+    """Create users with a folder tree each; returns the last user, their root and a leaf folder"""
+    from app import db
+    from models import User, Folder, File
+
+    user_ids = db.session.execute(db.insert(User).returning(User.id), [
+        {'username': f'user{u}', 'email': f'user{u}@example.com', 'password_hash': '-',
+         'key_hash': os.urandom(64).hex()}
+        for u in range(users)
+    ]).scalars().all()
+
+    for user_id in user_ids:
+        root_id = db.session.execute(db.insert(Folder).returning(Folder.id), [
+            {'name': 'Root', 'user_id': user_id, 'is_visible': True}
+        ]).scalar_one()
+        # A tree with three subfolders per folder, so subtree walks have some depth
+        folder_ids = [root_id]
+        for i in range(1, folders):
+            folder_ids.append(db.session.execute(db.insert(Folder).returning(Folder.id), [
+                {'name': f'Folder {i}', 'user_id': user_id, 'is_visible': True,
+                 'parent_id': folder_ids[(i - 1) // 3]}
+            ]).scalar_one())
+        db.session.execute(db.insert(File), [
+            {'name': f'photo_{f}.jpg', 'path': os.path.join('missing', f'{folder_id}_{f}'),
+             'size': (folder_id * 7919 + f * 104729) % 10000000,
+             'stored_size': (folder_id * 7919 + f * 104729) % 10000000, 'file_type': 'jpg',
+             'folder_id': folder_id, 'user_id': user_id, 'checksum': None}
+            for folder_id in folder_ids for f in range(files)
+        ])
+    db.session.commit()
+    # Give the planner statistics for the seeded data
+    db.session.execute(db.text('ANALYZE'))
+    db.session.commit()
+    return user_ids[-1], folder_ids[0], folder_ids[-1]
+
+
+def exercise_hot_paths(user_id, root_id, leaf_id):
+    """
+    Request the busiest pages and API endpoints as a user
+    :return: (statements, suspects) with every (statement, parameters) run, and
+             (request, QueryProfile) for each request that ran a statement in a loop
+    """
+    from sqlalchemy import event
+    from app import app, db
+    from models import User, File
+    from blobs import user_has_blob
+    from profiling import profile_queries
+
+    key = db.session.get(User, user_id).key_hash
+    statements = []
+
+    def record(conn, cursor, statement, parameters, context, executemany):
+        if not executemany and statement.lstrip().upper().startswith(('SELECT', 'WITH', 'UPDATE', 'DELETE')):
+            statements.append((statement, parameters))
+
+    event.listen(db.engine, 'before_cursor_execute', record)
+
+    test_client = app.test_client()
+    with test_client.session_transaction() as sess:
+        sess['_user_id'] = str(user_id)
+        sess['_fresh'] = True
+        sess['user_id'] = user_id
+
+    # Every request is profiled on its own for statements run in a loop
+    suspects = []
+
+    class ProfiledClient:
+        def __getattr__(self, method):
+            def request(url, **kwargs):
+                with profile_queries() as profile:
+                    response = getattr(test_client, method)(url, **kwargs)
+                if profile.repeated():
+                    suspects.append((f'{method.upper()} {url}', profile))
+                return response
+            return request
+
+    client = ProfiledClient()
+
+    try:
+        # The hot paths: dashboard, folder pages, paginated listing in every order,
+        # file details, resumable uploads, key retrieval, lock/unlock, dedupe checks
+        client.get('/')
+        client.get(f'/folder/{leaf_id}')
+        for sort in File.SORT_KEYS:
+            for order in ('asc', 'desc'):
+                page = client.get(f'/api/folder/{root_id}/files',
+                                  query_string={'sort': sort, 'order': order, 'limit': 5}).get_json()
+                client.get(f'/api/folder/{root_id}/files', query_string={'sort': sort, 'order': order, 'limit': 5,
+                                                                          'cursor': page['next_cursor']})
+        file_id = db.session.query(File.id).filter_by(folder_id=leaf_id).first()[0]
+        client.get(f'/file_details/{file_id}')
+        client.get('/api/uploads', query_string={'folder_id': root_id})
+        client.post('/retrieve_folder', data={'key': key})
+        client.post('/lock_folder', data={'key': key})
+        client.post('/unlock_folder', data={'key': key})
+        user_has_blob(user_id, 'sha256:' + '0' * 64)
+        db.session.rollback()
+        client.post(f'/delete_folder/{leaf_id}')
+    finally:
+        event.remove(db.engine, 'before_cursor_execute', record)
+    return statements, suspects
+
+
+def sequential_scans(statements):
+    """
+    EXPLAIN every distinct statement
+    :return: (number of distinct statements, [(statement, plan lines, tables read
+             without an index)] for each of them)
+    """
+    from app import db
+
+    backend = db.engine.url.get_backend_name()
+    if backend not in SEQUENTIAL_SCAN:
+        raise ValueError(f'Unsupported database backend: {backend}')
+    tables = set(db.metadata.tables)
+    pattern = SEQUENTIAL_SCAN[backend]
+    plans = []
+    seen = set()
+    with db.engine.connect() as conn:
+        for statement, parameters in statements:
+            if statement in seen:
+                continue
+            seen.add(statement)
+            plan = [' '.join(str(col) for col in row)
+                    for row in conn.exec_driver_sql(EXPLAIN_PREFIX[backend] + statement, parameters)]
+            # SQLAlchemy aliases a table joined to itself as <table>_1
+            scanned = sorted({re.sub(r'_\d+$', '', name) for line in plan for name in pattern.findall(line)}
+                             & tables)
+            plans.append((statement, plan, scanned))
+            conn.rollback()
+    return len(seen), plans
+
+
+def format_plan(statement, plan, scanned):
+    lines = [' '.join(statement.split())]
+    lines.extend('    ' + line for line in plan)
+    if scanned:
+        lines.append(f'  SEQUENTIAL SCAN on {", ".join(scanned)}')
+    return '\n'.join(lines)
+
+
+def main():
+    args = parse_args()
+
+    # Keep the app's upload/chunk directories and database out of the repository
+    work_dir = tempfile.mkdtemp(prefix='query_plans_')
+    os.chdir(work_dir)
+    os.environ['DATABASE_URL'] = os.environ.get('BENCH_DATABASE_URL', 'sqlite:///' + os.path.join(work_dir, 'bench.db'))
+    # Only the request paths are checked, not the storage sweeper's maintenance queries
+    os.environ['GC_INTERVAL'] = '0'
+    sys.path.insert(0, ROOT_DIR)
+
+    import logging
+    logging.disable(logging.INFO)
+
+    from app import app, db
+
+    app.config['WTF_CSRF_ENABLED'] = False
+
+    with app.app_context():
+        backend = db.engine.url.get_backend_name()
+        if backend not in SEQUENTIAL_SCAN:
+            sys.exit(f'Unsupported database backend: {backend}')
+
+        db.create_all()
+        started = time.perf_counter()
+        user_id, root_id, leaf_id = seed(args.users, args.folders, args.files)
+        print(f'Seeded {args.users} users, {args.users * args.folders} folders, '
+              f'{args.users * args.folders * args.files} files in {time.perf_counter() - started:.1f}s ({backend})')
+
+        statements, suspects = exercise_hot_paths(user_id, root_id, leaf_id)
+        checked, plans = sequential_scans(statements)
+
+        failures = 0
+        for statement, plan, scanned in plans:
+            if scanned:
+                failures += 1
+            if scanned or args.verbose:
+                print('-' * 72)
+                print(format_plan(statement, plan, scanned))
+
+        for url, profile in suspects:
+            print('-' * 72)
+            print(url)
+            print(profile.report())
+
+        print('-' * 72)
+        print(f'{checked} distinct statements checked, {failures} with sequential scans, '
+              f'{len(suspects)} request(s) with N+1 queries')
+        sys.exit(1 if failures or suspects else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,354 @@
+import os
+import time
+import uuid
+import hashlib
+from sqlalchemy.exc import IntegrityError
+from app import app, db
+from models import Blob, File
+from storage import get_storage, storage_for
+from utils import worth_compressing, compress_file, decompress_stream
+
+# Content-addressed storage for uploaded data. Every File with a checksum points
+# at a shared Blob; the blob's data is removed only when the last File goes away.
+# Blobs and older files are spread over a two-level directory fan-out so that no
+# directory grows past a few hundred entries.
+BLOB_FOLDER = os.path.join(app.config['UPLOAD_FOLDER'], "blobs")
+if not os.path.exists(BLOB_FOLDER):
+    os.makedirs(BLOB_FOLDER)
+app.config['BLOB_FOLDER'] = BLOB_FOLDER
+app.config['FILE_FOLDER'] = os.path.join(app.config['UPLOAD_FOLDER'], "files")
+
+def sha256_digest(hexdigest):
+    """Format a SHA-256 hex digest as a blob digest"""
+    return f"sha256:{hexdigest.lower()}"
+
+def is_chunk_tree_digest(digest):
+    """Whether a blob is keyed by the digest of its upload's chunks rather than its contents"""
+    return digest.startswith('sha256-chunks:')
+
+def hash_file(path, buffer_size=1024 * 1024):
+    """Compute the blob digest of a file on disk"""
+    sha256 = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for buf in iter(lambda: f.read(buffer_size), b''):
+            sha256.update(buf)
+    return sha256_digest(sha256.hexdigest())
+
+def shard_dir(root, key):
+    """Directory for an object in a two-level fan-out under root: root/ab/cd for a key 'abcd...'"""
+    return os.path.join(root, key[:2], key[2:4])
+
+def blob_path(digest):
+    """Location of a blob's data on disk"""
+    algorithm, hexdigest = digest.split(':', 1)
+    return os.path.join(shard_dir(app.config['BLOB_FOLDER'], hexdigest), f"{algorithm}_{hexdigest}")
+
+def legacy_file_path(path):
+    """Sharded location for data stored outside the blob store (files kept from before it)"""
+    name = os.path.basename(path)
+    key = hashlib.sha256(name.encode()).hexdigest()
+    return os.path.join(shard_dir(app.config['FILE_FOLDER'], key), name)
+
+def acquire_blob(digest):
+    """Take a reference on an existing blob; returns the Blob or None if unknown"""
+    updated = Blob.query.filter_by(digest=digest).update({
+        'ref_count': Blob.ref_count + 1
+    }, synchronize_session=False)
+    if not updated:
+        return None
+    return db.session.get(Blob, digest, populate_existing=True)
+
+def compress_for_storage(path, size, file_type):
+    """Write a compressed copy of a file about to be stored; returns its path, or None if it isn't worth it"""
+    if not app.config['COMPRESS_AT_REST'] or size < app.config['COMPRESSION_MIN_SIZE']:
+        return None
+    compressed_path = f"{path}.z"
+    with open(path, 'rb') as f:
+        if not worth_compressing(file_type, f.read(64 * 1024)):
+            return None
+        f.seek(0)
+        with open(compressed_path, 'wb') as out:
+            stored_size = compress_file(f, out, app.config['COMPRESSION_LEVEL'])
+    # The sample can be misleading; keep the original unless the whole file shrank too
+    if stored_size > size * 0.9:
+        os.remove(compressed_path)
+        return None
+    return compressed_path
+
+def store_blob(temp_path, digest, size, file_type=None):
+    """
+    Turn freshly written data into a reference on the blob with its contents
+    New data is compressed at rest if its type and contents suggest it is worth it.
+    :param temp_path: local file holding the data, or the location of an object already
+                      in storage (a finished multipart upload); it is moved into the blob
+                      store or deleted
+    :param digest: blob digest of the data
+    :param size: size of the data in bytes
+    :param file_type: extension of the file the data was uploaded as
+    :return: the Blob, with one reference taken for the caller. A reference on an existing
+             blob is left for the caller to commit with the File. A new blob is committed
+             right away, along with whatever else is pending in the session, so a caller
+             that could be retried can record the reference it holds in the same commit.
+    """
+    source = storage_for(temp_path)
+    storage = get_storage()
+    compressed_path = None
+    while True:
+        blob = acquire_blob(digest)
+        if blob:
+            # Already stored, drop the duplicate copy
+            source.delete(temp_path)
+            if compressed_path:
+                os.remove(compressed_path)
+            return blob
+
+        # Only new contents are compressed, and only once
+        if compressed_path is None and source.is_local:
+            compressed_path = compress_for_storage(temp_path, size, file_type) or ''
+        stored_size = os.path.getsize(compressed_path) if compressed_path else size
+
+        # Claim the digest first, then move the data into place
+        blob = Blob(digest=digest, path=storage.blob_location(digest), size=size,
+                    compressed=bool(compressed_path), stored_size=stored_size, ref_count=1)
+        try:
+            # In a savepoint, so losing the race keeps the caller's pending changes
+            with db.session.begin_nested():
+                db.session.add(blob)
+        except IntegrityError:
+            # Another upload stored the same data first, reference that one
+            continue
+        db.session.commit()
+        if compressed_path:
+            os.remove(temp_path)
+            temp_path = compressed_path
+        if source is storage:
+            storage.move(temp_path, blob.path)
+        else:
+            storage.put(temp_path, blob.path)
+        return blob
+
+def release_blob(digest):
+    """Drop a reference on a blob, reclaiming its space when none are left"""
+    Blob.query.filter_by(digest=digest).update({
+        'ref_count': Blob.ref_count - 1
+    }, synchronize_session=False)
+    db.session.commit()
+
+    reclaim_blob(digest)
+
+def reclaim_blob(digest):
+    """Delete a blob nothing references any more; returns the bytes freed"""
+    blob = db.session.get(Blob, digest, populate_existing=True)
+    if not blob or blob.ref_count > 0:
+        return 0
+
+    size, path = blob.stored_size, blob.path
+    storage = storage_for(path)
+    if not storage.is_local:
+        # Every stored copy has its own key, so the row can go first
+        deleted = Blob.query.filter_by(digest=digest, ref_count=0).delete(synchronize_session=False)
+        db.session.commit()
+        if not deleted:
+            return 0
+        storage.delete(path)
+        return size
+
+    # Move the data aside before deleting the row, so an upload that re-creates
+    # the blob right after can never have its data removed by us
+    tombstone = f"{blob.path}.{uuid.uuid4().hex}.deleted"
+    if os.path.exists(blob.path):
+        os.replace(blob.path, tombstone)
+    deleted = Blob.query.filter_by(digest=digest, ref_count=0).delete(synchronize_session=False)
+    db.session.commit()
+
+    if deleted:
+        if os.path.exists(tombstone):
+            os.remove(tombstone)
+            return size
+    elif os.path.exists(tombstone):
+        # Someone took a new reference in the meantime
+        os.replace(tombstone, blob.path)
+    return 0
+
+def delete_file_data(checksum, path):
+    """Remove the stored data of a deleted File record, given its checksum and path.
+    
+    Call this after the File row is gone so the blob row can be deleted too.
+    """
+    if checksum:
+        release_blob(checksum)
+    else:
+        storage_for(path).delete(path)
+
+def user_has_blob(user_id, digest):
+    """Whether the user already owns a file with these contents"""
+    return db.session.query(File.id).filter_by(user_id=user_id, checksum=digest).first() is not None
+
+def relink(old_path, new_path):
+    """Give a file a second name at new_path; the old name keeps working until it is removed"""
+    os.makedirs(os.path.dirname(new_path), exist_ok=True)
+    try:
+        os.link(old_path, new_path)
+    except FileExistsError:
+        pass
+
+def migrate_layout(batch_size=500, grace=5, on_batch=None):
+    """
+    Move blobs and older files into the sharded layout, a batch at a time, while the app runs
+    Each file is hard-linked at its new path, the records are switched over, and the
+    old name is removed only after a grace period, so requests that read the old path
+    just before the switch still find the file. Safe to interrupt and run again.
+    :param on_batch: called with (moved, total moved so far) after each batch
+    :return: the number of files moved
+    """
+    total = 0
+
+    def finish(moves):
+        nonlocal total
+        time.sleep(grace)
+        for old_path, new_path in moves:
+            # Catch records written from the old path while we waited
+            File.query.filter_by(path=old_path).update({'path': new_path}, synchronize_session=False)
+            db.session.commit()
+            if os.path.exists(new_path) and os.path.exists(old_path):
+                os.remove(old_path)
+        total += len(moves)
+        if on_batch:
+            on_batch(len(moves), total)
+
+    # Blobs, in digest order
+    last = ''
+    while True:
+        blobs = db.session.query(Blob.digest, Blob.path).filter(Blob.digest > last).order_by(Blob.digest).limit(batch_size).all()
+        if not blobs:
+            break
+        last = blobs[-1].digest
+        moves = []
+        for digest, old_path in blobs:
+            new_path = blob_path(digest)
+            if old_path == new_path or not storage_for(old_path).is_local or not os.path.exists(old_path):
+                continue
+            relink(old_path, new_path)
+            switched = Blob.query.filter_by(digest=digest, path=old_path).update({'path': new_path}, synchronize_session=False)
+            File.query.filter_by(path=old_path).update({'path': new_path}, synchronize_session=False)
+            db.session.commit()
+            # If the blob was released meanwhile, the new name is left for the sweeper
+            if switched:
+                moves.append((old_path, new_path))
+        if moves:
+            finish(moves)
+
+    # Files kept outside the blob store, in id order
+    last = 0
+    while True:
+        files = (db.session.query(File.id, File.path).filter(File.checksum.is_(None), File.id > last)
+                 .order_by(File.id).limit(batch_size).all())
+        if not files:
+            break
+        last = files[-1].id
+        moves = []
+        for file_id, old_path in files:
+            new_path = legacy_file_path(old_path)
+            if old_path == new_path or not os.path.exists(old_path):
+                continue
+            relink(old_path, new_path)
+            File.query.filter_by(id=file_id, path=old_path).update({'path': new_path}, synchronize_session=False)
+            db.session.commit()
+            moves.append((old_path, new_path))
+        if moves:
+            finish(moves)
+
+    return total
+
+def read_blob(blob, buffer_size=1024 * 1024):
+    """Yield a blob's contents, decompressed"""
+    storage = storage_for(blob.path)
+    if blob.compressed:
+        return decompress_stream(lambda offset, length: storage.read_at(blob.path, offset, length), blob.stored_size)
+    return storage.read_range(blob.path, 0, blob.size, buffer_size)
+
+def hash_location(location, size, buffer_size=1024 * 1024):
+    """Compute the blob digest of stored data, wherever it is"""
+    sha256 = hashlib.sha256()
+    for buf in storage_for(location).read_range(location, 0, size, buffer_size):
+        sha256.update(buf)
+    return sha256_digest(sha256.hexdigest())
+
+def rekey_blob(old):
+    """
+    Key a blob stored under the digest of its upload's chunks by the SHA-256 of its contents
+    That digest depends on the chunk size, so it never matches the same contents uploaded
+    another way. The blob is hashed, given a copy under its new key (or merged into a blob
+    that already has its contents), and its files are switched over with the old digest
+    kept as their chunk_digest. The old blob is left without references, for the caller
+    or the sweeper to reclaim once nobody reads its old path any more.
+    :return: (new digest, files switched), or None if the blob is gone
+    """
+    blob = db.session.get(Blob, old, populate_existing=True)
+    if not blob:
+        return None
+    sha256 = hashlib.sha256()
+    for buf in read_blob(blob):
+        sha256.update(buf)
+    new = sha256_digest(sha256.hexdigest())
+
+    while True:
+        target = db.session.get(Blob, new, populate_existing=True)
+        if target is None:
+            # The data is copied as it is stored, compressed or not, next to the old copy
+            storage = storage_for(blob.path)
+            location = storage.blob_location(new)
+            storage.copy(blob.path, location)
+            target = Blob(digest=new, path=location, size=blob.size, compressed=blob.compressed,
+                          stored_size=blob.stored_size, ref_count=0)
+            try:
+                with db.session.begin_nested():
+                    db.session.add(target)
+            except IntegrityError:
+                # Stored by an upload meanwhile, merge into that one
+                if not storage.is_local:
+                    storage.delete(location)
+                continue
+        break
+
+    switched = File.query.filter_by(checksum=old).update({
+        'checksum': new, 'chunk_digest': old, 'path': target.path,
+        'compressed': target.compressed, 'stored_size': target.stored_size
+    }, synchronize_session=False)
+    Blob.query.filter_by(digest=new).update({'ref_count': Blob.ref_count + switched}, synchronize_session=False)
+    Blob.query.filter_by(digest=old).update({'ref_count': Blob.ref_count - switched}, synchronize_session=False)
+    db.session.commit()
+    return new, switched
+
+def rekey_chunked_blobs(grace=5, on_blob=None):
+    """
+    Key every blob still stored under the digest of its upload's chunks by the SHA-256
+    of its contents (see rekey_blob). The old data is released after a grace period,
+    so requests that read the old path just before the switch still find it. Safe to
+    interrupt and run again.
+    :param on_blob: called with (old digest, new digest, files switched) for each blob
+    :return: the number of files switched
+    """
+    total = 0
+    old_digests = []
+    last = ''
+    while True:
+        old = (db.session.query(Blob.digest).filter(Blob.digest.startswith('sha256-chunks:'), Blob.digest > last)
+               .order_by(Blob.digest).limit(1).scalar())
+        if not old:
+            break
+        last = old
+        rekeyed = rekey_blob(old)
+        if not rekeyed:
+            continue
+        new, switched = rekeyed
+        old_digests.append(old)
+        total += switched
+        if on_blob:
+            on_blob(old, new, switched)
+
+    if old_digests:
+        time.sleep(grace)
+        for digest in old_digests:
+            reclaim_blob(digest)
+    return total
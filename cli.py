@@ -0,0 +1,39 @@
+import click
+from app import app
+from models import Folder
+
+@app.cli.command('rebuild-folder-totals')
+def rebuild_folder_totals():
+    """Recompute every folder's size and file-count totals from the file table"""
+    fixed = Folder.rebuild_totals()
+    click.echo(f'Rebuilt folder totals, {fixed} folder(s) were out of date')
+
+@app.cli.command('sweep-storage')
+def sweep_storage():
+    """Expire abandoned uploads, old archives and jobs, and delete orphaned data"""
+    from sweeper import sweep
+    from utils import format_file_size
+    result = sweep()
+    click.echo(f"Expired {result['uploads']} upload(s), {result['archives']} archive(s) and {result['jobs']} job(s), "
+               f"removed {result['orphans']} orphaned item(s); reclaimed {format_file_size(result['reclaimed_bytes'])}"
+               + (' (under disk pressure)' if result['disk_pressure'] else ''))
+
+@app.cli.command('migrate-storage-layout')
+@click.option('--batch-size', default=500, show_default=True, help='Files moved per batch')
+@click.option('--grace', default=5.0, show_default=True,
+              help='Seconds old paths stay valid after a batch is switched over')
+def migrate_storage_layout(batch_size, grace):
+    """Move stored data into the sharded directory layout while the app keeps running"""
+    from blobs import migrate_layout
+    moved = migrate_layout(batch_size, grace,
+                           on_batch=lambda count, total: click.echo(f'Moved {count} file(s), {total} so far'))
+    click.echo(f'Storage layout up to date, {moved} file(s) moved')
+
+@app.cli.command('rekey-chunked-blobs')
+@click.option('--grace', default=5.0, show_default=True,
+              help='Seconds old blob paths stay valid after their files are switched over')
+def rekey_chunked_blobs(grace):
+    """Key blobs of older chunked uploads by the SHA-256 of their contents, so they deduplicate"""
+    from blobs import rekey_chunked_blobs
+    switched = rekey_chunked_blobs(grace, on_blob=lambda old, new, count: click.echo(f'{old} -> {new}, {count} file(s)'))
+    click.echo(f'Chunked upload blobs re-keyed, {switched} file(s) switched over')
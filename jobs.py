@@ -0,0 +1,169 @@
+import os
+import json
+import time
+import uuid
+import socket
+import logging
+import threading
+from datetime import datetime, timedelta
+from concurrent.futures import ThreadPoolExecutor
+from app import app, db
+from models import Job
+
+# Background jobs run on a thread pool in every web worker. The job table is the
+# queue: a job is claimed with a compare-and-swap on its status, so it runs once
+# however many workers see it, and jobs left behind by a worker that stopped are
+# picked up again by the others once its heartbeats stop.
+WORKER_ID = f"{socket.gethostname()}:{os.getpid()}"
+
+_handlers = {}
+_executor = None
+_started_lock = threading.Lock()
+_submitted = set()  # Jobs queued on this worker's pool
+_running = set()  # Jobs this worker is running, kept alive by heartbeats
+_state_lock = threading.Lock()
+
+def job_handler(kind):
+    """
+    Register a function as the handler for a kind of job
+    The handler is called as handler(job_id, params) inside an app context and
+    returns a JSON-serialisable result. It should be safe to run again after an
+    interruption, since a job whose worker stopped is retried.
+    """
+    def register(func):
+        _handlers[kind] = func
+        return func
+    return register
+
+def enqueue_job(kind, user_id, params):
+    """Persist a job and hand it to the pool; returns the Job"""
+    job = Job(id=str(uuid.uuid4()), kind=kind, user_id=user_id, params=json.dumps(params),
+              status='queued', progress_done=0, progress_total=0, attempts=0)
+    db.session.add(job)
+    db.session.commit()
+
+    if app.config['JOB_WORKERS'] == 0:
+        # No pool: run in the calling thread
+        run_job(job.id)
+        db.session.refresh(job)
+    else:
+        start_job_runner()
+        _submit(job.id)
+    return job
+
+def report_progress(job_id, done, total=None, message=None):
+    """Record how far a job has come; call it from handlers as they work"""
+    values = {'progress_done': done, 'heartbeat_at': datetime.utcnow()}
+    if total is not None:
+        values['progress_total'] = total
+    if message is not None:
+        values['message'] = message
+    Job.query.filter_by(id=job_id).update(values, synchronize_session=False)
+    db.session.commit()
+
+def claim_job(job_id):
+    """Move a job from 'queued' to 'running' on this worker; only one caller wins"""
+    now = datetime.utcnow()
+    claimed = Job.query.filter_by(id=job_id, status='queued').update({
+        'status': 'running',
+        'worker': WORKER_ID,
+        'attempts': Job.attempts + 1,
+        'heartbeat_at': now
+    }, synchronize_session=False)
+    db.session.commit()
+    return claimed == 1
+
+def finish_job(job_id, status, result=None, message=None):
+    Job.query.filter_by(id=job_id, worker=WORKER_ID).update({
+        'status': status,
+        'result': json.dumps(result) if result is not None else None,
+        'message': message,
+        'heartbeat_at': datetime.utcnow()
+    }, synchronize_session=False)
+    db.session.commit()
+
+def run_job(job_id):
+    """Claim and run a job, recording its outcome"""
+    if not claim_job(job_id):
+        return
+
+    with _state_lock:
+        _running.add(job_id)
+    try:
+        job = db.session.get(Job, job_id)
+        handler = _handlers.get(job.kind)
+        if not handler:
+            finish_job(job_id, 'failed', message=f'Unknown job kind: {job.kind}')
+            return
+        try:
+            result = handler(job_id, json.loads(job.params))
+        except Exception as e:
+            logging.exception(f"Job {job_id} ({job.kind}) failed")
+            db.session.rollback()
+            finish_job(job_id, 'failed', message=str(e)[:255])
+        else:
+            finish_job(job_id, 'complete', result=result)
+    finally:
+        with _state_lock:
+            _running.discard(job_id)
+
+def _run_in_context(job_id):
+    try:
+        with app.app_context():
+            run_job(job_id)
+    except Exception:
+        logging.exception(f"Could not run job {job_id}")
+    finally:
+        with _state_lock:
+            _submitted.discard(job_id)
+
+def _submit(job_id):
+    with _state_lock:
+        if job_id in _submitted:
+            return
+        _submitted.add(job_id)
+    _executor.submit(_run_in_context, job_id)
+
+def recover_jobs():
+    """Heartbeat this worker's jobs, requeue those of workers that went away, and pick up queued ones"""
+    now = datetime.utcnow()
+    with _state_lock:
+        running = list(_running)
+    if running:
+        Job.query.filter(Job.id.in_(running)).update({'heartbeat_at': now}, synchronize_session=False)
+
+    stale = now - timedelta(seconds=app.config['JOB_STALE_AFTER'])
+    abandoned = Job.query.filter(Job.status == 'running', Job.heartbeat_at < stale)
+    abandoned.filter(Job.attempts < app.config['JOB_MAX_ATTEMPTS']).update({
+        'status': 'queued',
+        'worker': None
+    }, synchronize_session=False)
+    abandoned.update({
+        'status': 'failed',
+        'message': 'Stopped repeatedly before finishing'
+    }, synchronize_session=False)
+    db.session.commit()
+
+    queued = db.session.query(Job.id).filter_by(status='queued').order_by(Job.created_at).limit(100).all()
+    for (job_id,) in queued:
+        _submit(job_id)
+
+def _poll_jobs():
+    while True:
+        try:
+            with app.app_context():
+                recover_jobs()
+        except Exception:
+            logging.exception("Job recovery failed")
+        time.sleep(app.config['JOB_POLL_INTERVAL'])
+
+def start_job_runner():
+    """Start this worker's job pool and recovery loop, once"""
+    global _executor
+    if _executor is not None or app.config['JOB_WORKERS'] == 0:
+        return
+    with _started_lock:
+        if _executor is not None:
+            return
+        _executor = ThreadPoolExecutor(max_workers=app.config['JOB_WORKERS'], thread_name_prefix='job')
+        threading.Thread(target=_poll_jobs, name='job-recovery', daemon=True).start()
@@ -0,0 +1,231 @@
+import os
+import hmac
+import json
+import time
+import bisect
+import socket
+import logging
+import threading
+from flask import g, request, Response, abort
+from app import app, db
+from models import ChunkedUpload, Job
+
+# Prometheus metrics, exposed at /metrics in the text exposition format.
+# Recording a value only updates a few numbers in memory; the text is built when
+# the endpoint is scraped. Each web worker keeps its own values and writes them to
+# METRICS_FOLDER every METRICS_FLUSH_INTERVAL seconds while it handles requests,
+# and a scrape adds up those of all workers on the host, so it doesn't matter
+# which worker answers it. Values that live in the database (active uploads, job
+# queue) are read at scrape time.
+
+_metrics = []
+_lock = threading.Lock()
+_dirty = False
+_flushed = 0
+SNAPSHOT_NAME = f"{socket.gethostname()}-{os.getpid()}.json"
+
+# Seconds, from a fast page to a slow archive build
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300)
+
+class Counter:
+    """A total that only goes up, e.g. bytes served"""
+    kind = 'counter'
+
+    def __init__(self, name, documentation, labels=()):
+        self.name = name
+        self.documentation = documentation
+        self.labels = labels
+        self.values = {}
+        _metrics.append(self)
+
+    def inc(self, amount=1, *label_values):
+        global _dirty
+        with _lock:
+            self.values[label_values] = self.values.get(label_values, 0) + amount
+            _dirty = True
+
+    def snapshot(self):
+        return [[list(labels), value] for labels, value in self.values.items()]
+
+class Histogram:
+    """Observations counted into buckets, e.g. request durations"""
+    kind = 'histogram'
+
+    def __init__(self, name, documentation, labels=(), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labels = labels
+        self.buckets = tuple(buckets)
+        self.values = {}  # label values: [count per bucket, then above the last one], sum
+        _metrics.append(self)
+
+    def observe(self, value, *label_values):
+        global _dirty
+        index = bisect.bisect_left(self.buckets, value)
+        with _lock:
+            counts_sum = self.values.get(label_values)
+            if counts_sum is None:
+                counts_sum = self.values[label_values] = [[0] * (len(self.buckets) + 1), 0]
+            counts_sum[0][index] += 1
+            counts_sum[1] += value
+            _dirty = True
+
+    def snapshot(self):
+        return [[list(labels), list(counts), total] for labels, (counts, total) in self.values.items()]
+
+request_duration = Histogram('filelock_request_duration_seconds',
+                             'Time until a response starts, per route', ('endpoint', 'method'))
+chunk_receive_duration = Histogram('filelock_chunk_receive_seconds',
+                                   'Time to receive, verify and store one upload chunk')
+chunk_bytes = Counter('filelock_chunk_bytes_total', 'Bytes of upload chunks stored')
+assembly_duration = Histogram('filelock_assembly_seconds', 'Time to assemble a chunked upload into a file')
+assembly_bytes = Counter('filelock_assembly_bytes_total', 'Bytes of files assembled from chunked uploads')
+archive_build_duration = Histogram('filelock_archive_build_seconds',
+                                   'Time to build a folder zip archive, streamed to the client or by a job',
+                                   ('mode',))
+download_bytes = Counter('filelock_download_bytes_total',
+                         'Bytes of files sent by download_file, per way they were sent', ('mode',))
+
+def snapshot():
+    with _lock:
+        return {metric.name: metric.snapshot() for metric in _metrics}
+
+def flush(force=False):
+    """Write this worker's values for scrapes answered by other workers"""
+    global _dirty, _flushed
+    now = time.monotonic()
+    if not force and (not _dirty or now - _flushed < app.config['METRICS_FLUSH_INTERVAL']):
+        return
+    _dirty = False
+    _flushed = now
+    path = os.path.join(app.config['METRICS_FOLDER'], SNAPSHOT_NAME)
+    try:
+        temp_path = f"{path}.{threading.get_ident()}.tmp"
+        with open(temp_path, 'w') as f:
+            json.dump(snapshot(), f)
+        os.replace(temp_path, path)
+    except OSError as e:
+        logging.warning(f"Could not write metrics snapshot: {e}")
+
+def worker_running(snapshot_name):
+    """Whether the worker that wrote a snapshot still runs; idle ones don't rewrite theirs"""
+    host, pid = snapshot_name[:-len('.json')].rsplit('-', 1)
+    if host != socket.gethostname():
+        return False
+    try:
+        os.kill(int(pid), 0)
+    except ProcessLookupError:
+        return False
+    except (PermissionError, ValueError):
+        pass
+    return True
+
+def worker_snapshots():
+    """Values of every worker on this host, this one's current ones included"""
+    folder = app.config['METRICS_FOLDER']
+    stale = time.time() - app.config['METRICS_SNAPSHOT_TTL']
+    snapshots = [snapshot()]
+    for entry in os.scandir(folder):
+        if not entry.name.endswith('.json') or entry.name == SNAPSHOT_NAME:
+            continue
+        try:
+            if entry.stat().st_mtime < stale and not worker_running(entry.name):
+                # A worker that stopped long ago
+                os.remove(entry.path)
+                continue
+            with open(entry.path) as f:
+                snapshots.append(json.load(f))
+        except (OSError, ValueError):
+            continue
+    return snapshots
+
+def merge(snapshots):
+    """{metric name: {label values: value}} summed over workers"""
+    merged = {metric.name: {} for metric in _metrics}
+    for worker in snapshots:
+        for name, rows in worker.items():
+            if name not in merged:
+                continue
+            values = merged[name]
+            for row in rows:
+                labels = tuple(row[0])
+                if len(row) == 2:
+                    values[labels] = values.get(labels, 0) + row[1]
+                else:
+                    counts, total = values.get(labels, ([0] * len(row[1]), 0))
+                    values[labels] = ([a + b for a, b in zip(counts, row[1])], total + row[2])
+    return merged
+
+def escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+def label_text(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ''
+    return '{' + ','.join(f'{name}="{escape(value)}"' for name, value in pairs) + '}'
+
+def format_number(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+def database_gauges():
+    """(name, documentation, label name, {label value: value}) read from the database"""
+    uploads = dict(db.session.query(ChunkedUpload.status, db.func.count())
+                   .filter(ChunkedUpload.status.in_(('uploading', 'assembling')))
+                   .group_by(ChunkedUpload.status).all())
+    jobs = dict(db.session.query(Job.status, db.func.count())
+                .filter(Job.status.in_(('queued', 'running')))
+                .group_by(Job.status).all())
+    return [
+        ('filelock_chunked_uploads_active', 'Chunked upload sessions in progress', 'status',
+         {status: uploads.get(status, 0) for status in ('uploading', 'assembling')}),
+        ('filelock_jobs', 'Background jobs waiting or running', 'status',
+         {status: jobs.get(status, 0) for status in ('queued', 'running')}),
+    ]
+
+def render():
+    """All metrics in the Prometheus text format"""
+    merged = merge(worker_snapshots())
+    lines = []
+    for metric in _metrics:
+        lines.append(f"# HELP {metric.name} {metric.documentation}")
+        lines.append(f"# TYPE {metric.name} {metric.kind}")
+        for labels, value in sorted(merged[metric.name].items()):
+            if metric.kind == 'counter':
+                lines.append(f"{metric.name}{label_text(metric.labels, labels)} {format_number(value)}")
+                continue
+            counts, total = value
+            cumulative = 0
+            for bound, count in zip(metric.buckets + (float('inf'),), counts):
+                cumulative += count
+                lines.append(f"{metric.name}_bucket{label_text(metric.labels, labels, [('le', format_number(bound))])}"
+                             f" {cumulative}")
+            lines.append(f"{metric.name}_sum{label_text(metric.labels, labels)} {format_number(total)}")
+            lines.append(f"{metric.name}_count{label_text(metric.labels, labels)} {cumulative}")
+    for name, documentation, label, values in database_gauges():
+        lines.append(f"# HELP {name} {documentation}")
+        lines.append(f"# TYPE {name} gauge")
+        for value_label, value in values.items():
+            lines.append(f"{name}{label_text((label,), (value_label,))} {value}")
+    return '\n'.join(lines) + '\n'
+
+@app.before_request
+def start_request_timer():
+    g.request_started = time.perf_counter()
+
+@app.teardown_request
+def record_request(exc=None):
+    started = g.pop('request_started', None)
+    if started is not None:
+        request_duration.observe(time.perf_counter() - started, request.endpoint or 'unmatched', request.method)
+    flush()
+
+@app.route('/metrics')
+def metrics():
+    """Prometheus scrape endpoint; needs 'Authorization: Bearer <METRICS_TOKEN>' when a token is set"""
+    token = app.config['METRICS_TOKEN']
+    if token and not hmac.compare_digest(request.headers.get('Authorization', ''), f"Bearer {token}"):
+        abort(404)
+    return Response(render(), content_type='text/plain; version=0.0.4; charset=utf-8')
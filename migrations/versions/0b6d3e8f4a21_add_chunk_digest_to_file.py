@@ -0,0 +1,26 @@
+"""Add chunk digest to file
+
+Revision ID: 0b6d3e8f4a21
+Revises: f2a83c5d7e14
+Create Date: 2026-10-18 21:12:44.180379
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '0b6d3e8f4a21'
+down_revision = 'f2a83c5d7e14'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    with op.batch_alter_table('file', schema=None) as batch_op:
+        batch_op.add_column(sa.Column('chunk_digest', sa.String(length=100), nullable=True))
+
+
+def downgrade():
+    with op.batch_alter_table('file', schema=None) as batch_op:
+        batch_op.drop_column('chunk_digest')
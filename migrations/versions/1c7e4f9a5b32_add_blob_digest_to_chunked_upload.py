@@ -0,0 +1,26 @@
+"""Add blob digest to chunked upload
+
+Revision ID: 1c7e4f9a5b32
+Revises: 0b6d3e8f4a21
+Create Date: 2026-10-18 22:04:19.613027
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '1c7e4f9a5b32'
+down_revision = '0b6d3e8f4a21'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    with op.batch_alter_table('chunked_upload', schema=None) as batch_op:
+        batch_op.add_column(sa.Column('blob_digest', sa.String(length=100), nullable=True))
+
+
+def downgrade():
+    with op.batch_alter_table('chunked_upload', schema=None) as batch_op:
+        batch_op.drop_column('blob_digest')
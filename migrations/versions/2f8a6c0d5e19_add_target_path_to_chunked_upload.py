@@ -0,0 +1,26 @@
+"""Add target_path to chunked_upload for in-place chunk writes
+
+Revision ID: 2f8a6c0d5e19
+Revises: 9e5b7a13c2d4
+Create Date: 2026-10-18 11:20:51.306472
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '2f8a6c0d5e19'
+down_revision = '9e5b7a13c2d4'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    with op.batch_alter_table('chunked_upload', schema=None) as batch_op:
+        batch_op.add_column(sa.Column('target_path', sa.String(length=512), nullable=True))
+
+
+def downgrade():
+    with op.batch_alter_table('chunked_upload', schema=None) as batch_op:
+        batch_op.drop_column('target_path')
@@ -0,0 +1,36 @@
+"""Add composite indexes for keyset-paginated file listings
+
+Revision ID: 3a9d54c1f7b2
+Revises: e8b41f6d93a2
+Create Date: 2026-10-18 16:02:37.518204
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '3a9d54c1f7b2'
+down_revision = 'e8b41f6d93a2'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # Keyset comparisons skip NULLs, so give old rows the values new uploads get
+    op.execute("UPDATE file SET file_type = '' WHERE file_type IS NULL")
+    op.execute("UPDATE file SET created_at = CURRENT_TIMESTAMP WHERE created_at IS NULL")
+
+    with op.batch_alter_table('file', schema=None) as batch_op:
+        batch_op.create_index('ix_file_folder_name', ['folder_id', 'name', 'id'], unique=False)
+        batch_op.create_index('ix_file_folder_size', ['folder_id', 'size', 'id'], unique=False)
+        batch_op.create_index('ix_file_folder_type', ['folder_id', 'file_type', 'id'], unique=False)
+        batch_op.create_index('ix_file_folder_created', ['folder_id', 'created_at', 'id'], unique=False)
+
+
+def downgrade():
+    with op.batch_alter_table('file', schema=None) as batch_op:
+        batch_op.drop_index('ix_file_folder_created')
+        batch_op.drop_index('ix_file_folder_type')
+        batch_op.drop_index('ix_file_folder_size')
+        batch_op.drop_index('ix_file_folder_name')
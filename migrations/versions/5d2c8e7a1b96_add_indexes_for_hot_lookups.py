@@ -0,0 +1,49 @@
+"""Add indexes for hot lookups
+
+Revision ID: 5d2c8e7a1b96
+Revises: 3a9d54c1f7b2
+Create Date: 2026-10-18 16:47:55.102938
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '5d2c8e7a1b96'
+down_revision = '3a9d54c1f7b2'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # file.folder_id is already covered by the listing indexes, which lead with it
+    with op.batch_alter_table('user', schema=None) as batch_op:
+        batch_op.create_index(batch_op.f('ix_user_key_hash'), ['key_hash'], unique=False)
+
+    with op.batch_alter_table('folder', schema=None) as batch_op:
+        batch_op.create_index(batch_op.f('ix_folder_parent_id'), ['parent_id'], unique=False)
+        batch_op.create_index('ix_folder_user_parent', ['user_id', 'parent_id'], unique=False)
+
+    with op.batch_alter_table('file', schema=None) as batch_op:
+        batch_op.create_index('ix_file_user_checksum', ['user_id', 'checksum'], unique=False)
+
+    with op.batch_alter_table('chunked_upload', schema=None) as batch_op:
+        batch_op.create_index(batch_op.f('ix_chunked_upload_folder_id'), ['folder_id'], unique=False)
+        batch_op.create_index('ix_chunked_upload_user_status', ['user_id', 'status'], unique=False)
+
+
+def downgrade():
+    with op.batch_alter_table('chunked_upload', schema=None) as batch_op:
+        batch_op.drop_index('ix_chunked_upload_user_status')
+        batch_op.drop_index(batch_op.f('ix_chunked_upload_folder_id'))
+
+    with op.batch_alter_table('file', schema=None) as batch_op:
+        batch_op.drop_index('ix_file_user_checksum')
+
+    with op.batch_alter_table('folder', schema=None) as batch_op:
+        batch_op.drop_index('ix_folder_user_parent')
+        batch_op.drop_index(batch_op.f('ix_folder_parent_id'))
+
+    with op.batch_alter_table('user', schema=None) as batch_op:
+        batch_op.drop_index(batch_op.f('ix_user_key_hash'))
@@ -0,0 +1,54 @@
+"""Add job table for background work
+
+Revision ID: 6b0e3f8d2c71
+Revises: a4f7c2e91d05
+Create Date: 2026-10-18 18:12:09.264518
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '6b0e3f8d2c71'
+down_revision = 'a4f7c2e91d05'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('job',
+        sa.Column('id', sa.String(length=36), nullable=False),
+        sa.Column('kind', sa.String(length=50), nullable=False),
+        sa.Column('user_id', sa.Integer(), nullable=False),
+        sa.Column('params', sa.Text(), nullable=False),
+        sa.Column('result', sa.Text(), nullable=True),
+        sa.Column('status', sa.String(length=20), nullable=False),
+        sa.Column('message', sa.String(length=255), nullable=True),
+        sa.Column('progress_done', sa.BigInteger(), nullable=False),
+        sa.Column('progress_total', sa.BigInteger(), nullable=False),
+        sa.Column('attempts', sa.Integer(), nullable=False),
+        sa.Column('worker', sa.String(length=100), nullable=True),
+        sa.Column('heartbeat_at', sa.DateTime(), nullable=True),
+        sa.Column('created_at', sa.DateTime(), nullable=True),
+        sa.Column('updated_at', sa.DateTime(), nullable=True),
+        sa.ForeignKeyConstraint(['user_id'], ['user.id'], ),
+        sa.PrimaryKeyConstraint('id')
+    )
+    with op.batch_alter_table('job', schema=None) as batch_op:
+        batch_op.create_index(batch_op.f('ix_job_status'), ['status'], unique=False)
+
+    with op.batch_alter_table('chunked_upload', schema=None) as batch_op:
+        batch_op.add_column(sa.Column('job_id', sa.String(length=36), nullable=True))
+        batch_op.create_foreign_key('fk_chunked_upload_job_id_job', 'job', ['job_id'], ['id'])
+
+
+def downgrade():
+    with op.batch_alter_table('chunked_upload', schema=None) as batch_op:
+        batch_op.drop_constraint('fk_chunked_upload_job_id_job', type_='foreignkey')
+        batch_op.drop_column('job_id')
+
+    with op.batch_alter_table('job', schema=None) as batch_op:
+        batch_op.drop_index(batch_op.f('ix_job_status'))
+
+    op.drop_table('job')
@@ -0,0 +1,38 @@
+"""Add content-addressed blob table and file.checksum
+
+Revision ID: 71a3e0b84c6f
+Revises: 2f8a6c0d5e19
+Create Date: 2026-10-18 12:41:09.772615
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '71a3e0b84c6f'
+down_revision = '2f8a6c0d5e19'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('blob',
+        sa.Column('digest', sa.String(length=100), nullable=False),
+        sa.Column('path', sa.String(length=512), nullable=False),
+        sa.Column('size', sa.BigInteger(), nullable=False),
+        sa.Column('ref_count', sa.Integer(), nullable=False),
+        sa.Column('created_at', sa.DateTime(), nullable=True),
+        sa.PrimaryKeyConstraint('digest')
+    )
+    # Existing files keep their own paths and a NULL checksum
+    with op.batch_alter_table('file', schema=None) as batch_op:
+        batch_op.add_column(sa.Column('checksum', sa.String(length=100), nullable=True))
+        batch_op.create_foreign_key('fk_file_checksum_blob', 'blob', ['checksum'], ['digest'])
+
+
+def downgrade():
+    with op.batch_alter_table('file', schema=None) as batch_op:
+        batch_op.drop_constraint('fk_file_checksum_blob', type_='foreignkey')
+        batch_op.drop_column('checksum')
+    op.drop_table('blob')
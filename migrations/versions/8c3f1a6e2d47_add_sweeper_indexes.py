@@ -0,0 +1,34 @@
+"""Add indexes used by the storage sweeper
+
+Revision ID: 8c3f1a6e2d47
+Revises: 6b0e3f8d2c71
+Create Date: 2026-10-18 18:05:12.446201
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '8c3f1a6e2d47'
+down_revision = '6b0e3f8d2c71'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    with op.batch_alter_table('file', schema=None) as batch_op:
+        batch_op.create_index(batch_op.f('ix_file_path'), ['path'], unique=False)
+
+    with op.batch_alter_table('chunked_upload', schema=None) as batch_op:
+        batch_op.create_index('ix_chunked_upload_status_updated', ['status', 'updated_at'], unique=False)
+        batch_op.create_index(batch_op.f('ix_chunked_upload_file_id'), ['file_id'], unique=False)
+
+
+def downgrade():
+    with op.batch_alter_table('chunked_upload', schema=None) as batch_op:
+        batch_op.drop_index(batch_op.f('ix_chunked_upload_file_id'))
+        batch_op.drop_index('ix_chunked_upload_status_updated')
+
+    with op.batch_alter_table('file', schema=None) as batch_op:
+        batch_op.drop_index(batch_op.f('ix_file_path'))
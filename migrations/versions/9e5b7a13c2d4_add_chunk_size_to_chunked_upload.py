@@ -0,0 +1,26 @@
+"""Add chunk_size to chunked_upload for resumable uploads
+
+Revision ID: 9e5b7a13c2d4
+Revises: 4c1d2e9a7f30
+Create Date: 2026-10-18 10:03:27.540911
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '9e5b7a13c2d4'
+down_revision = '4c1d2e9a7f30'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    with op.batch_alter_table('chunked_upload', schema=None) as batch_op:
+        batch_op.add_column(sa.Column('chunk_size', sa.Integer(), nullable=True))
+
+
+def downgrade():
+    with op.batch_alter_table('chunked_upload', schema=None) as batch_op:
+        batch_op.drop_column('chunk_size')
@@ -0,0 +1,67 @@
+"""Add maintained size and file-count totals to folder, widen file.size
+
+Revision ID: a4f7c2e91d05
+Revises: 5d2c8e7a1b96
+Create Date: 2026-10-18 17:26:41.830557
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'a4f7c2e91d05'
+down_revision = '5d2c8e7a1b96'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    with op.batch_alter_table('file', schema=None) as batch_op:
+        batch_op.alter_column('size', existing_type=sa.Integer(), type_=sa.BigInteger(), existing_nullable=False)
+
+    with op.batch_alter_table('folder', schema=None) as batch_op:
+        batch_op.add_column(sa.Column('file_count', sa.Integer(), nullable=False, server_default='0'))
+        batch_op.add_column(sa.Column('total_size', sa.BigInteger(), nullable=False, server_default='0'))
+        batch_op.add_column(sa.Column('tree_file_count', sa.Integer(), nullable=False, server_default='0'))
+        batch_op.add_column(sa.Column('tree_size', sa.BigInteger(), nullable=False, server_default='0'))
+
+    # Backfill; same computation as `flask rebuild-folder-totals`
+    conn = op.get_bind()
+    direct = {folder_id: (count, size) for folder_id, count, size in conn.execute(sa.text(
+        'SELECT folder_id, COUNT(id), COALESCE(SUM(size), 0) FROM file GROUP BY folder_id'))}
+    children = {}
+    for folder_id, parent_id in conn.execute(sa.text('SELECT id, parent_id FROM folder')):
+        children.setdefault(parent_id, []).append(folder_id)
+
+    order, stack = [], list(children.get(None, []))
+    while stack:
+        folder_id = stack.pop()
+        order.append(folder_id)
+        stack.extend(children.get(folder_id, []))
+    tree = {}
+    for folder_id in reversed(order):
+        count, size = direct.get(folder_id, (0, 0))
+        for child_id in children.get(folder_id, []):
+            count += tree[child_id][0]
+            size += tree[child_id][1]
+        tree[folder_id] = (count, size)
+
+    rows = [{'id': folder_id, 'file_count': direct.get(folder_id, (0, 0))[0], 'total_size': direct.get(folder_id, (0, 0))[1],
+             'tree_file_count': count, 'tree_size': size}
+            for folder_id, (count, size) in tree.items() if count]
+    if rows:
+        conn.execute(sa.text(
+            'UPDATE folder SET file_count = :file_count, total_size = :total_size, '
+            'tree_file_count = :tree_file_count, tree_size = :tree_size WHERE id = :id'), rows)
+
+
+def downgrade():
+    with op.batch_alter_table('folder', schema=None) as batch_op:
+        batch_op.drop_column('tree_size')
+        batch_op.drop_column('tree_file_count')
+        batch_op.drop_column('total_size')
+        batch_op.drop_column('file_count')
+
+    with op.batch_alter_table('file', schema=None) as batch_op:
+        batch_op.alter_column('size', existing_type=sa.BigInteger(), type_=sa.Integer(), existing_nullable=False)
@@ -0,0 +1,26 @@
+"""Add per-chunk digests to chunked_upload
+
+Revision ID: c5d09b2e4a87
+Revises: 71a3e0b84c6f
+Create Date: 2026-10-18 13:55:36.204118
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'c5d09b2e4a87'
+down_revision = '71a3e0b84c6f'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    with op.batch_alter_table('chunked_upload', schema=None) as batch_op:
+        batch_op.add_column(sa.Column('chunk_digests', sa.LargeBinary(), nullable=True))
+
+
+def downgrade():
+    with op.batch_alter_table('chunked_upload', schema=None) as batch_op:
+        batch_op.drop_column('chunk_digests')
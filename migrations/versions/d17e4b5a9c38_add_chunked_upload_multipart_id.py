@@ -0,0 +1,26 @@
+"""Add chunked_upload.multipart_id
+
+Revision ID: d17e4b5a9c38
+Revises: 8c3f1a6e2d47
+Create Date: 2026-10-18 18:52:40.318774
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'd17e4b5a9c38'
+down_revision = '8c3f1a6e2d47'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    with op.batch_alter_table('chunked_upload', schema=None) as batch_op:
+        batch_op.add_column(sa.Column('multipart_id', sa.String(length=255), nullable=True))
+
+
+def downgrade():
+    with op.batch_alter_table('chunked_upload', schema=None) as batch_op:
+        batch_op.drop_column('multipart_id')
@@ -0,0 +1,26 @@
+"""Add encrypted flag to file
+
+Revision ID: e8b41f6d93a2
+Revises: c5d09b2e4a87
+Create Date: 2026-10-18 15:08:13.447120
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'e8b41f6d93a2'
+down_revision = 'c5d09b2e4a87'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    with op.batch_alter_table('file', schema=None) as batch_op:
+        batch_op.add_column(sa.Column('encrypted', sa.Boolean(), nullable=False, server_default=sa.false()))
+
+
+def downgrade():
+    with op.batch_alter_table('file', schema=None) as batch_op:
+        batch_op.drop_column('encrypted')
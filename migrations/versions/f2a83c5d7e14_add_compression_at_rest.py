@@ -0,0 +1,34 @@
+"""Add compression flag and stored size to file and blob
+
+Revision ID: f2a83c5d7e14
+Revises: d17e4b5a9c38
+Create Date: 2026-10-18 19:31:07.529164
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'f2a83c5d7e14'
+down_revision = 'd17e4b5a9c38'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # Everything stored so far is uncompressed, so its stored size is its size
+    for table in ('blob', 'file'):
+        with op.batch_alter_table(table, schema=None) as batch_op:
+            batch_op.add_column(sa.Column('compressed', sa.Boolean(), nullable=False, server_default=sa.false()))
+            batch_op.add_column(sa.Column('stored_size', sa.BigInteger(), nullable=True))
+        op.execute(f'UPDATE {table} SET stored_size = size')
+        with op.batch_alter_table(table, schema=None) as batch_op:
+            batch_op.alter_column('stored_size', existing_type=sa.BigInteger(), nullable=False)
+
+
+def downgrade():
+    for table in ('file', 'blob'):
+        with op.batch_alter_table(table, schema=None) as batch_op:
+            batch_op.drop_column('stored_size')
+            batch_op.drop_column('compressed')
@@ -1,3 +1,5 @@
+import json
+import hashlib
 from app import db
 from datetime import datetime
 from werkzeug.security import generate_password_hash, check_password_hash
@@ -8,7 +10,7 @@ class User(db.Model, UserMixin):
     username = db.Column(db.String(64), unique=True, nullable=False)
     email = db.Column(db.String(120), unique=True, nullable=False)
     password_hash = db.Column(db.String(256), nullable=False)
-    key_hash = db.Column(db.String(128), nullable=True)
+    key_hash = db.Column(db.String(128), nullable=True, index=True)  # Looked up by /retrieve_folder
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
     folders = db.relationship('Folder', backref='owner', lazy=True)
     files = db.relationship('File', backref='owner', lazy=True)
@@ -22,9 +24,14 @@ class User(db.Model, UserMixin):
 class Folder(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     name = db.Column(db.String(255), nullable=False)
-    parent_id = db.Column(db.Integer, db.ForeignKey('folder.id'), nullable=True)
+    parent_id = db.Column(db.Integer, db.ForeignKey('folder.id'), nullable=True, index=True)
     user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
     is_visible = db.Column(db.Boolean, default=True)  # Flag to control folder visibility
+    # Maintained totals: files directly in this folder, and in its whole subtree
+    file_count = db.Column(db.Integer, default=0, nullable=False)
+    total_size = db.Column(db.BigInteger, default=0, nullable=False)
+    tree_file_count = db.Column(db.Integer, default=0, nullable=False)
+    tree_size = db.Column(db.BigInteger, default=0, nullable=False)
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
     updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
     
@@ -32,13 +39,304 @@ class Folder(db.Model):
     subfolders = db.relationship('Folder', backref=db.backref('parent', remote_side=[id]), lazy=True)
     files = db.relationship('File', backref='folder', lazy=True, cascade="all, delete-orphan")
 
+    # Root folder lookup and vault-wide lock/unlock
+    __table_args__ = (
+        db.Index('ix_folder_user_parent', 'user_id', 'parent_id'),
+    )
+
+    @classmethod
+    def subtree_cte(cls, folder_id):
+        """Recursive CTE with the ids of a folder and all of its descendants"""
+        tree = db.select(cls.id).where(cls.id == folder_id).cte('subtree', recursive=True)
+        child = db.aliased(cls)
+        return tree.union_all(db.select(child.id).join(tree, child.parent_id == tree.c.id))
+
+    @classmethod
+    def subtree_ids(cls, folder_id):
+        """Select statement for the ids of a folder and its descendants, usable in in_()"""
+        tree = cls.subtree_cte(folder_id)
+        return db.select(tree.c.id)
+
+    def subtree(self):
+        """This folder and all of its descendants, loaded in a single query"""
+        return Folder.query.filter(Folder.id.in_(Folder.subtree_ids(self.id))).all()
+
+    @classmethod
+    def ancestors_cte(cls, folder_id):
+        """Recursive CTE with the ids of a folder and all of its ancestors, and their depth above it"""
+        chain = db.select(cls.id, cls.parent_id, db.literal(0).label('depth')) \
+            .where(cls.id == folder_id).cte('ancestors', recursive=True)
+        parent = db.aliased(cls)
+        return chain.union_all(
+            db.select(parent.id, parent.parent_id, (chain.c.depth + 1).label('depth'))
+            .join(chain, parent.id == chain.c.parent_id)
+        )
+
+    def ancestors(self):
+        """The chain of folders from the root down to this one, loaded in a single query"""
+        chain = Folder.ancestors_cte(self.id)
+        return Folder.query.join(chain, Folder.id == chain.c.id).order_by(chain.c.depth.desc()).all()
+
+    @classmethod
+    def add_to_totals(cls, folder_id, size, count, direct=True):
+        """
+        Add files to a folder's totals and to the subtree totals of it and its ancestors.
+        Pass negative values when files go away. The updates are atomic increments made
+        in the caller's transaction, so commit them together with the File changes.
+        :param direct: False when the files are in a subfolder, not in the folder itself
+        """
+        if direct:
+            cls.query.filter(cls.id == folder_id).update({
+                'file_count': cls.file_count + count,
+                'total_size': cls.total_size + size,
+                'updated_at': cls.updated_at
+            }, synchronize_session=False)
+        chain = cls.ancestors_cte(folder_id)
+        cls.query.filter(cls.id.in_(db.select(chain.c.id))).update({
+            'tree_file_count': cls.tree_file_count + count,
+            'tree_size': cls.tree_size + size,
+            'updated_at': cls.updated_at
+        }, synchronize_session=False)
+
+    @classmethod
+    def rebuild_totals(cls):
+        """Recompute every folder's totals from the file table; returns the number that were wrong"""
+        direct = {folder_id: (count, size) for folder_id, count, size in db.session.execute(
+            db.select(File.folder_id, db.func.count(File.id), db.func.coalesce(db.func.sum(File.size), 0))
+            .group_by(File.folder_id)
+        )}
+        folders = db.session.execute(db.select(
+            cls.id, cls.parent_id, cls.file_count, cls.total_size, cls.tree_file_count, cls.tree_size
+        )).all()
+
+        children = {}
+        for folder in folders:
+            children.setdefault(folder.parent_id, []).append(folder.id)
+
+        # Children before parents, without recursing on deep trees
+        order, stack = [], list(children.get(None, []))
+        while stack:
+            folder_id = stack.pop()
+            order.append(folder_id)
+            stack.extend(children.get(folder_id, []))
+        tree = {}
+        for folder_id in reversed(order):
+            count, size = direct.get(folder_id, (0, 0))
+            for child_id in children.get(folder_id, []):
+                count += tree[child_id][0]
+                size += tree[child_id][1]
+            tree[folder_id] = (count, size)
+
+        fixed = []
+        for folder in folders:
+            totals = direct.get(folder.id, (0, 0)) + tree.get(folder.id, (0, 0))
+            if totals != (folder.file_count, folder.total_size, folder.tree_file_count, folder.tree_size):
+                fixed.append({'id': folder.id, 'file_count': totals[0], 'total_size': totals[1],
+                              'tree_file_count': totals[2], 'tree_size': totals[3]})
+        if fixed:
+            db.session.execute(db.update(cls), fixed)
+        db.session.commit()
+        return len(fixed)
+
 class File(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     name = db.Column(db.String(255), nullable=False)
-    path = db.Column(db.String(512), nullable=False)
-    size = db.Column(db.Integer, nullable=False)  # Size in bytes
+    path = db.Column(db.String(512), nullable=False, index=True)  # Looked up when sweeping orphaned data
+    size = db.Column(db.BigInteger, nullable=False)  # Size in bytes
     file_type = db.Column(db.String(50), nullable=True)
     folder_id = db.Column(db.Integer, db.ForeignKey('folder.id'), nullable=False)
     user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
+    checksum = db.Column(db.String(100), db.ForeignKey('blob.digest'), nullable=True)  # Shared blob holding the data
+    encrypted = db.Column(db.Boolean, default=False, nullable=False)  # Stored in the segmented format from utils.encrypt_stream
+    compressed = db.Column(db.Boolean, default=False, nullable=False)  # Stored in the segmented format from utils.compress_stream
+    stored_size = db.Column(db.BigInteger, nullable=False)  # Bytes the data takes in storage; size is the logical size
+    chunk_digest = db.Column(db.String(100), nullable=True)  # ChunkedUpload.chunk_tree_digest() of a chunked upload, for integrity checks
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
     updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+
+    # One index per listing sort order, so each page is a short index range scan
+    __table_args__ = (
+        db.Index('ix_file_folder_name', 'folder_id', 'name', 'id'),
+        db.Index('ix_file_folder_size', 'folder_id', 'size', 'id'),
+        db.Index('ix_file_folder_type', 'folder_id', 'file_type', 'id'),
+        db.Index('ix_file_folder_created', 'folder_id', 'created_at', 'id'),
+        # Per-user lookups, including "does this user already own these contents"
+        db.Index('ix_file_user_checksum', 'user_id', 'checksum'),
+    )
+
+    # Listing sort keys and the columns they order by
+    SORT_KEYS = {'name': 'name', 'size': 'size', 'type': 'file_type', 'created_at': 'created_at'}
+
+    @classmethod
+    def page(cls, folder_id, sort='name', descending=False, after=None, limit=100):
+        """
+        One page of a folder's files in keyset order, ties broken by id
+        :param after: (sort value, id) of the last file on the previous page
+        :return: up to limit files
+        """
+        column = getattr(cls, cls.SORT_KEYS[sort])
+        query = cls.query.filter(cls.folder_id == folder_id)
+        if after is not None:
+            key, last = db.tuple_(column, cls.id), db.tuple_(*after)
+            query = query.filter(key < last if descending else key > last)
+        if descending:
+            query = query.order_by(column.desc(), cls.id.desc())
+        else:
+            query = query.order_by(column, cls.id)
+        return query.limit(limit).all()
+
+    def sort_value(self, sort):
+        return getattr(self, self.SORT_KEYS[sort])
+
+class Blob(db.Model):
+    """Content-addressed file data, shared by every File with the same contents"""
+    digest = db.Column(db.String(100), primary_key=True)  # '<algorithm>:<hex digest>'
+    path = db.Column(db.String(512), nullable=False)
+    size = db.Column(db.BigInteger, nullable=False)
+    compressed = db.Column(db.Boolean, default=False, nullable=False)  # Stored in the segmented format from utils.compress_stream
+    stored_size = db.Column(db.BigInteger, nullable=False)  # Bytes the data takes in storage
+    ref_count = db.Column(db.Integer, default=0, nullable=False)  # Number of File rows pointing here
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+class ChunkedUpload(db.Model):
+    """Server-side state for a chunked upload, shared by all workers"""
+    id = db.Column(db.String(36), primary_key=True)  # The upload_id handed to the client
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
+    folder_id = db.Column(db.Integer, db.ForeignKey('folder.id'), nullable=False, index=True)
+    filename = db.Column(db.String(255), nullable=False)
+    total_size = db.Column(db.BigInteger, nullable=False)
+    total_chunks = db.Column(db.Integer, nullable=False)
+    chunk_size = db.Column(db.Integer, nullable=True)  # Needed by clients resuming the upload
+    target_path = db.Column(db.String(512), nullable=True)  # Preallocated destination or multipart object, if chunks are written in place
+    multipart_id = db.Column(db.String(255), nullable=True)  # Object store multipart upload receiving the chunks as parts
+    blob_digest = db.Column(db.String(100), nullable=True)  # Blob assembly took a reference on, until the File holds it
+    received = db.Column(db.LargeBinary, nullable=False)  # One bit per chunk
+    chunk_digests = db.Column(db.LargeBinary, nullable=True)  # SHA-256 of each received chunk, 32 bytes apiece
+    received_count = db.Column(db.Integer, default=0, nullable=False)
+    status = db.Column(db.String(20), default='uploading', nullable=False)  # uploading, assembling, complete, failed
+    version = db.Column(db.Integer, default=0, nullable=False)  # Bumped on every bitmap update
+    file_id = db.Column(db.Integer, db.ForeignKey('file.id'), nullable=True, index=True)
+    job_id = db.Column(db.String(36), db.ForeignKey('job.id'), nullable=True)  # Background job assembling the file
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+
+    # The resumable-uploads listing, and the sweeper's search for expired uploads
+    __table_args__ = (
+        db.Index('ix_chunked_upload_user_status', 'user_id', 'status'),
+        db.Index('ix_chunked_upload_status_updated', 'status', 'updated_at'),
+    )
+
+    @staticmethod
+    def empty_bitmap(total_chunks):
+        return bytes((total_chunks + 7) // 8)
+
+    @staticmethod
+    def empty_digests(total_chunks):
+        return bytes(32 * total_chunks)
+
+    def digests_with(self, chunk_number, digest):
+        """Return a copy of the chunk digests with the given chunk's SHA-256 filled in"""
+        digests = bytearray(self.chunk_digests or self.empty_digests(self.total_chunks))
+        digests[chunk_number * 32:(chunk_number + 1) * 32] = digest
+        return bytes(digests)
+
+    def has_all_digests(self):
+        """False for uploads started before chunk digests were recorded"""
+        if not self.chunk_digests:
+            return False
+        empty = bytes(32)
+        return all(self.chunk_digests[i * 32:(i + 1) * 32] != empty for i in range(self.total_chunks))
+
+    def chunk_digest(self, chunk_number):
+        """SHA-256 recorded for a chunk when it arrived, or None for uploads started before they were"""
+        digest = (self.chunk_digests or b'')[chunk_number * 32:(chunk_number + 1) * 32]
+        return digest if digest and digest != bytes(32) else None
+
+    def chunk_tree_digest(self):
+        """
+        Digest of the file as it was sent, derived from the chunk digests
+        SHA-256 over the chunk size followed by every chunk's SHA-256, in order. It
+        depends on the chunk size, so an upload written in place is only stored under it
+        until a background job re-keys its blob by the SHA-256 of the whole file; it is
+        kept for integrity checks on File.chunk_digest.
+        """
+        sha256 = hashlib.sha256(self.chunk_size.to_bytes(8, 'big') if self.chunk_size else bytes(8))
+        sha256.update(self.chunk_digests)
+        return f"sha256-chunks:{sha256.hexdigest()}"
+
+    def has_chunk(self, chunk_number):
+        return bool(self.received[chunk_number // 8] & (1 << (chunk_number % 8)))
+
+    def bitmap_with(self, chunk_number):
+        """Return a copy of the received bitmap with the given chunk's bit set"""
+        bitmap = bytearray(self.received)
+        bitmap[chunk_number // 8] |= 1 << (chunk_number % 8)
+        return bytes(bitmap)
+
+    def chunk_length(self, chunk_number):
+        """Expected length of a chunk; every chunk but the last is chunk_size long"""
+        if chunk_number < self.total_chunks - 1:
+            return self.chunk_size
+        return self.total_size - self.chunk_size * (self.total_chunks - 1)
+
+    def missing_ranges(self):
+        """Return the chunks not yet received as inclusive [first, last] ranges"""
+        ranges = []
+        start = None
+        for chunk_number in range(self.total_chunks):
+            if not self.has_chunk(chunk_number):
+                if start is None:
+                    start = chunk_number
+            elif start is not None:
+                ranges.append([start, chunk_number - 1])
+                start = None
+        if start is not None:
+            ranges.append([start, self.total_chunks - 1])
+        return ranges
+
+    def to_dict(self):
+        return {
+            'upload_id': self.id,
+            'folder_id': self.folder_id,
+            'filename': self.filename,
+            'total_size': self.total_size,
+            'total_chunks': self.total_chunks,
+            'chunk_size': self.chunk_size,
+            'received_chunks': self.received_count,
+            'status': self.status,
+            'file_id': self.file_id,
+            'job_id': self.job_id,
+            'updated_at': self.updated_at.strftime('%Y-%m-%d %H:%M:%S') if self.updated_at else None
+        }
+
+    @property
+    def is_complete(self):
+        return self.received_count >= self.total_chunks
+
+class Job(db.Model):
+    """A unit of background work; the row is both the queue entry and the progress record"""
+    id = db.Column(db.String(36), primary_key=True)
+    kind = db.Column(db.String(50), nullable=False)  # Name of the handler registered in jobs.py
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
+    params = db.Column(db.Text, nullable=False)  # JSON arguments for the handler
+    result = db.Column(db.Text, nullable=True)  # JSON returned by the handler
+    status = db.Column(db.String(20), default='queued', nullable=False, index=True)  # queued, running, complete, failed
+    message = db.Column(db.String(255), nullable=True)
+    progress_done = db.Column(db.BigInteger, default=0, nullable=False)  # In whatever unit the handler counts
+    progress_total = db.Column(db.BigInteger, default=0, nullable=False)
+    attempts = db.Column(db.Integer, default=0, nullable=False)
+    worker = db.Column(db.String(100), nullable=True)  # host:pid currently running it
+    heartbeat_at = db.Column(db.DateTime, nullable=True)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+
+    def to_dict(self):
+        return {
+            'job_id': self.id,
+            'kind': self.kind,
+            'status': self.status,
+            'message': self.message,
+            'progress': round(100 * self.progress_done / self.progress_total) if self.progress_total else None,
+            'result': json.loads(self.result) if self.result else None,
+            'created_at': self.created_at.strftime('%Y-%m-%d %H:%M:%S') if self.created_at else None
+        }
@@ -0,0 +1,140 @@
+import re
+import time
+import logging
+import threading
+import contextvars
+from contextlib import contextmanager
+from flask import g, request
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from app import app
+
+# SQL profiling: counts and times the statements run while a profile is active,
+# to catch pages that got slow or started querying inside a loop. With
+# SQL_PROFILING set, every request is profiled and requests that are slow, run
+# many statements or repeat one are logged with their breakdown. Tests and
+# benchmarks can profile any block of code:
+#
+#     with profile_queries() as profile:
+#         client.get(f'/folder/{folder_id}')
+#     assert not profile.repeated(), profile.report()
+
+# Profiles statements are being recorded into, innermost last
+_active = contextvars.ContextVar('query_profiles', default=())
+_listening = False
+_listening_lock = threading.Lock()
+
+# Parameter lists expanded for IN (...), so a query has one shape whatever the list length
+IN_LIST = re.compile(r'\((?:\s*(?:\?|%\(\w+\)s|:\w+)\s*,)+\s*(?:\?|%\(\w+\)s|:\w+)\s*\)')
+WHITESPACE = re.compile(r'\s+')
+
+def query_shape(statement):
+    """A statement with its layout and parameter list lengths evened out"""
+    return IN_LIST.sub('(?...)', WHITESPACE.sub(' ', statement).strip())
+
+class QueryProfile:
+    """Statements run while a profile is active, with the time each took"""
+
+    def __init__(self):
+        self.queries = []  # (statement, seconds)
+
+    @property
+    def count(self):
+        return len(self.queries)
+
+    @property
+    def total_time(self):
+        return sum(seconds for _, seconds in self.queries)
+
+    def slowest(self, limit=5):
+        """The slowest statements, as (seconds, statement)"""
+        return sorted(((seconds, statement) for statement, seconds in self.queries), reverse=True)[:limit]
+
+    def repeated(self, threshold=None):
+        """
+        N+1 suspects: statement shapes run at least threshold times
+        :return: [(shape, times run, total seconds)], most run first
+        """
+        threshold = threshold or app.config['SQL_PROFILING_REPEAT_THRESHOLD']
+        shapes = {}
+        for statement, seconds in self.queries:
+            shape = query_shape(statement)
+            count, total = shapes.get(shape, (0, 0))
+            shapes[shape] = (count + 1, total + seconds)
+        return sorted(((shape, count, total) for shape, (count, total) in shapes.items() if count >= threshold),
+                      key=lambda suspect: -suspect[1])
+
+    def report(self, slowest=5):
+        """The breakdown as text, for logs and failing assertions"""
+        lines = [f"{self.count} statement(s) in {self.total_time * 1000:.1f}ms"]
+        for shape, count, total in self.repeated():
+            lines.append(f"  N+1 suspect, run {count} times in {total * 1000:.1f}ms: {shape}")
+        for seconds, statement in self.slowest(slowest):
+            lines.append(f"  {seconds * 1000:.1f}ms: {query_shape(statement)}")
+        return '\n'.join(lines)
+
+def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    if _active.get():
+        conn.info.setdefault('query_started', []).append(time.perf_counter())
+
+def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    profiles = _active.get()
+    started = conn.info.get('query_started')
+    if not profiles or not started:
+        return
+    seconds = time.perf_counter() - started.pop()
+    for profile in profiles:
+        profile.queries.append((statement, seconds))
+
+def listen():
+    """Hook the statement timers into every engine, once; they do nothing while no profile is active"""
+    global _listening
+    with _listening_lock:
+        if _listening:
+            return
+        event.listen(Engine, 'before_cursor_execute', before_cursor_execute)
+        event.listen(Engine, 'after_cursor_execute', after_cursor_execute)
+        _listening = True
+
+def start_profile():
+    """Record statements into a new profile until stop_profile(token); returns (profile, token)"""
+    listen()
+    profile = QueryProfile()
+    return profile, _active.set(_active.get() + (profile,))
+
+def stop_profile(token):
+    _active.reset(token)
+
+@contextmanager
+def profile_queries():
+    """Profile the statements run inside a with block"""
+    profile, token = start_profile()
+    try:
+        yield profile
+    finally:
+        stop_profile(token)
+
+@app.before_request
+def start_request_profile():
+    if app.config['SQL_PROFILING']:
+        g.query_profile, g.query_profile_token = start_profile()
+        g.query_profile_started = time.perf_counter()
+
+@app.after_request
+def add_server_timing(response):
+    # Shows the database's share of a request in the browser's developer tools
+    profile = g.get('query_profile')
+    if profile:
+        response.headers.add('Server-Timing', f'db;dur={profile.total_time * 1000:.1f};desc="{profile.count} queries"')
+    return response
+
+@app.teardown_request
+def finish_request_profile(exc=None):
+    profile = g.pop('query_profile', None)
+    if profile is None:
+        return
+    stop_profile(g.pop('query_profile_token'))
+    elapsed = time.perf_counter() - g.pop('query_profile_started')
+    if (elapsed >= app.config['SQL_PROFILING_SLOW_REQUEST'] or profile.count >= app.config['SQL_PROFILING_MAX_QUERIES']
+            or profile.repeated()):
+        logging.warning(f"{request.method} {request.path} took {elapsed * 1000:.1f}ms, {profile.report()}")
@@ -24,6 +24,12 @@ document.addEventListener('DOMContentLoaded', function() {
     // Setup file selection
     setupFileSelection();
     
+    // Setup sorting and loading further pages of files
+    setupFileListing();
+    
+    // Setup zip downloads built in the background
+    setupArchiveDownload();
+    
     // Setup QR code functionality
     setupQrCode();
     
@@ -299,24 +305,23 @@ function setupFolderActions() {
 }
 
 function setupFileSelection() {
-    // File selection
-    const fileItems = document.querySelectorAll('.file-item');
-    fileItems.forEach(item => {
-        item.addEventListener('click', function(e) {
-            e.preventDefault();
-            
-            // Remove selection from all files
-            fileItems.forEach(f => f.classList.remove('selected'));
-            
-            // Add selection to this file
-            item.classList.add('selected');
-            
-            // Get file ID
-            selectedFileId = item.dataset.fileId;
-            
-            // Load file details
-            loadFileDetails(selectedFileId);
-        });
+    // File selection, delegated so files appended on scroll work too
+    document.addEventListener('click', function(e) {
+        const item = e.target.closest('.file-item');
+        if (!item) return;
+        e.preventDefault();
+        
+        // Remove selection from all files
+        document.querySelectorAll('.file-item').forEach(f => f.classList.remove('selected'));
+        
+        // Add selection to this file
+        item.classList.add('selected');
+        
+        // Get file ID
+        selectedFileId = item.dataset.fileId;
+        
+        // Load file details
+        loadFileDetails(selectedFileId);
     });
     
     // Delete file buttons
@@ -332,6 +337,176 @@ function setupFileSelection() {
     });
 }
 
+function setupFileListing() {
+    const fileGrid = document.getElementById('file-grid');
+    const sentinel = document.getElementById('file-grid-sentinel');
+    const sortSelect = document.getElementById('file-sort');
+    
+    if (sortSelect) {
+        sortSelect.addEventListener('change', function() {
+            // Sorting happens on the server, reload the first page in the new order
+            const [sort, order] = this.value.split(':');
+            const params = new URLSearchParams(window.location.search);
+            params.set('sort', sort);
+            params.set('order', order);
+            window.location.search = params.toString();
+        });
+    }
+    
+    if (!fileGrid || !sentinel) return;
+    
+    // Images whose thumbnail can't be made fall back to their icon. Error events
+    // don't bubble, so this listens in the capture phase.
+    fileGrid.addEventListener('error', function(e) {
+        const img = e.target;
+        if (!img.classList || !img.classList.contains('file-thumbnail')) return;
+        const icon = document.createElement('i');
+        icon.className = `fas ${img.dataset.icon} fa-3x mb-2`;
+        img.replaceWith(icon);
+    }, true);
+    
+    let loading = false;
+    
+    function loadNextPage() {
+        const cursor = fileGrid.dataset.nextCursor;
+        if (loading || !cursor) return;
+        loading = true;
+        
+        const params = new URLSearchParams({
+            sort: fileGrid.dataset.sort,
+            order: fileGrid.dataset.order,
+            cursor: cursor
+        });
+        
+        fetch(`/api/folder/${fileGrid.dataset.folderId}/files?${params}`)
+            .then(response => response.json())
+            .then(data => {
+                if (!data.success) {
+                    throw new Error(data.message || 'Could not load files');
+                }
+                
+                data.files.forEach(file => fileGrid.appendChild(createFileCard(file)));
+                fileGrid.dataset.nextCursor = data.next_cursor || '';
+                if (!data.next_cursor) {
+                    sentinel.style.display = 'none';
+                    observer.disconnect();
+                }
+                loading = false;
+                
+                // Keep going while the sentinel is still on screen
+                const rect = sentinel.getBoundingClientRect();
+                if (data.next_cursor && rect.top < window.innerHeight) {
+                    loadNextPage();
+                }
+            })
+            .catch(error => {
+                console.error('Error loading files:', error);
+                loading = false;
+            });
+    }
+    
+    const observer = new IntersectionObserver(entries => {
+        if (entries.some(entry => entry.isIntersecting)) {
+            loadNextPage();
+        }
+    }, { rootMargin: '400px' });
+    
+    if (fileGrid.dataset.nextCursor) {
+        observer.observe(sentinel);
+    }
+}
+
+function createFileCard(file) {
+    const col = document.createElement('div');
+    col.className = 'col-md-3 col-sm-4 col-6 mb-3';
+    col.innerHTML = `
+        <div class="card h-100 file-item">
+            <div class="card-body text-center">
+                <i class="fas fa-3x mb-2"></i>
+                <p class="card-text text-truncate"></p>
+            </div>
+        </div>
+    `;
+    
+    col.querySelector('.file-item').dataset.fileId = file.id;
+    col.querySelector('i').classList.add(file.icon);
+    col.querySelector('.card-text').textContent = file.name;
+    
+    if (file.thumbnail_url) {
+        const img = document.createElement('img');
+        img.className = 'file-thumbnail mb-2';
+        img.alt = '';
+        img.loading = 'lazy';
+        img.decoding = 'async';
+        img.dataset.icon = file.icon;
+        img.src = file.thumbnail_url;
+        col.querySelector('i').replaceWith(img);
+    }
+    return col;
+}
+
+function setupArchiveDownload() {
+    document.querySelectorAll('.download-archive-btn').forEach(btn => {
+        btn.addEventListener('click', function(e) {
+            // The server builds the archive in the background; the link itself
+            // still streams it directly if this fails
+            e.preventDefault();
+            if (btn.classList.contains('disabled')) return;
+            
+            const label = btn.innerHTML;
+            btn.classList.add('disabled');
+            
+            fetch(`/api/folder/${btn.dataset.folderId}/archive`, { method: 'POST' })
+                .then(response => response.json())
+                .then(data => {
+                    if (!data.success) {
+                        throw new Error(data.message);
+                    }
+                    return waitForJob(data.job.job_id, job => {
+                        const progress = job.progress === null ? '' : ` ${job.progress}%`;
+                        btn.innerHTML = `<i class="fas fa-spinner fa-spin me-1"></i> Preparing zip${progress}`;
+                    });
+                })
+                .then(job => {
+                    window.location = job.download_url;
+                })
+                .catch(error => {
+                    showAlert(`Could not prepare the zip: ${error.message}`, 'danger');
+                })
+                .finally(() => {
+                    btn.innerHTML = label;
+                    btn.classList.remove('disabled');
+                });
+        });
+    });
+}
+
+function waitForJob(jobId, onProgress) {
+    // Poll a background job until it completes; resolves with its final status
+    return new Promise((resolve, reject) => {
+        function poll() {
+            fetch(`/api/jobs/${jobId}`)
+                .then(response => response.json())
+                .then(data => {
+                    if (!data.success) {
+                        throw new Error(data.message);
+                    }
+                    const job = data.job;
+                    if (job.status === 'complete') {
+                        resolve(job);
+                    } else if (job.status === 'failed') {
+                        reject(new Error(job.message || 'Job failed'));
+                    } else {
+                        if (onProgress) onProgress(job);
+                        setTimeout(poll, 1000);
+                    }
+                })
+                .catch(reject);
+        }
+        poll();
+    });
+}
+
 function loadFileDetails(fileId) {
     fetch(`/file_details/${fileId}`)
         .then(response => response.json())
@@ -0,0 +1,257 @@
+import os
+import uuid
+from functools import lru_cache
+from app import app
+
+# Where file data lives. Every stored object is named by a location string that
+# is kept in Blob.path and File.path: a filesystem path for local storage, or
+# s3://<bucket>/<key> for an S3-compatible object store. The driver is picked
+# from the location, so data written before a backend switch stays readable.
+
+S3_SCHEME = 's3://'
+
+class LocalStorage:
+    """Objects as files on the local filesystem"""
+    is_local = True
+    supports_multipart = False
+
+    def blob_location(self, digest):
+        from blobs import blob_path
+        return blob_path(digest)
+
+    def put(self, local_path, location):
+        """Move a finished local file to a location"""
+        os.makedirs(os.path.dirname(location), exist_ok=True)
+        os.replace(local_path, location)
+
+    def move(self, location, new_location):
+        self.put(location, new_location)
+
+    def copy(self, location, new_location):
+        """A second object with the same data; stored data is never modified, so a hard link will do"""
+        os.makedirs(os.path.dirname(new_location), exist_ok=True)
+        try:
+            os.link(location, new_location)
+        except FileExistsError:
+            pass
+
+    def delete(self, location):
+        if os.path.exists(location):
+            os.remove(location)
+
+    def exists(self, location):
+        return os.path.exists(location)
+
+    def size(self, location):
+        return os.path.getsize(location)
+
+    def read_range(self, location, start, stop, buffer_size=1024 * 1024):
+        """Yield the bytes in [start, stop) of an object"""
+        with open(location, 'rb') as f:
+            f.seek(start)
+            remaining = stop - start
+            while remaining > 0:
+                buf = f.read(min(buffer_size, remaining))
+                if not buf:
+                    break
+                remaining -= len(buf)
+                yield buf
+
+    def read_at(self, location, offset, length):
+        with open(location, 'rb') as f:
+            f.seek(offset)
+            return f.read(length)
+
+    def download_url(self, location, download_name):
+        return None
+
+class S3Storage:
+    """
+    Objects in an S3-compatible store (AWS S3, MinIO, moto...), through boto3
+    Large files move as parallel multipart transfers, and chunked uploads are
+    written straight to the store as the parts of a multipart upload, so the web
+    workers keep no upload state on disk.
+    """
+    is_local = False
+    supports_multipart = True
+    MIN_PART_SIZE = 5 * 1024 * 1024  # Every part but the last must be at least this big
+    MAX_PARTS = 10000
+
+    def __init__(self, bucket, prefix='', endpoint_url=None, region=None, concurrency=8):
+        try:
+            import boto3
+            from boto3.s3.transfer import TransferConfig
+        except ImportError:
+            raise RuntimeError("STORAGE_BACKEND=s3 needs boto3 (pip install boto3)")
+        if not bucket:
+            raise RuntimeError("STORAGE_BACKEND=s3 needs S3_BUCKET")
+        self.bucket = bucket
+        self.prefix = prefix
+        self.client = boto3.client('s3', endpoint_url=endpoint_url, region_name=region)
+        self.transfer_config = TransferConfig(multipart_threshold=64 * 1024 * 1024,
+                                              multipart_chunksize=64 * 1024 * 1024,
+                                              max_concurrency=concurrency)
+
+    def location(self, key):
+        return f"{S3_SCHEME}{self.bucket}/{self.prefix}{key}"
+
+    @staticmethod
+    def split(location):
+        """(bucket, key) of an s3:// location"""
+        bucket, key = location[len(S3_SCHEME):].split('/', 1)
+        return bucket, key
+
+    def blob_location(self, digest):
+        # Objects can't be renamed aside before deletion the way local blobs are,
+        # so each stored copy gets its own key; deleting a released copy can then
+        # never remove the data of an upload that stored the same contents again
+        algorithm, hexdigest = digest.split(':', 1)
+        return self.location(f"blobs/{hexdigest[:2]}/{hexdigest[2:4]}/{algorithm}_{hexdigest}.{uuid.uuid4().hex[:12]}")
+
+    def staging_location(self, upload_id):
+        """Where a chunked upload's multipart upload is assembled"""
+        return self.location(f"uploads/{upload_id}")
+
+    def put(self, local_path, location):
+        """Upload a finished local file, in parallel parts if it is large, and delete the local copy"""
+        bucket, key = self.split(location)
+        self.client.upload_file(local_path, bucket, key, Config=self.transfer_config)
+        os.remove(local_path)
+
+    def move(self, location, new_location):
+        """Server-side copy, in parallel parts if large, then delete the original"""
+        bucket, key = self.split(location)
+        new_bucket, new_key = self.split(new_location)
+        self.client.copy({'Bucket': bucket, 'Key': key}, new_bucket, new_key, Config=self.transfer_config)
+        self.client.delete_object(Bucket=bucket, Key=key)
+
+    def copy(self, location, new_location):
+        """Server-side copy, in parallel parts if large"""
+        bucket, key = self.split(location)
+        new_bucket, new_key = self.split(new_location)
+        self.client.copy({'Bucket': bucket, 'Key': key}, new_bucket, new_key, Config=self.transfer_config)
+
+    def delete(self, location):
+        bucket, key = self.split(location)
+        self.client.delete_object(Bucket=bucket, Key=key)
+
+    def exists(self, location):
+        from botocore.exceptions import ClientError
+        bucket, key = self.split(location)
+        try:
+            self.client.head_object(Bucket=bucket, Key=key)
+        except ClientError as e:
+            if e.response['Error']['Code'] in ('404', 'NoSuchKey', 'NotFound'):
+                return False
+            raise
+        return True
+
+    def size(self, location):
+        bucket, key = self.split(location)
+        return self.client.head_object(Bucket=bucket, Key=key)['ContentLength']
+
+    def read_range(self, location, start, stop, buffer_size=1024 * 1024):
+        if stop <= start:
+            return
+        bucket, key = self.split(location)
+        body = self.client.get_object(Bucket=bucket, Key=key, Range=f'bytes={start}-{stop - 1}')['Body']
+        try:
+            yield from body.iter_chunks(buffer_size)
+        finally:
+            body.close()
+
+    def read_at(self, location, offset, length):
+        bucket, key = self.split(location)
+        body = self.client.get_object(Bucket=bucket, Key=key, Range=f'bytes={offset}-{offset + length - 1}')['Body']
+        try:
+            return body.read()
+        finally:
+            body.close()
+
+    def download_url(self, location, download_name):
+        """A presigned URL the client can fetch the object from directly, ranges included"""
+        from urllib.parse import quote
+        bucket, key = self.split(location)
+        return self.client.generate_presigned_url('get_object', Params={
+            'Bucket': bucket,
+            'Key': key,
+            'ResponseContentDisposition': f"attachment; filename*=UTF-8''{quote(download_name)}"
+        }, ExpiresIn=app.config['S3_URL_EXPIRY'])
+
+    def create_multipart(self, location):
+        bucket, key = self.split(location)
+        return self.client.create_multipart_upload(Bucket=bucket, Key=key)['UploadId']
+
+    def upload_part(self, location, multipart_id, part_number, fileobj, length):
+        """
+        Store one part (numbered from 1); a part sent again replaces the earlier copy
+        Raises FileNotFoundError if the multipart upload was aborted, like a write
+        to a local upload whose file was removed.
+        """
+        from botocore.exceptions import ClientError
+        bucket, key = self.split(location)
+        try:
+            self.client.upload_part(Bucket=bucket, Key=key, UploadId=multipart_id, PartNumber=part_number,
+                                    Body=fileobj, ContentLength=length)
+        except ClientError as e:
+            if e.response['Error']['Code'] == 'NoSuchUpload':
+                raise FileNotFoundError(location)
+            raise
+
+    def uploaded_parts(self, location, multipart_id):
+        """{part number: ETag} of the parts stored so far"""
+        bucket, key = self.split(location)
+        parts = {}
+        paginator = self.client.get_paginator('list_parts')
+        for page in paginator.paginate(Bucket=bucket, Key=key, UploadId=multipart_id):
+            for part in page.get('Parts', []):
+                parts[part['PartNumber']] = part['ETag']
+        return parts
+
+    def complete_multipart(self, location, multipart_id, parts):
+        bucket, key = self.split(location)
+        self.client.complete_multipart_upload(Bucket=bucket, Key=key, UploadId=multipart_id, MultipartUpload={
+            'Parts': [{'PartNumber': number, 'ETag': etag} for number, etag in sorted(parts.items())]
+        })
+
+    def abort_multipart(self, location, multipart_id):
+        from botocore.exceptions import ClientError
+        bucket, key = self.split(location)
+        try:
+            self.client.abort_multipart_upload(Bucket=bucket, Key=key, UploadId=multipart_id)
+        except ClientError as e:
+            if e.response['Error']['Code'] != 'NoSuchUpload':
+                raise
+
+_local = LocalStorage()
+
+@lru_cache(maxsize=None)
+def _s3():
+    return S3Storage(app.config['S3_BUCKET'], app.config['S3_PREFIX'], app.config['S3_ENDPOINT_URL'],
+                     app.config['S3_REGION'], app.config['S3_TRANSFER_CONCURRENCY'])
+
+def get_storage():
+    """The backend new data is written to, per STORAGE_BACKEND"""
+    backend = app.config['STORAGE_BACKEND']
+    if backend == 'local':
+        return _local
+    if backend == 's3':
+        return _s3()
+    raise ValueError(f"Unknown STORAGE_BACKEND: {backend}")
+
+def storage_for(location):
+    """The backend holding the object at a location"""
+    if location.startswith(S3_SCHEME):
+        return _s3()
+    return _local
+
+def spool_stream(stream, fileobj, hasher=None, buffer_size=1024 * 1024):
+    """Copy a request stream into a seekable file to upload as a part; returns the byte count"""
+    written = 0
+    for buf in iter(lambda: stream.read(buffer_size), b''):
+        if hasher:
+            hasher.update(buf)
+        fileobj.write(buf)
+        written += len(buf)
+    fileobj.seek(0)
+    return written
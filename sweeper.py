@@ -0,0 +1,281 @@
+import os
+import time
+import random
+import shutil
+import logging
+import threading
+from datetime import datetime, timedelta
+from app import app, db, CHUNK_FOLDER, ARCHIVE_FOLDER, discard_chunked_upload_data
+from models import ChunkedUpload, File, Blob, Job
+from blobs import reclaim_blob
+from thumbnails import trim_cache
+from storage import S3_SCHEME
+from metrics import Counter
+
+# Reclaims storage nothing will use again: unfinished uploads nobody came back to,
+# old archives and jobs, and data whose record is gone after a crash. Every step
+# is a compare-and-swap on the database or tolerates the file being gone already,
+# so sweeps may run in every web worker and from the CLI at the same time.
+
+# Totals since this process started
+stats = {'sweeps': 0, 'reclaimed_bytes': 0, 'removed': 0}
+_stats_lock = threading.Lock()
+_started = False
+_started_lock = threading.Lock()
+
+reclaimed_bytes = Counter('filelock_storage_reclaimed_bytes_total', 'Bytes freed by the storage sweeper')
+
+BATCH_SIZE = 500
+
+def remove_path(path, older_than=None):
+    """
+    Delete a file or directory tree
+    :param older_than: only if its modification time is before this timestamp, checked right before removal
+    :return: the bytes freed, or None if it was gone or too recent
+    """
+    try:
+        info = os.stat(path)
+        if older_than is not None and info.st_mtime >= older_than:
+            return None
+        if os.path.isdir(path):
+            size = sum(os.path.getsize(os.path.join(root, name))
+                       for root, _, names in os.walk(path) for name in names)
+            shutil.rmtree(path, ignore_errors=True)
+            return size
+        os.remove(path)
+        return info.st_size
+    except FileNotFoundError:
+        return None
+
+def under_disk_pressure():
+    """Whether a storage filesystem is running out of free space"""
+    return any(shutil.disk_usage(folder).free < app.config['GC_PRESSURE_FREE_SPACE']
+               for folder in (app.config['UPLOAD_FOLDER'], CHUNK_FOLDER, ARCHIVE_FOLDER))
+
+def old_entries(directory, older_than):
+    """Entries of a directory last modified before a timestamp"""
+    try:
+        entries = list(os.scandir(directory))
+    except FileNotFoundError:
+        return []
+    old = []
+    for entry in entries:
+        try:
+            if entry.stat().st_mtime < older_than:
+                old.append(entry)
+        except FileNotFoundError:
+            pass
+    return old
+
+def blob_entries(older_than):
+    """Files in the blob store, sharded or not, last modified before a timestamp"""
+    found = []
+    for directory, _, _ in os.walk(app.config['BLOB_FOLDER']):
+        found.extend(entry for entry in old_entries(directory, older_than) if entry.is_file())
+    return found
+
+def batches(items):
+    for start in range(0, len(items), BATCH_SIZE):
+        yield items[start:start + BATCH_SIZE]
+
+def expire_uploads(ttl):
+    """Drop upload records idle for ttl seconds, with whatever data they left; returns (count, bytes)"""
+    cutoff = datetime.utcnow() - timedelta(seconds=ttl)
+    removed = freed = 0
+
+    # Unfinished uploads the client never came back to. The version check makes
+    # a chunk that arrives meanwhile keep the upload alive.
+    stale = ChunkedUpload.query.filter(ChunkedUpload.status == 'uploading', ChunkedUpload.updated_at < cutoff).all()
+    # Keep their paths around once the rows are gone
+    for chunked_upload in stale:
+        db.session.expunge(chunked_upload)
+    for chunked_upload in stale:
+        deleted = ChunkedUpload.query.filter_by(id=chunked_upload.id, status='uploading',
+                                                version=chunked_upload.version).delete(synchronize_session=False)
+        db.session.commit()
+        if deleted:
+            removed += 1
+            freed += discard_chunked_upload_data(chunked_upload)
+
+    # Assemblies whose job gave up without marking the upload failed
+    stuck = (ChunkedUpload.query
+             .outerjoin(Job, ChunkedUpload.job_id == Job.id)
+             .filter(ChunkedUpload.status == 'assembling', ChunkedUpload.updated_at < cutoff,
+                     db.or_(Job.id.is_(None), Job.status == 'failed'))
+             .all())
+    for chunked_upload in stuck:
+        failed = ChunkedUpload.query.filter_by(id=chunked_upload.id, status='assembling').update({
+            'status': 'failed'
+        }, synchronize_session=False)
+        db.session.commit()
+        if failed:
+            freed += discard_chunked_upload_data(chunked_upload)
+
+    # Finished uploads are only kept so clients can poll their outcome
+    removed += ChunkedUpload.query.filter(ChunkedUpload.status.in_(('complete', 'failed')),
+                                          ChunkedUpload.updated_at < cutoff).delete(synchronize_session=False)
+    db.session.commit()
+    return removed, freed
+
+def expire_archives(ttl):
+    """Delete archives, and archives left half-written, older than ttl seconds; returns (count, bytes)"""
+    older_than = time.time() - ttl
+    removed = freed = 0
+    for entry in old_entries(ARCHIVE_FOLDER, older_than):
+        size = remove_path(entry.path, older_than)
+        if size is not None:
+            removed += 1
+            freed += size
+    return removed, freed
+
+def expire_jobs(ttl):
+    """Delete finished jobs older than ttl seconds that no upload refers to; returns the count"""
+    cutoff = datetime.utcnow() - timedelta(seconds=ttl)
+    referenced = db.session.query(ChunkedUpload.job_id).filter(ChunkedUpload.job_id.isnot(None))
+    removed = Job.query.filter(Job.status.in_(('complete', 'failed')), Job.updated_at < cutoff,
+                               Job.id.notin_(referenced)).delete(synchronize_session=False)
+    db.session.commit()
+    return removed
+
+# Every column recording where stored data lives
+PATH_COLUMNS = (File.path, Blob.path, ChunkedUpload.target_path)
+
+def recorded_outside(root):
+    """A local path some record refers to that is not under root, or None"""
+    for column in PATH_COLUMNS:
+        # A full read of each table, which is fine for a periodic sweep
+        path = (db.session.query(column)
+                .filter(column.isnot(None), ~column.startswith(S3_SCHEME), ~column.startswith(root, autoescape=True))
+                .limit(1).scalar())
+        if path:
+            return path
+    return None
+
+def sweep_orphans(age):
+    """Delete data older than age seconds that no record refers to; returns (count, bytes)"""
+    older_than = time.time() - age
+    removed = freed = 0
+
+    def remove(path):
+        nonlocal removed, freed
+        size = remove_path(path, older_than)
+        if size is not None:
+            removed += 1
+            freed += size
+
+    # Chunk directories of uploads that are gone, and chunk writes cut short
+    live = {upload_id for (upload_id,) in db.session.query(ChunkedUpload.id)
+            .filter(ChunkedUpload.status.in_(('uploading', 'assembling')))}
+    for entry in os.scandir(CHUNK_FOLDER):
+        if entry.name not in live:
+            remove(entry.path)
+        elif entry.is_dir():
+            for chunk in old_entries(entry.path, older_than):
+                if chunk.name.endswith('.tmp'):
+                    remove(chunk.path)
+
+    # Upload files no File, blob or upload refers to: streamed uploads and assemblies
+    # that never got their record. Paths are matched exactly, so this is skipped if
+    # any local data is recorded under another directory (the app was moved).
+    upload_prefix = os.path.join(app.config['UPLOAD_FOLDER'], '')
+    outside = recorded_outside(upload_prefix)
+    if outside:
+        logging.warning(f"{outside} is recorded outside {upload_prefix}, not sweeping it for orphans")
+        candidates = []
+    else:
+        candidates = [entry.path for entry in old_entries(app.config['UPLOAD_FOLDER'], older_than) if entry.is_file()]
+    for batch in batches(candidates):
+        used = set()
+        for column in PATH_COLUMNS:
+            used.update(path for (path,) in db.session.query(column).filter(column.in_(batch)))
+        for path in batch:
+            if path not in used:
+                remove(path)
+
+    # Blob data without a row, and data set aside by a release that never finished
+    blobs = {}
+    for entry in blob_entries(older_than):
+        if entry.name.endswith('.deleted'):
+            remove(entry.path)
+        elif '_' in entry.name:
+            algorithm, hexdigest = entry.name.split('_', 1)
+            blobs[f"{algorithm}:{hexdigest}"] = entry.path
+    digests = list(blobs)
+    for batch in batches(digests):
+        known = {digest for (digest,) in db.session.query(Blob.digest).filter(Blob.digest.in_(batch))}
+        for digest in batch:
+            if digest not in known:
+                remove(blobs[digest])
+
+    # Blobs whose last reference went away without the data being reclaimed
+    unreferenced = db.session.query(Blob.digest).filter(
+        Blob.ref_count <= 0, Blob.created_at < datetime.utcnow() - timedelta(seconds=age)).all()
+    for (digest,) in unreferenced:
+        size = reclaim_blob(digest)
+        if size:
+            removed += 1
+            freed += size
+
+    return removed, freed
+
+def sweep():
+    """Run every sweep once; returns what was reclaimed"""
+    pressure = under_disk_pressure()
+    upload_ttl = app.config['UPLOAD_TTL']
+    archive_ttl = app.config['ARCHIVE_TTL']
+    if pressure:
+        upload_ttl = min(upload_ttl, app.config['GC_PRESSURE_TTL'])
+        archive_ttl = min(archive_ttl, app.config['GC_PRESSURE_TTL'])
+
+    uploads, upload_bytes = expire_uploads(upload_ttl)
+    archives, archive_bytes = expire_archives(archive_ttl)
+    jobs = expire_jobs(app.config['JOB_TTL'])
+    orphans, orphan_bytes = sweep_orphans(app.config['ORPHAN_AGE'])
+    # Every worker adds thumbnails, so the cache is also kept in bounds here
+    thumbnails, thumbnail_bytes = trim_cache()
+
+    result = {
+        'disk_pressure': pressure,
+        'uploads': uploads,
+        'archives': archives,
+        'jobs': jobs,
+        'orphans': orphans,
+        'thumbnails': thumbnails,
+        'reclaimed_bytes': upload_bytes + archive_bytes + orphan_bytes + thumbnail_bytes
+    }
+    with _stats_lock:
+        stats['sweeps'] += 1
+        stats['reclaimed_bytes'] += result['reclaimed_bytes']
+        stats['removed'] += uploads + archives + orphans + thumbnails
+    reclaimed_bytes.inc(result['reclaimed_bytes'])
+    if result['reclaimed_bytes'] or pressure:
+        logging.info(f"Storage sweep: {result}")
+    return result
+
+def _sweep_loop():
+    while True:
+        pressure = False
+        try:
+            with app.app_context():
+                pressure = sweep()['disk_pressure']
+        except Exception:
+            logging.exception("Storage sweep failed")
+        interval = app.config['GC_PRESSURE_INTERVAL'] if pressure else app.config['GC_INTERVAL']
+        # Spread the workers' sweeps out
+        time.sleep(interval * random.uniform(0.75, 1.25))
+
+def start_sweeper():
+    """Start this worker's sweeper thread, once"""
+    global _started
+    if _started or app.config['GC_INTERVAL'] == 0:
+        return
+    with _started_lock:
+        if _started:
+            return
+        _started = True
+        threading.Thread(target=_sweep_loop, name='storage-sweeper', daemon=True).start()
+
+@app.before_request
+def ensure_sweeper():
+    # Started lazily, like the job runner, so CLI commands don't start it
+    start_sweeper()
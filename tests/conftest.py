@@ -0,0 +1,114 @@
+import io
+import os
+import sys
+import shutil
+import hashlib
+import tempfile
+
+import pytest
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# app.py creates its storage directories under the working directory and reads its
+# settings from the environment when it is imported, so both are set up first. Jobs
+# and thumbnails run inline, and nothing sweeps storage behind the tests' back.
+WORK_DIR = tempfile.mkdtemp(prefix='filelock_tests_')
+os.chdir(WORK_DIR)
+os.environ['DATABASE_URL'] = 'sqlite:///' + os.path.join(WORK_DIR, 'test.db')
+os.environ['GC_INTERVAL'] = '0'
+os.environ['JOB_WORKERS'] = '0'
+os.environ['THUMBNAIL_WORKERS'] = '0'
+os.environ['MIN_FREE_SPACE'] = '0'
+os.environ['LOG_LEVEL'] = 'warning'
+sys.path.insert(0, ROOT_DIR)
+
+from app import app as flask_app, db, CHUNK_FOLDER  # noqa: E402
+from models import User, Folder  # noqa: E402
+
+DEFAULT_CONFIG = dict(flask_app.config)
+
+
+@pytest.fixture
+def app():
+    """The app with an empty database and empty storage, inside an app context"""
+    flask_app.config.update(DEFAULT_CONFIG, TESTING=True, WTF_CSRF_ENABLED=False)
+    for folder in (flask_app.config['UPLOAD_FOLDER'], CHUNK_FOLDER):
+        shutil.rmtree(folder, ignore_errors=True)
+    os.makedirs(flask_app.config['BLOB_FOLDER'])
+    os.makedirs(CHUNK_FOLDER)
+
+    with flask_app.app_context():
+        db.drop_all()
+        db.create_all()
+        yield flask_app
+        db.session.remove()
+
+
+@pytest.fixture
+def user(app):
+    """A user with a root folder; returns (user id, root folder id)"""
+    account = User(username='alice', email='alice@example.com')
+    account.set_password('correct horse battery')
+    db.session.add(account)
+    db.session.commit()
+    root = Folder(name='Root', user_id=account.id, is_visible=True)
+    db.session.add(root)
+    db.session.commit()
+    return account.id, root.id
+
+
+@pytest.fixture
+def client(app, user):
+    """A test client logged in as the user"""
+    test_client = app.test_client()
+    with test_client.session_transaction() as sess:
+        sess['_user_id'] = str(user[0])
+        sess['_fresh'] = True
+        sess['user_id'] = user[0]
+        sess['has_key'] = True
+    return test_client
+
+
+@pytest.fixture
+def root_id(user):
+    return user[1]
+
+
+def sha256(data):
+    return 'sha256:' + hashlib.sha256(data).hexdigest()
+
+
+def upload(client, folder_id, name, data):
+    """Upload a file through /upload; returns the response"""
+    return client.post('/upload', data={'folder_id': folder_id, 'file': (io.BytesIO(data), name)},
+                       content_type='multipart/form-data')
+
+
+def init_upload(client, folder_id, name, size, chunk_size):
+    """Start a chunked upload; returns the response"""
+    return client.post('/api/upload/init', data={
+        'folder_id': folder_id,
+        'filename': name,
+        'total_size': size,
+        'total_chunks': max(1, -(-size // chunk_size)),
+        'chunk_size': chunk_size
+    })
+
+
+def send_chunk(client, upload_id, chunk_number, data, checksum=None):
+    """Send one chunk as a raw body; returns the response"""
+    headers = {'X-Chunk-Checksum': checksum} if checksum else {}
+    return client.post(f'/api/upload/chunk/{upload_id}', query_string={'chunk_number': chunk_number},
+                       data=data, content_type='application/octet-stream', headers=headers)
+
+
+def chunked_upload(client, folder_id, name, data, chunk_size, order=None):
+    """Upload data in chunks, in the given chunk order; returns the last chunk's response"""
+    upload_id = init_upload(client, folder_id, name, len(data), chunk_size).get_json()['upload_id']
+    chunks = [data[i:i + chunk_size] for i in range(0, len(data), chunk_size)] or [b'']
+    response = None
+    for chunk_number in order or range(len(chunks)):
+        chunk = chunks[chunk_number]
+        response = send_chunk(client, upload_id, chunk_number, chunk, sha256(chunk))
+        assert response.status_code == 200, response.get_json()
+    return response
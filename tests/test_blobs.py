@@ -0,0 +1,145 @@
+import os
+
+import blobs
+from app import db
+from models import Blob, File, Folder
+from blobs import store_blob, reclaim_blob, rekey_blob, blob_path
+from sweeper import sweep_orphans
+from conftest import sha256, upload, chunked_upload
+
+
+def stored_files(app):
+    return sorted(name for _, _, names in os.walk(app.config['BLOB_FOLDER']) for name in names)
+
+
+def test_identical_uploads_share_one_blob(app, client, root_id):
+    data = os.urandom(5000)
+    upload(client, root_id, 'a.bin', data)
+    upload(client, root_id, 'b.bin', data)
+
+    blob = Blob.query.one()
+    assert blob.digest == sha256(data)
+    assert blob.ref_count == 2
+    assert {file.path for file in File.query} == {blob.path}
+    assert stored_files(app) == [os.path.basename(blob_path(blob.digest))]
+
+
+def test_deleting_the_last_file_reclaims_the_blob(app, client, root_id):
+    data = os.urandom(5000)
+    upload(client, root_id, 'a.bin', data)
+    upload(client, root_id, 'b.bin', data)
+    first, second = File.query.order_by(File.id).all()
+
+    assert client.post(f'/delete_file/{first.id}').status_code == 302
+    assert Blob.query.one().ref_count == 1
+    assert os.path.exists(second.path)
+
+    assert client.post(f'/delete_file/{second.id}').status_code == 302
+    assert Blob.query.count() == 0
+    assert stored_files(app) == []
+
+
+def test_deleting_a_folder_releases_its_files(app, client, root_id):
+    data = os.urandom(5000)
+    upload(client, root_id, 'keep.bin', data)
+    folder = Folder(name='Photos', user_id=db.session.get(Folder, root_id).user_id, parent_id=root_id)
+    db.session.add(folder)
+    db.session.commit()
+    upload(client, folder.id, 'copy.bin', data)
+    upload(client, folder.id, 'other.bin', os.urandom(5000))
+
+    assert client.post(f'/delete_folder/{folder.id}').status_code == 302
+    blob = Blob.query.one()
+    assert blob.digest == sha256(data) and blob.ref_count == 1
+    assert stored_files(app) == [os.path.basename(blob.path)]
+
+
+def test_reclaim_leaves_referenced_blobs_alone(app, client, root_id):
+    upload(client, root_id, 'a.bin', os.urandom(100))
+    blob = Blob.query.one()
+    assert reclaim_blob(blob.digest) == 0
+    assert os.path.exists(blob.path)
+
+
+def test_lost_insert_race_keeps_the_callers_pending_changes(app, user, monkeypatch, tmp_path):
+    user_id, root_id = user
+    data = os.urandom(100)
+    digest = sha256(data)
+    winner = tmp_path / 'winner'
+    winner.write_bytes(data)
+    store_blob(str(winner), digest, len(data))
+
+    # Our lookup misses the blob the other upload is committing
+    acquire = blobs.acquire_blob
+    misses = []
+
+    def acquire_blob(d):
+        if not misses:
+            misses.append(d)
+            return None
+        return acquire(d)
+
+    monkeypatch.setattr(blobs, 'acquire_blob', acquire_blob)
+    db.session.add(File(name='pending.bin', path='pending', size=1, stored_size=1, file_type='bin', folder_id=root_id,
+                        user_id=user_id))
+    loser = tmp_path / 'loser'
+    loser.write_bytes(data)
+    blob = store_blob(str(loser), digest, len(data))
+    db.session.commit()
+
+    assert blob.ref_count == 2
+    assert File.query.filter_by(name='pending.bin').count() == 1
+    assert not loser.exists()
+
+
+def test_chunked_uploads_are_rekeyed_onto_existing_contents(app, client, root_id):
+    data = os.urandom(3000)
+    upload(client, root_id, 'whole.bin', data)
+    response = chunked_upload(client, root_id, 'chunked.bin', data, 1000)
+
+    file = db.session.get(File, response.get_json()['file_id'])
+    assert file.checksum == sha256(data)
+    assert file.chunk_digest.startswith('sha256-chunks:')
+    assert db.session.get(Blob, sha256(data)).ref_count == 2
+    # The chunk-keyed copy is left for the sweeper
+    old = db.session.get(Blob, file.chunk_digest)
+    assert old.ref_count == 0
+    sweep_orphans(0)
+    assert db.session.get(Blob, file.chunk_digest) is None
+    assert stored_files(app) == [os.path.basename(blob_path(sha256(data)))]
+
+
+def test_rekey_blob_switches_every_file(app, user, tmp_path):
+    user_id, root_id = user
+    data = os.urandom(2000)
+    old = 'sha256-chunks:' + 'ab' * 32
+    source = tmp_path / 'data'
+    source.write_bytes(data)
+    blob = store_blob(str(source), old, len(data))
+    for name in ('a.bin', 'b.bin'):
+        db.session.add(File(name=name, path=blob.path, size=len(data), file_type='bin', folder_id=root_id,
+                            user_id=user_id, checksum=old, stored_size=len(data)))
+    Blob.query.filter_by(digest=old).update({'ref_count': 2})
+    db.session.commit()
+
+    assert rekey_blob(old) == (sha256(data), 2)
+    assert db.session.get(Blob, old).ref_count == 0
+    new = db.session.get(Blob, sha256(data))
+    assert new.ref_count == 2
+    assert {(file.checksum, file.chunk_digest, file.path) for file in File.query} == {(new.digest, old, new.path)}
+    with open(new.path, 'rb') as f:
+        assert f.read() == data
+
+    assert reclaim_blob(old) == len(data)
+    assert db.session.get(Blob, old) is None
+    assert rekey_blob(old) is None
+
+
+def test_compressible_data_is_stored_compressed(app, client, root_id):
+    data = b'the same line over and over\n' * 2000
+    upload(client, root_id, 'notes.txt', data)
+
+    blob = Blob.query.one()
+    assert blob.compressed and blob.stored_size < blob.size == len(data)
+    file = File.query.one()
+    assert client.get(f'/download/{file.id}').get_data() == data
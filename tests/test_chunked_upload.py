@@ -0,0 +1,168 @@
+import os
+
+import pytest
+from sqlalchemy.orm import Session
+
+import app as app_module
+from app import db, mark_chunk_received
+from models import ChunkedUpload, File, Blob
+from conftest import sha256, init_upload, send_chunk, chunked_upload
+
+
+def download(client, file_id):
+    response = client.get(f'/download/{file_id}')
+    assert response.status_code == 200
+    return response.get_data()
+
+
+@pytest.mark.parametrize('fields, message', [
+    ({'chunk_size': None}, 'Missing required parameters'),
+    ({'total_chunks': 3}, 'Invalid size parameters'),
+    ({'total_chunks': 5}, 'Invalid size parameters'),
+    ({'chunk_size': 0, 'total_chunks': 1}, 'Invalid size parameters'),
+    ({'total_size': -1, 'total_chunks': 1}, 'Invalid size parameters'),
+    ({'total_size': 'lots'}, 'Invalid size parameters'),
+])
+def test_init_rejects_inconsistent_layouts(client, root_id, fields, message):
+    form = {'folder_id': root_id, 'filename': 'a.bin', 'total_size': 1000, 'total_chunks': 4, 'chunk_size': 256}
+    form.update(fields)
+    response = client.post('/api/upload/init', data={k: v for k, v in form.items() if v is not None})
+    assert response.status_code == 400
+    assert response.get_json()['message'] == message
+    assert ChunkedUpload.query.count() == 0
+
+
+def test_init_caps_the_number_of_chunks(app, client, root_id):
+    app.config['MAX_UPLOAD_CHUNKS'] = 8
+    assert init_upload(client, root_id, 'a.bin', 9, 1).status_code == 400
+    assert init_upload(client, root_id, 'a.bin', 8, 1).status_code == 200
+
+
+@pytest.mark.parametrize('mode', ['preallocate', 'chunks'])
+def test_chunks_out_of_order_assemble_the_file(app, client, root_id, mode):
+    app.config['CHUNKED_UPLOAD_MODE'] = mode
+    data = os.urandom(10 * 1000 + 123)
+
+    response = chunked_upload(client, root_id, 'big.bin', data, 1000, order=[3, 0, 10, 7, 1, 2, 9, 4, 5, 8, 6])
+
+    result = response.get_json()
+    assert result['success'] and result['message'] == 'File upload complete'
+    assert download(client, result['file_id']) == data
+    # Uploads written in place are re-keyed to the SHA-256 of their contents
+    file = db.session.get(File, result['file_id'])
+    assert file.checksum == sha256(data)
+    assert [blob.digest for blob in Blob.query.filter(Blob.ref_count > 0)] == [sha256(data)]
+    assert ChunkedUpload.query.one().status == 'complete'
+    assert not os.listdir(app_module.CHUNK_FOLDER)
+
+
+def test_empty_file(client, root_id):
+    response = chunked_upload(client, root_id, 'empty.txt', b'', 1024)
+    assert download(client, response.get_json()['file_id']) == b''
+
+
+def test_status_reports_missing_ranges(client, root_id):
+    upload_id = init_upload(client, root_id, 'a.bin', 10 * 100, 100).get_json()['upload_id']
+    for chunk_number in (0, 1, 4, 9):
+        assert send_chunk(client, upload_id, chunk_number, os.urandom(100)).status_code == 200
+
+    status = client.get(f'/api/upload/status/{upload_id}').get_json()['upload']
+    assert status['status'] == 'uploading'
+    assert status['received_chunks'] == 4
+    assert status['missing_ranges'] == [[2, 3], [5, 8]]
+
+
+def test_duplicate_chunk_is_counted_once(client, root_id):
+    upload_id = init_upload(client, root_id, 'a.bin', 300, 100).get_json()['upload_id']
+    chunk = os.urandom(100)
+    assert send_chunk(client, upload_id, 1, chunk).get_json()['received_chunks'] == 1
+    response = send_chunk(client, upload_id, 1, chunk).get_json()
+    assert response['message'] == 'Chunk 1 already received'
+    assert response['received_chunks'] == 1
+
+
+def test_checksum_mismatch_leaves_the_chunk_missing(client, root_id):
+    upload_id = init_upload(client, root_id, 'a.bin', 200, 100).get_json()['upload_id']
+    chunk = os.urandom(100)
+
+    response = send_chunk(client, upload_id, 0, chunk, checksum=sha256(b'something else'))
+    assert response.status_code == 400
+    assert response.get_json()['retry'] is True
+    assert db.session.get(ChunkedUpload, upload_id).missing_ranges() == [[0, 1]]
+
+    assert send_chunk(client, upload_id, 0, chunk, checksum=sha256(chunk)).status_code == 200
+
+
+def test_chunk_of_the_wrong_length_is_rejected(client, root_id):
+    upload_id = init_upload(client, root_id, 'a.bin', 200, 100).get_json()['upload_id']
+    response = send_chunk(client, upload_id, 0, os.urandom(99))
+    assert response.status_code == 400
+    assert response.get_json()['retry'] is True
+
+
+def test_invalid_chunk_numbers(client, root_id):
+    upload_id = init_upload(client, root_id, 'a.bin', 200, 100).get_json()['upload_id']
+    assert send_chunk(client, upload_id, 2, os.urandom(100)).status_code == 400
+    assert send_chunk(client, upload_id, 'x', os.urandom(100)).status_code == 400
+
+
+def test_mark_chunk_received_retries_a_lost_compare_and_swap(client, root_id, monkeypatch):
+    upload_id = init_upload(client, root_id, 'a.bin', 300, 100).get_json()['upload_id']
+    original = ChunkedUpload.bitmap_with
+    interleaved = []
+
+    def bitmap_with(self, chunk_number):
+        # Another worker records chunk 2 between our read and our update
+        if not interleaved:
+            interleaved.append(chunk_number)
+            with Session(db.engine) as other:
+                chunked = other.get(ChunkedUpload, upload_id)
+                chunked.received = chunked.bitmap_with(2)
+                chunked.chunk_digests = chunked.digests_with(2, b'\x02' * 32)
+                chunked.received_count += 1
+                chunked.version += 1
+                other.commit()
+        return original(self, chunk_number)
+
+    monkeypatch.setattr(ChunkedUpload, 'bitmap_with', bitmap_with)
+    chunked, set_bit = mark_chunk_received(upload_id, 0, b'\x01' * 32)
+
+    assert set_bit
+    assert chunked.received_count == 2
+    assert chunked.version == 2
+    assert chunked.missing_ranges() == [[1, 1]]
+    assert chunked.chunk_digest(0) == b'\x01' * 32
+    assert chunked.chunk_digest(2) == b'\x02' * 32
+
+    again, set_bit = mark_chunk_received(upload_id, 0, b'\x01' * 32)
+    assert not set_bit
+    assert again.version == 2
+
+
+def test_resent_last_chunk_finishes_a_stalled_upload(client, root_id, monkeypatch):
+    data = os.urandom(200)
+    upload_id = init_upload(client, root_id, 'a.bin', 200, 100).get_json()['upload_id']
+    assert send_chunk(client, upload_id, 0, data[:100]).status_code == 200
+
+    # The worker storing the last chunk stops before it queues the assembly
+    monkeypatch.setattr(app_module, 'start_assembly', lambda chunked_upload: None)
+    send_chunk(client, upload_id, 1, data[100:])
+    assert db.session.get(ChunkedUpload, upload_id).status == 'uploading'
+    monkeypatch.undo()
+
+    result = send_chunk(client, upload_id, 1, data[100:]).get_json()
+    assert result['message'] == 'File upload complete'
+    assert download(client, result['file_id']) == data
+
+
+@pytest.mark.parametrize('mode', ['preallocate', 'chunks'])
+def test_cancel_discards_partial_data(app, client, root_id, mode):
+    app.config['CHUNKED_UPLOAD_MODE'] = mode
+    upload_id = init_upload(client, root_id, 'a.bin', 200, 100).get_json()['upload_id']
+    send_chunk(client, upload_id, 0, os.urandom(100))
+
+    assert client.delete(f'/api/upload/{upload_id}').status_code == 200
+    assert ChunkedUpload.query.count() == 0
+    assert not os.listdir(app_module.CHUNK_FOLDER)
+    assert not [name for name in os.listdir(app.config['UPLOAD_FOLDER']) if name.endswith('.part')]
+    assert send_chunk(client, upload_id, 1, os.urandom(100)).status_code == 400
@@ -0,0 +1,127 @@
+import os
+
+import pytest
+from werkzeug.wsgi import FileWrapper
+
+from app import wrap_file_range
+from models import File
+from utils import parse_byte_ranges
+from conftest import upload
+
+
+@pytest.fixture
+def stored(client, root_id):
+    """A file stored as is; returns (file id, data)"""
+    data = os.urandom(10000)
+    upload(client, root_id, 'data.bin', data)
+    return File.query.one().id, data
+
+
+@pytest.fixture
+def compressed(client, root_id):
+    """A file stored compressed; returns (file id, data)"""
+    data = b''.join(b'line %d of the log\n' % i for i in range(5000))
+    upload(client, root_id, 'log.txt', data)
+    file = File.query.one()
+    assert file.compressed
+    return file.id, data
+
+
+def byteranges(response):
+    """The (Content-Range, data) parts of a multipart/byteranges response"""
+    boundary = response.mimetype_params['boundary'].encode()
+    body = response.get_data()
+    assert body.startswith(b'--' + boundary + b'\r\n')
+    assert body.endswith(b'\r\n--' + boundary + b'--\r\n')
+    parts = []
+    for part in body[len(boundary) + 4:-len(boundary) - 8].split(b'\r\n--' + boundary + b'\r\n'):
+        head, _, data = part.partition(b'\r\n\r\n')
+        headers = dict(line.split(': ', 1) for line in head.decode().split('\r\n'))
+        parts.append((headers['Content-Range'], data))
+    return parts
+
+
+@pytest.mark.parametrize('header, ranges', [
+    ('bytes=0-99', [(0, 100)]),
+    ('bytes=9900-', [(9900, 10000)]),
+    ('bytes=-500', [(9500, 10000)]),
+    ('bytes=9990-20000', [(9990, 10000)]),
+    ('bytes=0-0, 5-9', [(0, 1), (5, 10)]),
+    ('bytes=10000-', []),
+    ('bytes=-0', []),
+    ('bytes=5-4', None),
+    ('bytes=a-b', None),
+    ('items=0-1', None),
+])
+def test_parse_byte_ranges(header, ranges):
+    assert parse_byte_ranges(header, 10000) == ranges
+
+
+def test_too_many_ranges_are_ignored():
+    assert parse_byte_ranges('bytes=' + ','.join(f'{i}-{i}' for i in range(33)), 10000) is None
+
+
+def test_whole_file(client, stored):
+    file_id, data = stored
+    response = client.get(f'/download/{file_id}')
+    assert response.status_code == 200
+    assert response.headers['Accept-Ranges'] == 'bytes'
+    assert response.get_data() == data
+
+
+@pytest.mark.parametrize('fixture', ['stored', 'compressed'])
+def test_single_range(client, fixture, request):
+    file_id, data = request.getfixturevalue(fixture)
+    response = client.get(f'/download/{file_id}', headers={'Range': 'bytes=1000-2999'})
+    assert response.status_code == 206
+    assert response.headers['Content-Range'] == f'bytes 1000-2999/{len(data)}'
+    assert response.headers['Content-Length'] == '2000'
+    assert response.get_data() == data[1000:3000]
+
+
+@pytest.mark.parametrize('fixture', ['stored', 'compressed'])
+def test_multiple_ranges(client, fixture, request):
+    file_id, data = request.getfixturevalue(fixture)
+    response = client.get(f'/download/{file_id}', headers={'Range': 'bytes=0-9, 5000-5099, -10'})
+    assert response.status_code == 206
+    assert response.mimetype == 'multipart/byteranges'
+    assert int(response.headers['Content-Length']) == len(response.get_data())
+    assert byteranges(response) == [
+        (f'bytes 0-9/{len(data)}', data[:10]),
+        (f'bytes 5000-5099/{len(data)}', data[5000:5100]),
+        (f'bytes {len(data) - 10}-{len(data) - 1}/{len(data)}', data[-10:]),
+    ]
+
+
+def test_unsatisfiable_range(client, stored):
+    file_id, data = stored
+    response = client.get(f'/download/{file_id}', headers={'Range': f'bytes={len(data)}-'})
+    assert response.status_code == 416
+    assert response.headers['Content-Range'] == f'bytes */{len(data)}'
+
+
+def test_if_range(client, stored):
+    file_id, data = stored
+    full = client.get(f'/download/{file_id}')
+    etag, last_modified = full.headers['ETag'], full.headers['Last-Modified']
+
+    for validator in (etag, last_modified):
+        response = client.get(f'/download/{file_id}', headers={'Range': 'bytes=0-9', 'If-Range': validator})
+        assert response.status_code == 206
+        assert response.get_data() == data[:10]
+
+    # The client's copy is out of date: it gets the whole file instead
+    for validator in ('"stale"', 'Thu, 01 Jan 2015 00:00:00 GMT'):
+        response = client.get(f'/download/{file_id}', headers={'Range': 'bytes=0-9', 'If-Range': validator})
+        assert response.status_code == 200
+        assert response.get_data() == data
+
+
+def test_file_range_stops_at_the_end_of_the_range(app, tmp_path):
+    path = tmp_path / 'data'
+    path.write_bytes(bytes(range(256)) * 4)
+    with app.test_request_context(environ_overrides={'wsgi.file_wrapper': FileWrapper}):
+        body = wrap_file_range(str(path), 10, 20)
+        assert body.file.tell() == 10
+        assert b''.join(body) == bytes(range(10, 20))
+        body.close()
@@ -0,0 +1,111 @@
+import os
+from datetime import datetime, timedelta
+
+import pytest
+
+from app import db
+from models import File, Folder
+from conftest import upload, chunked_upload
+
+
+@pytest.fixture
+def files(user):
+    """Files with repeated names, sizes, types and dates, so every order has ties to break"""
+    user_id, root_id = user
+    created = datetime(2024, 1, 1)
+    db.session.add_all(File(
+        name=f'file_{i % 7}.{("jpg", "txt", "pdf")[i % 3]}', path=f'missing/{i}', size=(i * 37) % 11,
+        stored_size=(i * 37) % 11, file_type=('jpg', 'txt', 'pdf')[i % 3], folder_id=root_id, user_id=user_id,
+        created_at=created + timedelta(hours=i % 5)
+    ) for i in range(40))
+    db.session.commit()
+    return root_id
+
+
+def listing(client, folder_id, **query):
+    response = client.get(f'/api/folder/{folder_id}/files', query_string=query)
+    assert response.status_code == 200
+    return response.get_json()
+
+
+@pytest.mark.parametrize('order', ['asc', 'desc'])
+@pytest.mark.parametrize('sort', sorted(File.SORT_KEYS))
+def test_cursor_pages_cover_every_file_once_in_order(client, files, sort, order):
+    column = File.SORT_KEYS[sort]
+    expected = sorted(File.query.filter_by(folder_id=files), key=lambda file: (getattr(file, column), file.id),
+                      reverse=order == 'desc')
+
+    seen = []
+    cursor = None
+    while True:
+        query = {'sort': sort, 'order': order, 'limit': 6}
+        if cursor:
+            query['cursor'] = cursor
+        page = listing(client, files, **query)
+        assert len(page['files']) <= 6
+        seen.extend(file['id'] for file in page['files'])
+        cursor = page['next_cursor']
+        if not cursor:
+            break
+
+    assert seen == [file.id for file in expected]
+
+
+def test_exact_last_page_has_no_cursor(client, files):
+    page = listing(client, files, limit=40)
+    assert len(page['files']) == 40
+    assert page['next_cursor'] is None
+
+
+@pytest.mark.parametrize('query', [{'sort': 'owner'}, {'order': 'sideways'}, {'cursor': 'not-a-cursor'},
+                                   {'sort': 'size', 'cursor': 'WyJhIiwgMV0'}])
+def test_invalid_listing_requests(client, files, query):
+    assert client.get(f'/api/folder/{files}/files', query_string=query).status_code == 400
+
+
+def test_listing_requires_login(app, files):
+    assert app.test_client().get(f'/api/folder/{files}/files').status_code in (302, 401)
+
+
+def test_folder_totals_follow_uploads_and_deletes(client, user):
+    user_id, root_id = user
+    photos = Folder(name='Photos', user_id=user_id, parent_id=root_id)
+    db.session.add(photos)
+    db.session.commit()
+    trip = Folder(name='Trip', user_id=user_id, parent_id=photos.id)
+    db.session.add(trip)
+    db.session.commit()
+
+    upload(client, root_id, 'a.bin', os.urandom(100))
+    upload(client, photos.id, 'b.bin', os.urandom(200))
+    upload(client, trip.id, 'c.bin', os.urandom(300))
+    chunked_upload(client, trip.id, 'd.bin', os.urandom(2500), 1000)
+
+    def totals(folder_id):
+        folder = db.session.get(Folder, folder_id, populate_existing=True)
+        return folder.file_count, folder.total_size, folder.tree_file_count, folder.tree_size
+
+    assert totals(root_id) == (1, 100, 4, 3100)
+    assert totals(photos.id) == (1, 200, 3, 3000)
+    assert totals(trip.id) == (2, 2800, 2, 2800)
+
+    file = File.query.filter_by(name='c.bin').one()
+    client.post(f'/delete_file/{file.id}')
+    assert totals(trip.id) == (1, 2500, 1, 2500)
+    assert totals(root_id) == (1, 100, 3, 2800)
+
+    client.post(f'/delete_folder/{photos.id}')
+    assert totals(root_id) == (1, 100, 1, 100)
+    assert Folder.rebuild_totals() == 0
+
+
+def test_rebuild_totals_repairs_drift(client, user):
+    user_id, root_id = user
+    upload(client, root_id, 'a.bin', os.urandom(100))
+    Folder.query.filter_by(id=root_id).update({'file_count': 5, 'tree_size': 1})
+    db.session.commit()
+
+    assert Folder.rebuild_totals() == 1
+    root = db.session.get(Folder, root_id, populate_existing=True)
+    assert (root.file_count, root.total_size, root.tree_file_count, root.tree_size) == (1, 100, 1, 100)
+    assert Folder.rebuild_totals() == 0
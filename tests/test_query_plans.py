@@ -0,0 +1,22 @@
+import jobs
+import app as app_module
+from benchmarks.query_plans import seed, exercise_hot_paths, sequential_scans, format_plan
+
+
+def test_hot_queries_use_indexes(app, monkeypatch):
+    """The check from benchmarks/query_plans.py, on a data set small enough for every run"""
+    # Jobs are left queued as if for a worker pool; only the requests are checked
+    app.config['JOB_WORKERS'] = 1
+    monkeypatch.setattr(jobs, 'start_job_runner', lambda: None)
+    monkeypatch.setattr(app_module, 'start_job_runner', lambda: None)
+    monkeypatch.setattr(jobs, '_submit', lambda job_id: None)
+
+    user_id, root_id, leaf_id = seed(users=10, folders=20, files=10)
+    statements, suspects = exercise_hot_paths(user_id, root_id, leaf_id)
+    checked, plans = sequential_scans(statements)
+
+    assert checked > 20
+    scans = [format_plan(statement, plan, scanned) for statement, plan, scanned in plans if scanned]
+    assert not scans, '\n\n'.join(scans)
+    repeated = [f'{url}\n{profile.report()}' for url, profile in suspects]
+    assert not repeated, '\n\n'.join(repeated)
@@ -0,0 +1,105 @@
+import os
+
+import pytest
+
+moto = pytest.importorskip('moto')
+boto3 = pytest.importorskip('boto3')
+
+import storage  # noqa: E402
+from app import db, CHUNK_FOLDER  # noqa: E402
+from models import Blob, File, ChunkedUpload  # noqa: E402
+from storage import S3Storage  # noqa: E402
+from sweeper import sweep_orphans  # noqa: E402
+from conftest import sha256, upload, init_upload, send_chunk, chunked_upload  # noqa: E402
+
+BUCKET = 'filelock-test'
+
+
+@pytest.fixture
+def s3(app, monkeypatch):
+    """New data goes to a mocked S3 bucket; returns a boto3 client for it"""
+    for name, value in (('AWS_ACCESS_KEY_ID', 'testing'), ('AWS_SECRET_ACCESS_KEY', 'testing'),
+                        ('AWS_DEFAULT_REGION', 'us-east-1')):
+        monkeypatch.setenv(name, value)
+    with moto.mock_aws():
+        client = boto3.client('s3', region_name='us-east-1')
+        client.create_bucket(Bucket=BUCKET)
+        app.config.update(STORAGE_BACKEND='s3', S3_BUCKET=BUCKET, S3_REGION='us-east-1')
+        storage._s3.cache_clear()
+        yield client
+        storage._s3.cache_clear()
+
+
+def keys(client, prefix=''):
+    return sorted(obj['Key'] for obj in client.list_objects_v2(Bucket=BUCKET, Prefix=prefix).get('Contents', []))
+
+
+def read(file):
+    return b''.join(storage.storage_for(file.path).read_range(file.path, 0, file.size))
+
+
+def test_uploads_are_stored_in_the_bucket(s3, client, root_id):
+    data = os.urandom(5000)
+    upload(client, root_id, 'a.bin', data)
+    upload(client, root_id, 'b.bin', data)
+
+    blob = Blob.query.one()
+    assert blob.path.startswith(f's3://{BUCKET}/blobs/')
+    assert blob.ref_count == 2
+    assert keys(s3) == [S3Storage.split(blob.path)[1]]
+    file = File.query.first()
+    assert read(file) == data
+
+    # Downloads go straight to the store
+    response = client.get(f'/download/{file.id}')
+    assert response.status_code == 302
+    assert S3Storage.split(blob.path)[1] in response.headers['Location']
+
+    for file in File.query.all():
+        client.post(f'/delete_file/{file.id}')
+    assert Blob.query.count() == 0
+    assert keys(s3) == []
+
+
+def test_chunked_upload_is_a_multipart_upload(s3, client, root_id):
+    chunk_size = S3Storage.MIN_PART_SIZE
+    data = os.urandom(2 * chunk_size + 1000)
+
+    response = chunked_upload(client, root_id, 'big.bin', data, chunk_size, order=[2, 0, 1])
+
+    result = response.get_json()
+    assert result['message'] == 'File upload complete'
+    assert ChunkedUpload.query.one().multipart_id
+    file = db.session.get(File, result['file_id'])
+    assert file.checksum == sha256(data)
+    assert file.path.startswith(f's3://{BUCKET}/blobs/')
+    assert read(file) == data
+    # Nothing of it was kept on this server
+    assert not os.listdir(CHUNK_FOLDER)
+
+    # The copy stored under the chunk digest is left for the sweeper
+    sweep_orphans(0)
+    assert keys(s3) == [S3Storage.split(file.path)[1]]
+    assert keys(s3, 'uploads/') == []
+
+
+def test_small_chunks_are_stored_once_assembled(s3, client, root_id):
+    # Chunks too small to be parts are kept locally and stored once assembled
+    data = os.urandom(3000)
+    response = chunked_upload(client, root_id, 'small.bin', data, 1000)
+
+    assert not ChunkedUpload.query.one().multipart_id
+    file = db.session.get(File, response.get_json()['file_id'])
+    assert file.path.startswith('s3://')
+    assert read(file) == data
+
+
+def test_cancel_aborts_the_multipart_upload(s3, client, root_id):
+    chunk_size = S3Storage.MIN_PART_SIZE
+    upload_id = init_upload(client, root_id, 'big.bin', 2 * chunk_size, chunk_size).get_json()['upload_id']
+    assert send_chunk(client, upload_id, 0, os.urandom(chunk_size)).status_code == 200
+    assert s3.list_multipart_uploads(Bucket=BUCKET).get('Uploads')
+
+    assert client.delete(f'/api/upload/{upload_id}').status_code == 200
+    assert not s3.list_multipart_uploads(Bucket=BUCKET).get('Uploads')
+    assert keys(s3) == []
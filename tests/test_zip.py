@@ -0,0 +1,81 @@
+import io
+import os
+import zipfile
+from datetime import datetime
+
+from app import db
+from models import Folder
+from utils import stream_zip
+from conftest import upload
+
+
+def entry(name, data, compress=True, mtime=datetime(2024, 5, 17, 12, 30, 10)):
+    return name, len(data), mtime, compress, lambda: [data[i:i + 1000] for i in range(0, len(data), 1000)]
+
+
+def build(entries):
+    return b''.join(stream_zip(entries))
+
+
+def test_round_trip():
+    text = b'hello zip\n' * 1000
+    binary = os.urandom(5000)
+    archive = zipfile.ZipFile(io.BytesIO(build([
+        entry('docs/hello.txt', text),
+        entry('docs/photo.jpg', binary, compress=False),
+        entry('empty', b'', mtime=None),
+    ])))
+
+    assert archive.testzip() is None
+    assert archive.namelist() == ['docs/hello.txt', 'docs/photo.jpg', 'empty']
+    assert archive.read('docs/hello.txt') == text
+    assert archive.read('docs/photo.jpg') == binary
+    assert archive.read('empty') == b''
+    hello, photo, empty = archive.infolist()
+    assert hello.compress_type == zipfile.ZIP_DEFLATED and hello.compress_size < len(text)
+    assert photo.compress_type == zipfile.ZIP_STORED
+    assert hello.date_time == (2024, 5, 17, 12, 30, 10)
+    assert empty.date_time == (1980, 1, 1, 0, 0, 0)
+
+
+def test_output_is_streamed():
+    pieces = stream_zip([entry(f'{i}.bin', os.urandom(3000), compress=False) for i in range(5)])
+    assert sum(1 for _ in pieces) > 5
+
+
+def test_zip64_entry_count():
+    data = build([entry(f'{i}', b'', mtime=None) for i in range(0xFFFF + 1)])
+    assert b'PK\x06\x06' in data[-200:]
+    archive = zipfile.ZipFile(io.BytesIO(data))
+    assert len(archive.infolist()) == 0xFFFF + 1
+    assert archive.read('65535') == b''
+
+
+def test_zip64_sizes(monkeypatch):
+    # Entries past the 4 GiB limit get ZIP64 sizes; a lower limit stands in for it here
+    monkeypatch.setattr(zipfile, 'ZIP64_LIMIT', 1 << 12)
+    big = os.urandom(10000)
+    data = build([entry('small', b'x'), entry('big', big, compress=False), entry('after', b'y')])
+
+    assert b'PK\x06\x06' in data
+    archive = zipfile.ZipFile(io.BytesIO(data))
+    assert archive.testzip() is None
+    assert [archive.read(name) for name in ('small', 'big', 'after')] == [b'x', big, b'y']
+
+
+def test_download_folder(client, root_id):
+    folder = Folder(name='Trip', user_id=db.session.get(Folder, root_id).user_id, parent_id=root_id)
+    db.session.add(folder)
+    db.session.commit()
+    notes = b'day one\n' * 1000
+    photo = os.urandom(3000)
+    upload(client, root_id, 'notes.txt', notes)
+    upload(client, folder.id, 'photo.jpg', photo)
+
+    response = client.get(f'/download_folder/{root_id}')
+    assert response.status_code == 200
+    assert response.mimetype == 'application/zip'
+    archive = zipfile.ZipFile(io.BytesIO(response.get_data()))
+    assert archive.read('Root/notes.txt') == notes
+    assert archive.read('Root/Trip/photo.jpg') == photo
+    assert archive.getinfo('Root/Trip/photo.jpg').compress_type == zipfile.ZIP_STORED
@@ -0,0 +1,231 @@
+import os
+import time
+import hashlib
+import logging
+import tempfile
+import threading
+import multiprocessing
+from functools import partial
+from concurrent.futures import Future, ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from app import app, THUMBNAIL_FOLDER
+from blobs import shard_dir
+from storage import storage_for
+from utils import THUMBNAIL_TYPES, render_thumbnail
+
+# Thumbnails of image files, so listings can show previews without sending the
+# originals. Decoding and resizing is CPU-bound, so it runs in a process pool per
+# web worker. Thumbnails are cached on disk by the file's contents, which makes
+# them shared between duplicate files and never stale; the cache is kept under
+# THUMBNAIL_CACHE_SIZE by evicting the least recently used ones, and an evicted
+# thumbnail is rendered again the next time it is asked for.
+
+_pool = None
+_pool_lock = threading.Lock()
+_pending = {}  # Thumbnail path: Future, for renders in progress in this worker
+_pending_lock = threading.Lock()
+_usage = None  # Bytes this worker believes the cache holds, None until it was measured
+_usage_lock = threading.Lock()
+
+# Cache hits refresh a thumbnail's modification time, which eviction goes by, at most this often
+TOUCH_INTERVAL = 24 * 3600
+
+def has_thumbnail(file):
+    """Whether a file is an image a thumbnail can be made of"""
+    return ((file.file_type or '').lower() in THUMBNAIL_TYPES
+            and file.size <= app.config['THUMBNAIL_MAX_SOURCE_SIZE'])
+
+def thumbnail_path(file):
+    """Where a file's thumbnail is cached"""
+    key = file.checksum or f"file:{file.id}"
+    name = hashlib.sha256(f"{key}:{app.config['THUMBNAIL_SIZE']}".encode()).hexdigest()
+    return os.path.join(shard_dir(THUMBNAIL_FOLDER, name), f"{name}.webp")
+
+def get_pool():
+    global _pool
+    if _pool is None:
+        with _pool_lock:
+            if _pool is None:
+                # Spawned rather than forked: this process runs threads (jobs, the
+                # sweeper) that a fork could copy while they hold a lock
+                _pool = ProcessPoolExecutor(max_workers=app.config['THUMBNAIL_WORKERS'],
+                                            mp_context=multiprocessing.get_context('spawn'))
+    return _pool
+
+def discard_pool(pool):
+    """Drop a pool that broke (a render took its process down) so the next render starts a new one"""
+    global _pool
+    with _pool_lock:
+        if _pool is pool:
+            _pool = None
+    pool.shutdown(wait=False)
+
+def submit(*args):
+    pool = get_pool()
+    try:
+        return pool.submit(render_thumbnail, *args)
+    except BrokenProcessPool:
+        discard_pool(pool)
+        return get_pool().submit(render_thumbnail, *args)
+
+def image_source(file):
+    """
+    A local path the pool can read a file's image from
+    :return: (path, temporary); temporary copies are made of data that is encrypted,
+             compressed or not on local disk, and must be removed after use
+    """
+    if not file.encrypted and not file.compressed and storage_for(file.path).is_local:
+        return file.path, False
+
+    from app import file_reader
+    length, read_range = file_reader(file)
+    fd, temp_path = tempfile.mkstemp(dir=THUMBNAIL_FOLDER, suffix='.src')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            for buf in read_range(0, length):
+                f.write(buf)
+    except Exception:
+        os.remove(temp_path)
+        raise
+    return temp_path, True
+
+def render(file):
+    """Start rendering a file's thumbnail; returns a Future resolving to its path"""
+    path = thumbnail_path(file)
+    with _pending_lock:
+        future = _pending.get(path)
+        if future:
+            return future
+        future = _pending[path] = Future()
+
+    try:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        source, temporary = image_source(file)
+        args = (source, path, app.config['THUMBNAIL_SIZE'], app.config['THUMBNAIL_MAX_PIXELS'])
+        if app.config['THUMBNAIL_WORKERS'] == 0:
+            # No pool: render in the calling thread
+            rendered = Future()
+            try:
+                rendered.set_result(render_thumbnail(*args))
+            except Exception as e:
+                rendered.set_exception(e)
+        else:
+            rendered = submit(*args)
+    except Exception as e:
+        # The original could not be read; nothing is cached so it is tried again later
+        with _pending_lock:
+            _pending.pop(path, None)
+        future.set_exception(e)
+        return future
+
+    rendered.add_done_callback(partial(finish_render, path, source if temporary else None, future))
+    return future
+
+def finish_render(path, temporary_source, future, rendered):
+    """Record the outcome of a render once the pool is done with it"""
+    if temporary_source and os.path.exists(temporary_source):
+        os.remove(temporary_source)
+
+    size = 0
+    try:
+        size = rendered.result()
+    except BrokenProcessPool:
+        if _pool is not None:
+            discard_pool(_pool)
+        logging.warning(f"Thumbnail pool broke while rendering {path}")
+    except Exception as e:
+        # An empty thumbnail records that the image can't be read, so broken
+        # images aren't decoded again on every listing
+        logging.warning(f"Could not render thumbnail {path}: {e}")
+        open(path, 'wb').close()
+
+    with _pending_lock:
+        _pending.pop(path, None)
+    future.set_result(path)
+    account(size)
+
+def account(size):
+    """Count a new thumbnail towards the cache size, trimming the cache when it is over its bound"""
+    global _usage
+    with _usage_lock:
+        if _usage is not None:
+            _usage += size
+        over = _usage is None or _usage > app.config['THUMBNAIL_CACHE_SIZE']
+    if over:
+        trim_cache()
+
+def trim_cache(limit=None):
+    """
+    Evict the least recently used thumbnails until the cache is within its size bound
+    Every worker adds to the cache, so the sweeper also calls this periodically.
+    :return: (count, bytes) removed
+    """
+    global _usage
+    limit = app.config['THUMBNAIL_CACHE_SIZE'] if limit is None else limit
+    entries = []
+    for directory, _, names in os.walk(THUMBNAIL_FOLDER):
+        for name in names:
+            path = os.path.join(directory, name)
+            try:
+                info = os.stat(path)
+            except FileNotFoundError:
+                continue
+            entries.append((info.st_mtime, info.st_size, path))
+
+    total = sum(size for _, size, _ in entries)
+    removed = freed = 0
+    if total > limit:
+        # Down to 90% of the bound, so a full cache isn't trimmed after every render
+        entries.sort()
+        for _, size, path in entries:
+            if total - freed <= limit * 0.9:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                continue
+            removed += 1
+            freed += size
+
+    with _usage_lock:
+        _usage = total - freed
+    return removed, freed
+
+def get_thumbnail(file, timeout=None):
+    """
+    Path of a file's thumbnail, rendering it first on a cache miss
+    :return: the path, or None if the image can't be read
+    :raises TimeoutError: if rendering takes longer than timeout seconds
+    """
+    path = thumbnail_path(file)
+    try:
+        info = os.stat(path)
+    except FileNotFoundError:
+        try:
+            path = render(file).result(timeout=timeout)
+        except TimeoutError:
+            raise
+        except Exception as e:
+            logging.warning(f"Could not read image of file {file.id}: {e}")
+            return None
+        try:
+            info = os.stat(path)
+        except FileNotFoundError:
+            # Lost with a broken pool, or evicted already
+            return None
+    else:
+        if time.time() - info.st_mtime > TOUCH_INTERVAL:
+            os.utime(path)
+    return path if info.st_size else None
+
+def queue_thumbnail(file):
+    """Render a newly stored image's thumbnail in the background, so the first listing finds it ready"""
+    if app.config['THUMBNAIL_WORKERS'] == 0 or not has_thumbnail(file):
+        return
+    # Only data the pool can read straight from disk; the rest is rendered on first view
+    if file.encrypted or file.compressed or not storage_for(file.path).is_local:
+        return
+    try:
+        render(file)
+    except Exception:
+        logging.exception(f"Could not queue thumbnail of file {file.id}")
@@ -1,72 +1,565 @@
 import os
+import io
 import base64
+import hashlib
 import secrets
-from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes
-from cryptography.hazmat.backends import default_backend
-from cryptography.hazmat.primitives import padding
+import zipfile
+import zlib
+import qrcode
+from PIL import Image, ImageOps
+from functools import lru_cache
+from cryptography.hazmat.primitives import hashes
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+from cryptography.hazmat.primitives.kdf.hkdf import HKDF
+from werkzeug.exceptions import RequestEntityTooLarge
+from werkzeug.sansio.multipart import MultipartDecoder, Field, File as FilePart, Data, Epilogue, NeedData
 
 def generate_key():
     """Generate a secure 64-byte key"""
     return secrets.token_bytes(64)
 
-def pad_data(data):
-    """Pad data to be a multiple of block size"""
-    padder = padding.PKCS7(128).padder()
-    return padder.update(data) + padder.finalize()
+# Encrypted file format: a fixed header followed by independently authenticated
+# AES-256-GCM segments, so any segment can be decrypted on its own.
+#   header:  magic (4) | version (1) | reserved (3) | segment size (4) | salt (16)
+#   segment: ciphertext (segment size, shorter for the last one) | GCM tag (16)
+# The per-file key is derived from the user key and the salt; each segment's nonce
+# is its index plus a flag marking the final segment, which stops truncation.
+ENCRYPTION_MAGIC = b'FLKS'
+ENCRYPTION_VERSION = 1
+ENCRYPTION_HEADER_SIZE = 28
+ENCRYPTION_TAG_SIZE = 16
+DEFAULT_SEGMENT_SIZE = 64 * 1024
 
-def unpad_data(padded_data):
-    """Remove padding from data"""
-    unpadder = padding.PKCS7(128).unpadder()
-    return unpadder.update(padded_data) + unpadder.finalize()
+def _segment_key(key, salt):
+    """Derive the AES-256 key for one file from the 64-byte user key"""
+    return HKDF(algorithm=hashes.SHA256(), length=32, salt=salt,
+                info=b'filelock segmented encryption').derive(key)
 
-def encrypt_file(file_data, key):
+def _segment_nonce(index, final):
+    return index.to_bytes(11, 'big') + (b'\x01' if final else b'\x00')
+
+def _read_header(header):
+    if len(header) != ENCRYPTION_HEADER_SIZE or header[:4] != ENCRYPTION_MAGIC:
+        raise ValueError('Not an encrypted file')
+    if header[4] != ENCRYPTION_VERSION:
+        raise ValueError(f'Unsupported encryption version {header[4]}')
+    segment_size = int.from_bytes(header[8:12], 'big')
+    salt = header[12:28]
+    return segment_size, salt
+
+def encrypted_size(plaintext_size, segment_size=DEFAULT_SEGMENT_SIZE):
+    """Size of the encrypted form of plaintext_size bytes"""
+    segments = max(1, -(-plaintext_size // segment_size))
+    return ENCRYPTION_HEADER_SIZE + plaintext_size + segments * ENCRYPTION_TAG_SIZE
+
+def plaintext_size(ciphertext_size, segment_size):
+    """Size of the plaintext held in an encrypted file of ciphertext_size bytes"""
+    body = ciphertext_size - ENCRYPTION_HEADER_SIZE
+    full_segments, remainder = divmod(body, segment_size + ENCRYPTION_TAG_SIZE)
+    if remainder:
+        return full_segments * segment_size + remainder - ENCRYPTION_TAG_SIZE
+    return full_segments * segment_size
+
+def encrypt_stream(chunks, key, segment_size=DEFAULT_SEGMENT_SIZE):
+    """
+    Encrypt an iterable of byte chunks, yielding the encrypted file piece by piece
+    :param chunks: iterable of bytes (e.g. a generator or iter(f.read, b''))
+    :param key: 64-byte key
+    :return: generator of bytes: the header, then one item per segment
+    Memory use is bounded by the segment size, whatever the input size.
+    """
+    salt = os.urandom(16)
+    header = (ENCRYPTION_MAGIC + bytes([ENCRYPTION_VERSION]) + bytes(3)
+              + segment_size.to_bytes(4, 'big') + salt)
+    aesgcm = AESGCM(_segment_key(key, salt))
+    yield header
+    
+    buffer = bytearray()
+    index = 0
+    for chunk in chunks:
+        buffer += chunk
+        # Keep at least one byte back so the final segment is always known
+        while len(buffer) > segment_size:
+            yield aesgcm.encrypt(_segment_nonce(index, False), bytes(buffer[:segment_size]), header)
+            del buffer[:segment_size]
+            index += 1
+    yield aesgcm.encrypt(_segment_nonce(index, True), bytes(buffer), header)
+
+def decrypt_stream(f, key, start=0, end=None):
+    """
+    Decrypt part of an encrypted file, touching only the segments that overlap it
+    :param f: seekable binary file object positioned anywhere
+    :param key: 64-byte key
+    :param start: first plaintext byte to return
+    :param end: plaintext offset to stop at (exclusive), None for the end of the file
+    :return: generator of plaintext bytes
+    Raises cryptography.exceptions.InvalidTag if any segment read was tampered with.
+    """
+    f.seek(0)
+    header = f.read(ENCRYPTION_HEADER_SIZE)
+    segment_size, salt = _read_header(header)
+    aesgcm = AESGCM(_segment_key(key, salt))
+    
+    total = plaintext_size(f.seek(0, os.SEEK_END), segment_size)
+    end = total if end is None else min(end, total)
+    if start >= end and total > 0:
+        return
+    
+    last_index = max(0, -(-total // segment_size) - 1)
+    index = start // segment_size
+    while index <= last_index:
+        f.seek(ENCRYPTION_HEADER_SIZE + index * (segment_size + ENCRYPTION_TAG_SIZE))
+        ciphertext = f.read(segment_size + ENCRYPTION_TAG_SIZE)
+        plaintext = aesgcm.decrypt(_segment_nonce(index, index == last_index), ciphertext, header)
+        
+        segment_start = index * segment_size
+        piece = plaintext[max(0, start - segment_start):end - segment_start]
+        if piece:
+            yield piece
+        if segment_start + segment_size >= end:
+            break
+        index += 1
+
+def decrypted_size(f):
+    """Plaintext size of an encrypted file object"""
+    f.seek(0)
+    segment_size, _ = _read_header(f.read(ENCRYPTION_HEADER_SIZE))
+    return plaintext_size(f.seek(0, os.SEEK_END), segment_size)
+
+def encrypt_file(src, dst, key, segment_size=DEFAULT_SEGMENT_SIZE, buffer_size=1024 * 1024):
+    """
+    Encrypt one file object into another using AES-256-GCM segments
+    :param src: readable binary file object with the plaintext
+    :param dst: writable binary file object for the encrypted data
+    :param key: 64-byte key
+    :return: number of bytes written to dst
+    """
+    written = 0
+    for piece in encrypt_stream(iter(lambda: src.read(buffer_size), b''), key, segment_size):
+        dst.write(piece)
+        written += len(piece)
+    return written
+
+def decrypt_file(src, dst, key):
     """
-    Encrypt file data using AES-256 with the provided key
-    :param file_data: bytes to be encrypted
-    :param key: 64-byte key (we'll use first 32 bytes for AES-256)
-    :return: bytes containing IV + encrypted data
+    Decrypt an encrypted file object into another
+    :param src: seekable binary file object produced by encrypt_file/encrypt_stream
+    :param dst: writable binary file object for the plaintext
+    :param key: 64-byte key
+    :return: number of plaintext bytes written
     """
-    # Use first 32 bytes for AES-256
-    aes_key = key[:32]
-    # Generate a random IV
-    iv = os.urandom(16)
+    written = 0
+    for piece in decrypt_stream(src, key):
+        dst.write(piece)
+        written += len(piece)
+    return written
+
+# Compressed format: a header, independently deflated segments, then an index of
+# their compressed lengths and a footer with the uncompressed size, so any byte
+# range can be read by inflating only the segments that overlap it.
+COMPRESSION_MAGIC = b'FLKZ'
+COMPRESSION_VERSION = 1
+COMPRESSION_HEADER_SIZE = 12
+COMPRESSION_FOOTER_SIZE = 20
+DEFAULT_COMPRESSION_SEGMENT_SIZE = 256 * 1024
+
+# Signatures of formats that are compressed already, whatever their extension
+# (gzip, zip and the office formats built on it, bzip2, xz, zstd, 7z, rar, PNG, JPEG)
+COMPRESSED_SIGNATURES = (b'\x1f\x8b', b'PK\x03\x04', b'BZh', b'\xfd7zXZ\x00', b'\x28\xb5\x2f\xfd',
+                         b"7z\xbc\xaf\x27\x1c", b'Rar!', b'\x89PNG', b'\xff\xd8\xff')
+
+def worth_compressing(file_type, sample, min_saving=0.1):
+    """
+    Whether data is worth compressing at rest, judged by its type and a sample of its start
+    Already-compressed types and formats are skipped, and the sample must shrink by
+    at least min_saving when deflated quickly.
+    """
+    if is_precompressed(file_type) or sample.startswith(COMPRESSED_SIGNATURES):
+        return False
+    return len(zlib.compress(sample, 1)) <= len(sample) * (1 - min_saving)
+
+def compress_stream(chunks, level=6, segment_size=DEFAULT_COMPRESSION_SEGMENT_SIZE):
+    """
+    Compress an iterable of byte chunks into the segmented format, piece by piece
+    :return: generator of bytes: the header, one item per segment, then the index and footer
+    """
+    yield (COMPRESSION_MAGIC + bytes([COMPRESSION_VERSION]) + bytes(3) + segment_size.to_bytes(4, 'big'))
     
-    # Create an encryptor
-    cipher = Cipher(algorithms.AES(aes_key), modes.CBC(iv), backend=default_backend())
-    encryptor = cipher.encryptor()
+    lengths = []
+    total = 0
+    buffer = bytearray()
     
-    # Pad the data to be a multiple of block size
-    padded_data = pad_data(file_data)
+    def segment(data):
+        compressed = zlib.compress(data, level)
+        lengths.append(len(compressed))
+        return compressed
     
-    # Encrypt the data
-    encrypted_data = encryptor.update(padded_data) + encryptor.finalize()
+    for chunk in chunks:
+        buffer += chunk
+        total += len(chunk)
+        while len(buffer) >= segment_size:
+            yield segment(bytes(buffer[:segment_size]))
+            del buffer[:segment_size]
+    if buffer:
+        yield segment(bytes(buffer))
     
-    # Return IV + encrypted data
-    return iv + encrypted_data
+    yield (b''.join(length.to_bytes(4, 'big') for length in lengths)
+           + total.to_bytes(8, 'big') + len(lengths).to_bytes(8, 'big') + COMPRESSION_MAGIC)
 
-def decrypt_file(encrypted_data, key):
+def decompress_stream(read_at, stored_size, start=0, end=None, max_read=8 * 1024 * 1024):
     """
-    Decrypt file data using AES-256 with the provided key
-    :param encrypted_data: bytes containing IV + encrypted data
-    :param key: 64-byte key (first 32 bytes for AES-256)
-    :return: decrypted bytes
+    Decompress part of a compressed file, inflating only the segments that overlap it
+    :param read_at: called with (offset, length), returns that many bytes of the stored file
+    :param stored_size: size of the stored (compressed) file
+    :param start: first uncompressed byte to return
+    :param end: uncompressed offset to stop at (exclusive), None for the end of the file
+    :param max_read: compressed bytes fetched per read_at call, as several segments at once
+    :return: generator of uncompressed bytes
     """
-    # Use first 32 bytes for AES-256
-    aes_key = key[:32]
+    footer = read_at(stored_size - COMPRESSION_FOOTER_SIZE, COMPRESSION_FOOTER_SIZE)
+    if footer[16:] != COMPRESSION_MAGIC:
+        raise ValueError('Not a compressed file')
+    total = int.from_bytes(footer[:8], 'big')
+    count = int.from_bytes(footer[8:16], 'big')
+    header = read_at(0, COMPRESSION_HEADER_SIZE)
+    if header[:4] != COMPRESSION_MAGIC or header[4] != COMPRESSION_VERSION:
+        raise ValueError('Unsupported compressed file')
+    segment_size = int.from_bytes(header[8:12], 'big')
     
-    # Extract IV from the beginning of encrypted data
-    iv = encrypted_data[:16]
-    encrypted_data = encrypted_data[16:]
+    end = total if end is None else min(end, total)
+    if start >= end:
+        return
     
-    # Create a decryptor
-    cipher = Cipher(algorithms.AES(aes_key), modes.CBC(iv), backend=default_backend())
-    decryptor = cipher.decryptor()
+    index = read_at(stored_size - COMPRESSION_FOOTER_SIZE - 4 * count, 4 * count)
+    lengths = [int.from_bytes(index[i * 4:i * 4 + 4], 'big') for i in range(count)]
+    first, last = start // segment_size, (end - 1) // segment_size
+    offset = COMPRESSION_HEADER_SIZE + sum(lengths[:first])
     
-    # Decrypt the data
-    padded_data = decryptor.update(encrypted_data) + decryptor.finalize()
+    number = first
+    while number <= last:
+        # Fetch a run of consecutive segments in one read
+        batch = [number]
+        size = lengths[number]
+        while batch[-1] < last and size + lengths[batch[-1] + 1] <= max_read:
+            batch.append(batch[-1] + 1)
+            size += lengths[batch[-1]]
+        data = read_at(offset, size)
+        position = 0
+        for segment_number in batch:
+            plain = zlib.decompress(data[position:position + lengths[segment_number]])
+            position += lengths[segment_number]
+            segment_start = segment_number * segment_size
+            piece = plain[max(0, start - segment_start):end - segment_start]
+            if piece:
+                yield piece
+        offset += size
+        number = batch[-1] + 1
+
+def compress_file(src, dst, level=6, buffer_size=1024 * 1024):
+    """
+    Compress one file object into another in the segmented format
+    :return: number of bytes written to dst
+    """
+    written = 0
+    for piece in compress_stream(iter(lambda: src.read(buffer_size), b''), level):
+        dst.write(piece)
+        written += len(piece)
+    return written
+
+def preallocate_file(path, size):
+    """Create a file of the given size, reserving the disk blocks where supported"""
+    with open(path, 'wb') as f:
+        if size <= 0:
+            return
+        try:
+            os.posix_fallocate(f.fileno(), 0, size)
+        except (AttributeError, OSError):
+            # Not available on this platform/filesystem, fall back to a sparse file
+            f.truncate(size)
+
+def write_stream_at(path, offset, stream, buffer_size=1024 * 1024, hasher=None):
+    """
+    Copy a readable stream into an existing file starting at the given offset
+    :param path: file to write into (must already exist)
+    :param offset: byte offset of the first byte
+    :param stream: file-like object with a read(size) method
+    :param hasher: optional hashlib object updated with every byte written
+    :return: number of bytes written
+    """
+    written = 0
+    with open(path, 'r+b') as f:
+        fd = f.fileno()
+        if not hasattr(os, 'pwrite'):
+            f.seek(offset)
+        while True:
+            buf = stream.read(buffer_size)
+            if not buf:
+                break
+            if hasher:
+                hasher.update(buf)
+            if hasattr(os, 'pwrite'):
+                view = memoryview(buf)
+                while view:
+                    n = os.pwrite(fd, view, offset + written)
+                    view = view[n:]
+                    written += n
+            else:
+                f.write(buf)
+                written += len(buf)
+    return written
+
+def copy_stream(stream, path, buffer_size=1024 * 1024, hasher=None):
+    """Copy a readable stream into a new file, returning the number of bytes written"""
+    written = 0
+    with open(path, 'wb') as f:
+        for buf in iter(lambda: stream.read(buffer_size), b''):
+            if hasher:
+                hasher.update(buf)
+            f.write(buf)
+            written += len(buf)
+    return written
+
+def stream_multipart(stream, boundary, destination_for, buffer_size=1024 * 1024, max_field_size=64 * 1024):
+    """
+    Parse a multipart/form-data body incrementally, writing file parts straight to disk
+    :param stream: request body stream
+    :param boundary: multipart boundary as bytes
+    :param destination_for: called with (field_name, filename) for each file part, returns
+                            the path to write it to, or None to discard the part
+    :return: (fields, files) where fields maps names to lists of values and files is a list
+             of dicts with field, filename, path, size and sha256 of every stored file
+    Memory use is bounded by buffer_size; files are hashed and sized as they are written.
+    """
+    decoder = MultipartDecoder(boundary)
+    fields = {}
+    files = []
+    current = None
+    container = None
+    output = None
+    
+    try:
+        while True:
+            data = stream.read(buffer_size)
+            decoder.receive_data(data or None)
+            event = decoder.next_event()
+            while not isinstance(event, (Epilogue, NeedData)):
+                if isinstance(event, Field):
+                    current = event
+                    container = []
+                elif isinstance(event, FilePart):
+                    path = destination_for(event.name, event.filename) if event.filename else None
+                    current = {'field': event.name, 'filename': event.filename, 'path': path,
+                               'size': 0, 'sha256': hashlib.sha256()}
+                    output = open(path, 'wb') if path else None
+                elif isinstance(event, Data):
+                    if isinstance(current, Field):
+                        container.append(event.data)
+                        if sum(len(part) for part in container) > max_field_size:
+                            raise RequestEntityTooLarge()
+                        if not event.more_data:
+                            fields.setdefault(current.name, []).append(b''.join(container).decode('utf-8', 'replace'))
+                    else:
+                        if output:
+                            output.write(event.data)
+                            current['size'] += len(event.data)
+                            current['sha256'].update(event.data)
+                        if not event.more_data:
+                            if output:
+                                output.close()
+                                output = None
+                                current['sha256'] = current['sha256'].hexdigest()
+                                files.append(current)
+                event = decoder.next_event()
+            if not data or isinstance(event, Epilogue):
+                break
+    except Exception:
+        # Don't leave partial files behind
+        if output:
+            output.close()
+            files.append(current)
+        for stored in files:
+            if os.path.exists(stored['path']):
+                os.remove(stored['path'])
+        raise
     
-    # Unpad the data
-    return unpad_data(padded_data)
+    return fields, files
+
+def parse_byte_ranges(header, length, max_ranges=32):
+    """
+    Resolve an HTTP Range header against a representation length
+    :param header: value of the Range header
+    :param length: size of the full representation in bytes
+    :return: None if the header should be ignored (serve the whole body), an empty
+             list if no range is satisfiable, else a list of (start, stop) with stop
+             exclusive, in request order
+    """
+    if not header or not header.strip().lower().startswith('bytes='):
+        return None
+    
+    ranges = []
+    for spec in header.split('=', 1)[1].split(','):
+        spec = spec.strip()
+        if not spec:
+            continue
+        first, sep, last = spec.partition('-')
+        if not sep:
+            return None
+        try:
+            if not first:
+                # Suffix range: the last N bytes
+                suffix = int(last)
+                if suffix <= 0 or length == 0:
+                    continue
+                ranges.append((max(0, length - suffix), length))
+                continue
+            start = int(first)
+            stop = int(last) + 1 if last else max(length, start + 1)
+        except ValueError:
+            return None
+        if start < 0 or stop <= start:
+            return None
+        if start >= length:
+            continue
+        ranges.append((start, min(stop, length)))
+    
+    if len(ranges) > max_ranges:
+        # Too many pieces to be worth it, send the whole thing instead
+        return None
+    return ranges
+
+class FileRange:
+    """
+    A file read from its current offset for at most length bytes
+    fileno() and tell() are passed through, so a server can still send the range
+    with sendfile(2); plain readers stop at the end of the range.
+    """
+    def __init__(self, f, length):
+        self._file = f
+        self._remaining = length
+
+    def read(self, size=-1):
+        if size is None or size < 0 or size > self._remaining:
+            size = self._remaining
+        data = self._file.read(size) if size else b''
+        self._remaining -= len(data)
+        return data
+
+    def fileno(self):
+        return self._file.fileno()
+
+    def tell(self):
+        return self._file.tell()
+
+    def close(self):
+        self._file.close()
+
+class _ZipOutput(io.RawIOBase):
+    """Write-only, non-seekable sink that collects zip output until it is drained"""
+    def __init__(self):
+        self._chunks = []
+        self._offset = 0
+
+    def writable(self):
+        return True
+
+    def write(self, b):
+        self._chunks.append(bytes(b))
+        self._offset += len(b)
+        return len(b)
+
+    def tell(self):
+        return self._offset
+
+    def drain(self):
+        data = b''.join(self._chunks)
+        self._chunks.clear()
+        return data
+
+def stream_zip(entries):
+    """
+    Generate a zip archive on the fly, without buffering it
+    :param entries: iterable of (arcname, size, mtime, compress, read_chunks) where mtime is
+                    a datetime, compress says whether to deflate, and read_chunks() returns
+                    an iterable of the entry's bytes
+    :return: generator of zip bytes
+    Entries use data descriptors, and ZIP64 records wherever sizes, offsets or the
+    entry count need them, so archives of any size can be produced.
+    """
+    output = _ZipOutput()
+    with zipfile.ZipFile(output, 'w', allowZip64=True) as zipf:
+        for arcname, size, mtime, compress, read_chunks in entries:
+            info = zipfile.ZipInfo(arcname, date_time=mtime.timetuple()[:6] if mtime else (1980, 1, 1, 0, 0, 0))
+            info.compress_type = zipfile.ZIP_DEFLATED if compress else zipfile.ZIP_STORED
+            info.file_size = size  # Lets zipfile decide whether the entry needs ZIP64
+            with zipf.open(info, 'w') as dest:
+                for chunk in read_chunks():
+                    dest.write(chunk)
+                    data = output.drain()
+                    if data:
+                        yield data
+            data = output.drain()
+            if data:
+                yield data
+    # Closing the archive wrote the central directory
+    yield output.drain()
+
+def is_precompressed(file_type):
+    """Whether a file type is already compressed, so deflating it again is wasted CPU"""
+    file_type = file_type.lower() if file_type else ''
+    if file_type in ['bmp', 'svg']:
+        # Listed as images, but stored uncompressed
+        return False
+    return get_file_icon(file_type) in ['fa-file-image', 'fa-file-video', 'fa-file-archive']
+
+@lru_cache(maxsize=1024)
+def qr_code_png(data):
+    """
+    Render data as a QR code PNG. Results are cached, since the same upload links
+    are encoded over and over.
+    :return: (png bytes, etag)
+    """
+    qr = qrcode.QRCode(
+        version=1,
+        error_correction=qrcode.constants.ERROR_CORRECT_L,
+        box_size=10,
+        border=4,
+    )
+    qr.add_data(data)
+    qr.make(fit=True)
+
+    img = qr.make_image(fill_color="black", back_color="white")
+    buffered = io.BytesIO()
+    img.save(buffered)
+    png = buffered.getvalue()
+    return png, hashlib.sha256(png).hexdigest()[:32]
+
+# Image types thumbnails are made of
+THUMBNAIL_TYPES = {'jpg', 'jpeg', 'png', 'gif', 'bmp', 'webp'}
+
+def render_thumbnail(src, dst, size, max_pixels=None):
+    """
+    Write a WebP thumbnail of an image, at most size pixels on its longest side
+    This runs in the thumbnail process pool, so it only works from its arguments.
+    :param max_pixels: refuse images larger than this (decompression bombs)
+    :return: the thumbnail's size in bytes
+    """
+    Image.MAX_IMAGE_PIXELS = max_pixels
+    temp_path = f"{dst}.{os.getpid()}.tmp"
+    with Image.open(src) as img:
+        # JPEGs can be decoded straight at a fraction of their size, much faster for photos
+        img.draft('RGB', (size, size))
+        img = ImageOps.exif_transpose(img)
+        img.thumbnail((size, size))
+        if img.mode not in ('RGB', 'RGBA'):
+            img = img.convert('RGBA' if img.has_transparency_data else 'RGB')
+        try:
+            img.save(temp_path, 'WEBP', quality=80)
+        except Exception:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+            raise
+    os.replace(temp_path, dst)
+    return os.path.getsize(dst)
 
 def get_file_icon(file_type):
     """Return appropriate Font Awesome icon class based on file type"""